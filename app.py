@@ -1,102 +1,219 @@
 # !/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-from flask import Flask, render_template, request, jsonify, session, redirect, url_for, flash
+from flask import Flask, render_template, request, jsonify, session, redirect, url_for, flash, Response, g
 from flask_session import Session
 from werkzeug.middleware.proxy_fix import ProxyFix
-import os
 from werkzeug.utils import secure_filename
 from werkzeug.security import check_password_hash, generate_password_hash
 import json
+import logging
+import os
 import time
-import markdown
 from pathlib import Path
 import threading
 import queue
-import uuid
 from contextlib import contextmanager
 
 from config import Config
-from deepseek_helpers import DeepSeekChatPersistent
-from database import ChatDatabase, UserDatabase
+from deepseek_helpers import DeepSeekChatPersistent, ReasoningSplitter
+from database import ChatDatabase, UserDatabase, OperationDatabase
+from sharding import ShardRouter
+from cache import LRUCache
+from context_store import ContextStore
+from engine_pool import EnginePool
+from state_store import create_state_store
+from rendering import MarkdownRenderer
+from uploads import UploadPipeline, UploadError, normalize_files
+from message_pipeline import MessagePipeline, StageTimer
+from metrics import REGISTRY as metrics_registry
+from tracing import TRACER as tracer
+from profiling import SamplingProfiler, RequestProfiler
+from app_logging import setup_logging, parse_levels, dropped_records
+from responses import conditional_json, compress_response, make_etag, parse_timestamp
+from operations import OperationRegistry, FINISHED_STATUSES
+from job_queue import JobWorkerPool
+from ws_channel import ChatChannel
+
+try:
+    from flask_sock import Sock
+except ImportError:
+    # Без flask-sock WebSocket-канала нет, клиент работает через REST
+    Sock = None
 
 app = Flask(__name__)
 app.config.from_object(Config)
 
+# Журнал пишется из отдельного потока: запросы только ставят записи в очередь
+setup_logging(level=app.config['LOG_LEVEL'],
+              module_levels=parse_levels(app.config['LOG_LEVELS']),
+              json_output=app.config['LOG_FORMAT'] == 'json',
+              sample_rates=app.config['LOG_SAMPLE_RATES'],
+              queue_size=app.config['LOG_QUEUE_SIZE'])
+log = logging.getLogger(__name__)
+
 # Настройка для работы за прокси
 app.wsgi_app = ProxyFix(app.wsgi_app, x_for=1, x_proto=1, x_host=1, x_port=1)
 
 Session(app)
 
+tracer.configure(app.config['TRACE_SAMPLE_RATE'], app.config['TRACE_BUFFER_SPANS'], app.config['TRACE_FILE'])
+# Профилирование работающего процесса по команде администратора
+sampling_profiler = SamplingProfiler(max_seconds=app.config['PROFILE_MAX_SECONDS'],
+                                     min_interval=app.config['PROFILE_MIN_INTERVAL'])
+request_profiler = RequestProfiler()
+
 # Глобальные объекты
-# chat_instance = None
-# chat_lock = threading.Lock()
-# Вместо одного глобального экземпляра - словарь по пользователям
-user_chat_instances = {}
-chat_lock = threading.Lock()
-db = ChatDatabase()
-user_db = UserDatabase()
-# Глобальные переменные для асинхронных операций
-async_operations = {}
-operation_lock = threading.Lock()
-
-
-class AsyncOperation:
-    def __init__(self, operation_id):
-        self.operation_id = operation_id
-        self.status = "pending"  # pending, running, completed, error
-        self.progress = ""
-        self.result = None
-        self.error = None
-        self.start_time = time.time()
-
-
-def get_chat_instance():
-    """Получает экземпляр чата для конкретного пользователя"""
-    global user_chat_instances
-
-    # Проверяем, находимся ли мы в контексте запроса
-    try:
-        user_id = session.get('user_id')
-    except RuntimeError:
-        # Если нет контекста запроса, возвращаем глобальный экземпляр
-        global chat_instance
-        with chat_lock:
-            if chat_instance is None:
-                chat_instance = DeepSeekChatPersistent(
-                    model_name=app.config['DEEPSEEK_MODEL'],
-                    max_context_tokens=app.config['MAX_CONTEXT_TOKENS']
-                )
-            return chat_instance
-
-    if not user_id:
-        raise Exception("Пользователь не авторизован")
-
-    with chat_lock:
-        if user_id not in user_chat_instances:
-            user_chat_instances[user_id] = DeepSeekChatPersistent(
-                model_name=app.config['DEEPSEEK_MODEL'],
-                max_context_tokens=app.config['MAX_CONTEXT_TOKENS']
-            )
-        return user_chat_instances[user_id]
-
-
-# Добавляем функцию очистки неактивных пользователей
-def cleanup_inactive_users():
-    """Очищает экземпляры чата неактивных пользователей"""
+# Состояние, которое должны видеть все процессы-воркеры (см. STATE_STORE)
+state = create_state_store(app.config['STATE_STORE'])
+shard_router = None
+if app.config['SHARD_COUNT'] > 0:
+    shard_router = ShardRouter('chat_history.db', app.config['SHARD_COUNT'],
+                               shard_dir=app.config['SHARD_DIR'], archive_path=app.config['ARCHIVE_PATH'])
+read_cache = LRUCache(max_entries=app.config['CACHE_MAX_ENTRIES'],
+                      max_bytes=app.config['CACHE_MAX_BYTES'],
+                      ttl=app.config['CACHE_TTL'],
+                      publisher=state.publish if state.shared else None)
+# Вложения декодируются потоково, без временных файлов
+uploads = UploadPipeline(max_file_bytes=app.config['UPLOAD_MAX_FILE_BYTES'],
+                         max_file_tokens=app.config['UPLOAD_MAX_FILE_TOKENS'],
+                         max_files=app.config['UPLOAD_MAX_FILES'])
+# HTML ответов рендерится один раз при сохранении и хранится вместе с сообщением
+renderer = MarkdownRenderer()
+db = ChatDatabase(compress_threshold=app.config['COMPRESS_THRESHOLD'],
+                  compress_level=app.config['COMPRESS_LEVEL'],
+                  archive_path=app.config['ARCHIVE_PATH'],
+                  router=shard_router,
+                  cache=read_cache,
+                  renderer=renderer)
+user_db = UserDatabase(archive_path=app.config['ARCHIVE_PATH'], router=shard_router, cache=read_cache)
+contexts = ContextStore(db,
+                        state=state,
+                        max_entries=app.config['CONTEXT_CACHE_SIZE'],
+                        max_bytes=app.config['CONTEXT_CACHE_MAX_BYTES'],
+                        ttl=app.config['CONTEXT_CACHE_TTL'])
+# Движки разговоров по сессиям: вкладки с разными сессиями работают независимо
+engines = EnginePool(lambda: DeepSeekChatPersistent(model_name=app.config['DEEPSEEK_MODEL'],
+                                                    max_context_tokens=app.config['MAX_CONTEXT_TOKENS']),
+                     contexts,
+                     state=state,
+                     max_engines=app.config['ENGINE_POOL_SIZE'],
+                     max_bytes=app.config['ENGINE_POOL_MAX_BYTES'],
+                     idle_timeout=app.config['ENGINE_IDLE_TIMEOUT'])
+# Этапы обработки сообщения, общие для синхронной отправки и очереди
+pipeline = MessagePipeline(db, user_db, contexts, renderer)
+# Асинхронные операции - задачи в очереди в БД. В памяти только активные и недавние
+operations = OperationRegistry(OperationDatabase(),
+                               max_entries=app.config['OPERATION_REGISTRY_SIZE'],
+                               ttl=app.config['OPERATION_TTL'],
+                               fetched_ttl=app.config['OPERATION_FETCHED_TTL'])
+
+
+def get_chat_instance(session_id=None):
+    """Движок разговора для сессии чата (по умолчанию - текущей сессии пользователя)"""
+    if session_id is None:
+        if not session.get('user_id'):
+            raise Exception("Пользователь не авторизован")
+        session_id = get_session_id()
+    return engines.get(session_id)
+
+
+def cleanup_idle_engines():
+    """Выгружает движки сессий, к которым давно не обращались"""
     while True:
-        time.sleep(3600)  # Каждый час
-        with chat_lock:
-            # Здесь можно добавить логику удаления неактивных пользователей
-            # Например, если пользователь не активен больше 2 часов
-            pass
+        time.sleep(app.config['ENGINE_CLEANUP_INTERVAL'])
+        try:
+            evicted = engines.evict()
+            if evicted:
+                log.info("Выгружено неактивных движков: %d", evicted)
+        except Exception:
+            log.exception("Ошибка выгрузки движков")
 
 
-cleanup_thread = threading.Thread(target=cleanup_inactive_users)
+cleanup_thread = threading.Thread(target=cleanup_idle_engines)
 cleanup_thread.daemon = True
 cleanup_thread.start()
 
 
+def sync_cache_invalidations():
+    """Применяет к кешу чтения инвалидации, сделанные другими процессами"""
+    seq = None
+    while True:
+        try:
+            seq, events = state.events_since(seq)
+            for event in events:
+                read_cache.apply(event)
+        except Exception:
+            log.exception("Ошибка синхронизации кеша")
+
+        time.sleep(app.config['CACHE_SYNC_INTERVAL'])
+
+
+if state.shared:
+    cache_sync_thread = threading.Thread(target=sync_cache_invalidations)
+    cache_sync_thread.daemon = True
+    cache_sync_thread.start()
+
+
+def compress_history_background():
+    """Фоновое сжатие старых сообщений в БД"""
+    try:
+        moved = db.migrate_inline_attachments()
+        if moved['files_moved']:
+            log.info("Перенесено вложений в хранилище: %d", moved['files_moved'])
+
+        stats = db.compress_existing_messages()
+        log.info("Сжато сообщений: %d из %d, сэкономлено %.1f КБ",
+                 stats['rows_updated'], stats['rows_scanned'], stats['bytes_saved'] / 1024)
+    except Exception:
+        log.exception("Ошибка фонового сжатия истории")
+
+
+if app.config['COMPRESS_MIGRATE_ON_START']:
+    compress_thread = threading.Thread(target=compress_history_background)
+    compress_thread.daemon = True
+    compress_thread.start()
+
+
+def database_maintenance():
+    """Периодическое обслуживание БД: архивирование и инкрементальная очистка"""
+    try:
+        if db.enable_incremental_vacuum():
+            log.info("Включен режим auto_vacuum=INCREMENTAL")
+    except Exception:
+        log.exception("Ошибка включения auto_vacuum")
+
+    while True:
+        try:
+            stats = db.archive_idle_sessions(app.config['ARCHIVE_IDLE_DAYS'])
+            if stats['sessions_archived']:
+                log.info("В архив перенесено сессий: %d, сообщений: %d",
+                         stats['sessions_archived'], stats['messages_archived'])
+
+            purged = operations.store.purge_operations(app.config['OPERATION_RETENTION_DAYS'])
+            if purged:
+                log.info("Удалено старых операций: %d", purged)
+            operations.evict()
+
+            retention = app.config['STATE_RETENTION_SECONDS']
+            purged = state.purge('context:', retention) + state.purge_events(retention)
+            if purged:
+                log.info("Удалено старых записей общего состояния: %d", purged)
+
+            freed = db.incremental_vacuum(app.config['VACUUM_PAGES'])
+            if any(freed.values()):
+                log.info("Освобождено страниц: %s", freed)
+        except Exception:
+            log.exception("Ошибка обслуживания БД")
+
+        time.sleep(app.config['MAINTENANCE_INTERVAL'])
+
+
+maintenance_thread = threading.Thread(target=database_maintenance)
+maintenance_thread.daemon = True
+maintenance_thread.start()
+
+
 def get_session_id():
     """Получение ID сессии"""
     if 'session_id' not in session or not session['session_id']:
@@ -105,26 +222,99 @@ def get_session_id():
     return session['session_id']
 
 
+def owns_session(user_id, session_id):
+    """Сессия из запроса клиента принадлежит пользователю"""
+    return user_db.get_session_owner(session_id) == user_id
+
+
 def allowed_file(filename):
     """Проверяет, разрешено ли расширение файла"""
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in app.config['ALLOWED_EXTENSIONS']
 
 
-def read_file_content(file_path):
-    """Читает содержимое файла"""
-    try:
-        with open(file_path, 'r', encoding='utf-8') as f:
-            return f.read()
-    except UnicodeDecodeError:
-        for encoding in ['cp1251', 'latin1']:
-            try:
-                with open(file_path, 'r', encoding=encoding) as f:
-                    return f.read()
-            except:
-                continue
-        return "[ОШИБКА: Не удалось прочитать файл - неподдерживаемая кодировка]"
-    except Exception as e:
-        return f"[ОШИБКА при чтении файла: {str(e)}]"
+def history_response(session_id):
+    """История сессии для /get_history и /load_session: 304, если не менялась у клиента"""
+    updated_at, message_count, last_id = db.get_session_revision(session_id)
+    # HTML ответов зависит от версии рендерера
+    etag = make_etag(session_id, updated_at, message_count, last_id, renderer.version)
+    return conditional_json(request, etag, parse_timestamp(updated_at),
+                            lambda: {'success': True, 'messages': db.get_messages(session_id)})
+
+
+def read_multipart_message():
+    """Сообщение, session_id и вложения multipart-запроса (потоковый разбор, см. UploadPipeline)"""
+    fields, files = uploads.parse(request.stream, request.content_type, allowed=allowed_file)
+    files_content = [file for field, file in files if field == 'files']
+    return fields.get('message', '').strip(), fields.get('session_id', ''), files_content
+
+
+# Запросы без трассы: статика, сбор метрик, служебные endpoint-ы и долгие WebSocket-соединения
+UNTRACED_PREFIXES = ('/static/', '/metrics', '/admin/', '/ws')
+
+
+@app.before_request
+def start_trace():
+    """Корневой спан запроса (если запрос попал в выборку)"""
+    if request.path.startswith(UNTRACED_PREFIXES):
+        return
+    route = request.url_rule.rule if request.url_rule is not None else request.path
+    g.trace = tracer.trace(f"{request.method} {route}", user_id=session.get('user_id'))
+    g.trace_span = g.trace.__enter__()
+
+
+@app.after_request
+def trace_response(response):
+    trace_span = g.get('trace_span')
+    if trace_span is not None and trace_span.trace_id is not None:
+        trace_span.set(status_code=response.status_code)
+        response.headers['X-Trace-Id'] = trace_span.trace_id
+    return response
+
+
+@app.teardown_request
+def finish_trace(error=None):
+    trace = g.pop('trace', None)
+    if trace is not None:
+        g.pop('trace_span', None)
+        trace.__exit__(type(error) if error else None, error, None)
+
+
+@app.before_request
+def start_request_profile():
+    """cProfile запроса, помеченного через /admin/profile/request"""
+    if request.path.startswith('/admin/'):
+        return
+    g.profile = request_profiler.claim(request.path)
+
+
+@app.after_request
+def remember_status(response):
+    if g.get('profile') is not None:
+        g.profile_status = response.status_code
+    return response
+
+
+@app.teardown_request
+def finish_request_profile(error=None):
+    profile = g.pop('profile', None)
+    if profile is not None:
+        request_profiler.finish(profile, request.method, request.path, g.get('profile_status'))
+        log.info("Профиль запроса %s %s сохранен", request.method, request.path)
+
+
+def admin_authorized():
+    """Запрос к /admin/* с верным токеном. Без ADMIN_TOKEN служебные endpoint-ы выключены"""
+    token = app.config['ADMIN_TOKEN']
+    return bool(token) and request.headers.get('Authorization') == f'Bearer {token}'
+
+
+@app.after_request
+def compress_json(response):
+    """Сжатие больших JSON-ответов (история, список сессий, статусы операций)"""
+    return compress_response(response, request,
+                             min_size=app.config['RESPONSE_COMPRESS_MIN_SIZE'],
+                             gzip_level=app.config['RESPONSE_GZIP_LEVEL'],
+                             brotli_quality=app.config['RESPONSE_BROTLI_QUALITY'])
 
 
 @app.route('/')
@@ -176,12 +366,9 @@ def chat():
     if 'logged_in' not in session or not session['logged_in']:
         return redirect(url_for('login'))
 
-    chat_inst = get_chat_instance()
-    model_loaded = chat_inst.model_loaded
-
     return render_template('chat.html',
                            username=session['username'],
-                           model_loaded=model_loaded,
+                           model_loaded=engines.model_loaded,
                            model_name=app.config['DEEPSEEK_MODEL'])
 
 
@@ -192,12 +379,7 @@ def get_history():
         return jsonify({'error': 'Не авторизован'}), 401
 
     try:
-        session_id = get_session_id()
-        messages = db.get_messages(session_id)
-        return jsonify({
-            'success': True,
-            'messages': messages
-        })
+        return history_response(get_session_id())
     except Exception as e:
         return jsonify({'error': f'Ошибка получения истории: {str(e)}'}), 500
 
@@ -217,15 +399,16 @@ def preload_model():
                 'message': 'Модель уже загружена в память'
             })
 
-        print("🔄 Запускаю предзагрузку модели...")
-        print("⏱️ Это может занять очень много времени для больших моделей на CPU...")
+        log.info("Запускаю предзагрузку модели")
 
         # Загружаем модель БЕЗ каких-либо таймаутов
         start_time = time.time()
         success = chat_inst.preload_model()
         load_time = time.time() - start_time
+        if success:
+            engines.set_model_loaded(True)
 
-        print(f"⏱️ Общее время загрузки: {load_time:.2f} секунд ({load_time / 60:.2f} минут)")
+        log.info("Общее время загрузки модели: %.2f с", load_time, extra={'load_seconds': round(load_time, 2)})
 
         if success:
             return jsonify({
@@ -241,9 +424,7 @@ def preload_model():
 
     except Exception as e:
         error_msg = f"Ошибка при загрузке модели: {str(e)}"
-        print(f"❌ {error_msg}")
-        import traceback
-        traceback.print_exc()
+        log.exception("Ошибка при загрузке модели")
 
         return jsonify({
             'success': False,
@@ -257,192 +438,99 @@ def send_message():
     if 'logged_in' not in session or not session['logged_in']:
         return jsonify({'error': 'Не авторизован'}), 401
 
+    chat_inst = None
+    timer = StageTimer()
     try:
         # Читаем данные из form
         if request.content_type and 'multipart/form-data' in request.content_type:
-            message = request.form.get('message', '').strip()
-            session_id = request.form.get('session_id', '')
-
-            # Обрабатываем файлы
-            files_content = []
-            uploaded_files = request.files.getlist('files')
-
-            for file in uploaded_files:
-                if file and file.filename:
-                    if allowed_file(file.filename):
-                        try:
-                            content = file.read().decode('utf-8')
-                            files_content.append({
-                                'name': file.filename,
-                                'content': content
-                            })
-                        except UnicodeDecodeError:
-                            file.seek(0)
-                            try:
-                                content = file.read().decode('cp1251')
-                                files_content.append({
-                                    'name': file.filename,
-                                    'content': content
-                                })
-                            except:
-                                files_content.append({
-                                    'name': file.filename,
-                                    'content': f'[ОШИБКА: Не удалось прочитать файл - неподдерживаемая кодировка]'
-                                })
-                    else:
-                        return jsonify({'error': f'Неподдерживаемый тип файла: {file.filename}'}), 400
+            with timer.stage('upload'):
+                message, session_id, files_content = read_multipart_message()
         else:
             data = request.get_json()
             message = data.get('message', '').strip()
             session_id = data.get('session_id', '')
-            files_content = data.get('files', [])
+            files_content = normalize_files(data.get('files'))
 
         if not message:
             return jsonify({'error': 'Пустое сообщение'}), 400
 
-        chat_inst = get_chat_instance()
-
+        user_id = session.get('user_id')
         if session_id:
+            # Чужая сессия не попадает ни в сессию Flask, ни в пул движков
+            if not owns_session(user_id, session_id):
+                return jsonify({'error': 'Сессия не найдена или не принадлежит вам'}), 404
             session['session_id'] = session_id
         else:
             session_id = get_session_id()
 
+        # Движок сессии не выгружается, пока идет генерация
+        with timer.stage('engine'):
+            chat_inst = engines.acquire(session_id)
+
         if not chat_inst.model_loaded:
             return jsonify({'error': 'Модель не загружена. Используйте кнопку "Загрузить модель"'}), 400
 
-        # Обрабатываем прикрепленные файлы
-        original_message = message
-
-        if files_content:
-            file_texts = []
-            for file_data in files_content:
-                filename = file_data.get('name', 'unknown')
-                content = file_data.get('content', '')
-
-                if len(content) > 200000:
-                    content = content[:200000] + "\n\n[... файл обрезан из-за большого размера ...]"
-
-                file_text = f"[Файл: {filename}]\n"
-                file_text += f"[Размер: {len(content)} символов]\n"
-                file_text += "--- СОДЕРЖИМОЕ ФАЙЛА ---\n"
-                file_text += content
-                file_text += "\n--- КОНЕЦ ФАЙЛА ---\n\n"
-                file_texts.append(file_text)
-
-            message = ''.join(file_texts) + message
-
-        # Сохраняем сообщение пользователя в БД
-        db.save_message(session_id, 'user', original_message, files=files_content, user_id=session.get('user_id'))
+        prompt = pipeline.prepare(session_id, user_id, message, files_content, timer)
 
         # Отправляем сообщение БЕЗ каких-либо таймаутов
         start_time = time.time()
 
-        print(f"📤 Отправляю сообщение: {message[:100]}...")
-        print("⏳ Ожидание ответа от модели (может занять несколько часов для CPU)...")
+        log.info("Отправляю сообщение в модель", extra={'event': 'turn.sent', 'session_id': session_id,
+                                                         'prompt_chars': len(prompt)})
+        log.debug("Начало запроса: %.100s", prompt, extra={'event': 'message.preview'})
 
         # Простая отправка без таймаутов
-        response = chat_inst.send_message(message)
+        with timer.stage('model'):
+            response = chat_inst.send_message(prompt)
 
         if isinstance(response, dict) and 'error' in response:
             return jsonify({'error': response['error']}), 500
 
-        print(f"📥 Получен ответ: {response[:100]}...")
+        log.debug("Начало ответа: %.100s", response, extra={'event': 'message.preview'})
 
-        response_time = time.time() - start_time
-
-        # Обновление названия сессии
-        messages_count = len(db.get_messages(session_id))
-        if messages_count == 1:
-            title = original_message[:50] + ('...' if len(original_message) > 50 else '')
-            user_db.update_session_title(session_id, title)
-
-        # Обрабатываем ответ
-        thinking_text = ""
-        final_response = response
-
-        if "<think>" in response and "</think>" in response:
-            import re
-            thinking_match = re.search(r'<think>(.*?)</think>', response, re.DOTALL)
-            if thinking_match:
-                thinking_text = thinking_match.group(1).strip()
-                final_response = re.sub(r'<think>.*?</think>', '', response, flags=re.DOTALL).strip()
-
-        if not final_response.strip():
-            final_response = "Извините, произошла ошибка при обработке ответа."
-
-        # Сохраняем ответ ассистента в БД
-        db.save_message(session_id, 'assistant', final_response, thinking_text, response_time,
-                        files=None, user_id=session.get('user_id'))
-
-        # Создаем ответ
-        response_data = {
-            'success': True,
-            'thinking': thinking_text,
-            'response': final_response,
-            'response_time': round(response_time, 2),
-            'session_id': session_id
-        }
-
-        # Конвертируем markdown в HTML
-        try:
-            html_response = markdown.markdown(final_response, extensions=['codehilite', 'fenced_code', 'tables'])
-            response_data['html_response'] = html_response
-        except Exception as e:
-            print(f"❌ Ошибка конвертации markdown: {str(e)}")
-            response_data['html_response'] = final_response
-
-        print(f"✅ Отправляю ответ в браузер: {len(final_response)} символов")
-        print(f"⏱️ Общее время обработки: {response_time:.2f} секунд ({response_time / 60:.2f} минут)")
+        response_data = pipeline.finish(session_id, user_id, message, response, time.time() - start_time,
+                                        chat_inst, timer)
 
         # Возвращаем ответ
         response = jsonify(response_data)
         response.headers['Content-Type'] = 'application/json; charset=utf-8'
         return response
 
+    except UploadError as e:
+        return jsonify({'error': str(e)}), e.status
     except Exception as e:
-        print(f"❌ Ошибка в send_message: {str(e)}")
-        import traceback
-        traceback.print_exc()
+        log.exception("Ошибка в send_message")
 
         error_response = jsonify({'error': f'Ошибка при отправке сообщения: {str(e)}'})
         error_response.headers['Content-Type'] = 'application/json; charset=utf-8'
         return error_response, 500
+    finally:
+        if chat_inst is not None:
+            engines.release(session_id)
 
 
 @app.route('/upload_file', methods=['POST'])
 def upload_file():
-    """Загрузка файла"""
+    """Загрузка файла: содержимое декодируется по мере чтения запроса, без записи на диск"""
     if 'logged_in' not in session or not session['logged_in']:
         return jsonify({'error': 'Не авторизован'}), 401
 
     try:
-        if 'file' not in request.files:
-            return jsonify({'error': 'Файл не выбран'}), 400
-
-        file = request.files['file']
-        if file.filename == '':
+        _, files = uploads.parse(request.stream, request.content_type, allowed=allowed_file)
+        uploaded = [file for field, file in files if field == 'file']
+        if not uploaded:
             return jsonify({'error': 'Файл не выбран'}), 400
 
-        if file and allowed_file(file.filename):
-            filename = secure_filename(file.filename)
-            upload_folder = app.config['UPLOAD_FOLDER']
-            os.makedirs(upload_folder, exist_ok=True)
-
-            file_path = os.path.join(upload_folder, filename)
-            file.save(file_path)
-
-            content = read_file_content(file_path)
-            os.remove(file_path)
-
-            return jsonify({
-                'success': True,
-                'filename': filename,
-                'content': content,
-                'size': len(content)
-            })
-        else:
-            return jsonify({'error': 'Неподдерживаемый тип файла'}), 400
+        file = uploaded[0]
+        return jsonify({
+            'success': True,
+            'filename': secure_filename(file['name']),
+            'content': file['content'],
+            'size': len(file['content'])
+        })
 
+    except UploadError as e:
+        return jsonify({'error': str(e)}), e.status
     except Exception as e:
         return jsonify({'error': f'Ошибка загрузки файла: {str(e)}'}), 500
 
@@ -459,6 +547,7 @@ def clear_history():
 
         chat_inst.clear_history()
         db.clear_session(session_id)
+        contexts.drop(session_id)
 
         return jsonify({'success': True, 'message': 'История очищена'})
 
@@ -490,7 +579,14 @@ def get_status():
             'max_tokens': chat_inst.max_context_tokens,
             'used_percent': round(used_percent, 1),
             'messages_count': len(chat_inst.conversation_history),
-            'db_stats': stats
+            'db_stats': stats,
+            'compression': db.get_compression_stats(),
+            'cache': read_cache.stats(),
+            'rendering': {'version': renderer.version, 'renders': renderer.renders},
+            'contexts': contexts.stats(),
+            'engines': engines.stats(),
+            'operations': operations.stats(),
+            'jobs': job_workers.stats()
         })
 
     except Exception as e:
@@ -507,7 +603,10 @@ def get_sessions():
         user_id = session['user_id']
         sessions = user_db.get_user_sessions(user_id)
 
-        return jsonify({'success': True, 'sessions': sessions})
+        # Список сессий небольшой: валидатор - хеш его содержимого
+        etag = make_etag(user_id, *(f"{s['session_id']}/{s['title']}/{s['updated_at']}" for s in sessions))
+        last_modified = max((parse_timestamp(s['updated_at']) for s in sessions if s['updated_at']), default=None)
+        return conditional_json(request, etag, last_modified, lambda: {'success': True, 'sessions': sessions})
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)})
 
@@ -519,24 +618,18 @@ def load_session(session_id):
         return jsonify({'success': False, 'error': 'Не авторизован'})
 
     try:
-        session['session_id'] = session_id
-        messages = db.get_messages(session_id)
+        if user_db.get_session_owner(session_id) != session.get('user_id'):
+            return jsonify({'success': False, 'error': 'Сессия не найдена или не принадлежит вам'})
 
-        # ВАЖНО: Восстанавливаем контекст в модели
-        chat_inst = get_chat_instance()
-        chat_inst.clear_history()  # Очищаем старый контекст
+        session['session_id'] = session_id
 
-        # Загружаем историю в модель
-        for msg in messages:
-            if msg['role'] in ['user', 'assistant']:
-                chat_inst.conversation_history.append({
-                    "role": msg['role'],
-                    "content": msg['content']
-                })
+        # Движок сессии либо уже в памяти, либо восстанавливается из снимка
+        chat_inst = get_chat_instance(session_id)
 
-        print(f"🔄 Восстановлен контекст: {len(chat_inst.conversation_history)} сообщений")
+        log.debug("Контекст сессии: %d сообщений", len(chat_inst.conversation_history),
+                  extra={'session_id': session_id})
 
-        return jsonify({'success': True, 'messages': messages})
+        return history_response(session_id)
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)})
 
@@ -552,11 +645,8 @@ def new_chat():
         session_id = user_db.create_session(user_id)
         session['session_id'] = session_id
 
-        # Очищаем контекст модели для нового чата
-        chat_inst = get_chat_instance()
-        chat_inst.clear_history()
-
-        print("🆕 Создан новый чат, контекст очищен")
+        # Движок новой сессии создастся с пустым контекстом при первом сообщении
+        log.info("Создан новый чат", extra={'session_id': session_id})
 
         return jsonify({'success': True, 'session_id': session_id})
     except Exception as e:
@@ -569,201 +659,267 @@ def send_message_async():
     if 'logged_in' not in session or not session['logged_in']:
         return jsonify({'error': 'Не авторизован'}), 401
 
-    # Создаем операцию
-    operation_id = str(uuid.uuid4())
-    operation = AsyncOperation(operation_id)
-
-    with operation_lock:
-        async_operations[operation_id] = operation
-
-    # ВАЖНО: Сохраняем данные сессии ДО запуска потока
+    # ВАЖНО: Сохраняем данные сессии ДО постановки задачи в очередь
     user_id = session.get('user_id')
     current_session_id = session.get('session_id', '')
-
-    # Получаем chat_instance ТУТ, в контексте запроса
-    try:
-        chat_inst = get_chat_instance()
-    except Exception as e:
-        operation.status = "error"
-        operation.error = f"Ошибка получения чата: {str(e)}"
-        return jsonify({'error': f'Ошибка получения чата: {str(e)}'}), 500
+    timer = StageTimer()
 
     # Получаем данные из запроса
     try:
         if request.content_type and 'multipart/form-data' in request.content_type:
-            message = request.form.get('message', '').strip()
-            session_id = request.form.get('session_id', '')
-
-            # Обрабатываем файлы
-            files_content = []
-            uploaded_files = request.files.getlist('files')
-
-            for file in uploaded_files:
-                if file and file.filename:
-                    if allowed_file(file.filename):
-                        try:
-                            content = file.read().decode('utf-8')
-                            files_content.append({
-                                'name': file.filename,
-                                'content': content
-                            })
-                        except:
-                            files_content.append({
-                                'name': file.filename,
-                                'content': f'[ОШИБКА: Не удалось прочитать файл]'
-                            })
+            with timer.stage('upload'):
+                message, session_id, files_content = read_multipart_message()
         else:
             data = request.get_json()
             message = data.get('message', '').strip()
             session_id = data.get('session_id', '')
-            files_content = data.get('files', [])
+            files_content = normalize_files(data.get('files'))
 
         if not message:
-            operation.status = "error"
-            operation.error = "Пустое сообщение"
             return jsonify({'error': 'Пустое сообщение'}), 400
 
+        if session_id and not owns_session(user_id, session_id):
+            return jsonify({'error': 'Сессия не найдена или не принадлежит вам'}), 404
+
+    except UploadError as e:
+        return jsonify({'error': str(e)}), e.status
     except Exception as e:
-        operation.status = "error"
-        operation.error = str(e)
         return jsonify({'error': f'Ошибка обработки запроса: {str(e)}'}), 400
 
-    # Определяем финальный session_id
-    if session_id:
-        final_session_id = session_id
-    else:
-        if not current_session_id:
-            final_session_id = user_db.create_session(user_id)
-        else:
-            final_session_id = current_session_id
-
-    # Запускаем обработку в отдельном потоке
-    def process_message():
-        try:
-            operation.status = "running"
-            operation.progress = "Инициализация..."
+    operation, rejection = enqueue_message(user_id, session_id or current_session_id, message, files_content,
+                                           timer)
+    if rejection:
+        response = jsonify({'success': False, 'error': rejection})
+        response.headers['Retry-After'] = str(app.config['JOB_RETRY_AFTER'])
+        return response, 429
 
-            # НЕ ИСПОЛЬЗУЕМ session внутри потока - используем переданные переменные
-            if not chat_inst.model_loaded:
-                operation.status = "error"
-                operation.error = "Модель не загружена. Используйте кнопку 'Загрузить модель'"
-                return
+    return jsonify({
+        'success': True,
+        'operation_id': operation.operation_id,
+        'message': 'Сообщение принято в обработку'
+    })
 
-            # Обрабатываем прикрепленные файлы
-            original_message = message
-            processed_message = message
 
-            if files_content:
-                operation.progress = "Обработка файлов..."
-                file_texts = []
-                for file_data in files_content:
-                    filename = file_data.get('name', 'unknown')
-                    content = file_data.get('content', '')
+def enqueue_message(user_id, session_id, message, files_content, timer=None):
+    """Ставит сообщение в очередь (REST и WebSocket).
 
-                    if len(content) > 200000:
-                        content = content[:200000] + "\n\n[... файл обрезан ...]"
+    Принадлежность session_id пользователю проверяет вызывающий (owns_session).
+    Возвращает (операция, None) или (None, причина отказа).
+    """
+    # Очередь ограничена: сверх лимита новые задачи отклоняются сразу
+    rejection = job_workers.admit(user_id)
+    if rejection:
+        return None, rejection
 
-                    file_text = f"[Файл: {filename}]\n--- СОДЕРЖИМОЕ ---\n{content}\n--- КОНЕЦ ---\n\n"
-                    file_texts.append(file_text)
+    # Определяем финальный session_id
+    final_session_id = session_id or user_db.create_session(user_id)
+
+    # Сообщение пользователя сохраняется при приеме задачи:
+    # повторный запуск задачи после сбоя не продублирует его
+    timer = timer or StageTimer()
+    prompt = pipeline.prepare(final_session_id, user_id, message, files_content, timer)
+
+    # Ставим задачу в очередь - её выполнит воркер этого или другого процесса
+    operation = operations.create(user_id, final_session_id, payload={
+        'message': prompt,
+        'original_message': message,
+        'timings': timer.timings,
+        # Задача продолжает трассу запроса, даже если её выполнит другой процесс
+        'trace': tracer.inject()
+    })
+    job_workers.notify()
 
-                processed_message = ''.join(file_texts) + message
+    return operation, None
 
-            # Сохраняем сообщение пользователя
-            db.save_message(final_session_id, 'user', original_message, files=files_content, user_id=user_id)
 
-            # Отправляем сообщение в AI
-            operation.progress = "Ожидание ответа от AI..."
-            start_time = time.time()
+def process_job(operation, payload, registry):
+    """Выполнение задачи из очереди в трассе поставившего её запроса"""
+    with tracer.trace('job', parent=payload.get('trace'), operation_id=operation.operation_id,
+                      attempt=operation.attempt) as job_span:
+        run_job(operation, payload, registry)
+        job_span.set(status=operation.status)
 
-            response = chat_inst.send_message(processed_message)
 
-            if isinstance(response, dict) and 'error' in response:
-                operation.status = "error"
-                operation.error = response['error']
-                return
+def run_job(operation, payload, registry):
+    """Запрос к модели и сохранение ответа"""
+    session_id = operation.session_id
+    user_id = operation.user_id
+    original_message = payload['original_message']
 
-            response_time = time.time() - start_time
+    # Этапы приема задачи продолжаются этапами воркера
+    timer = StageTimer(payload.get('timings'))
+    timer.add('queue', time.time() - operation.start_time)
 
-            # Обновление названия сессии
-            messages_count = len(db.get_messages(final_session_id))
-            if messages_count == 1:
-                title = original_message[:50] + ('...' if len(original_message) > 50 else '')
-                user_db.update_session_title(final_session_id, title)
+    registry.progress(operation, "Инициализация...")
 
-            # Обрабатываем ответ
-            thinking_text = ""
-            final_response = response
+    # Движок сессии не выгружается, пока идет генерация.
+    # После сбоя процесса контекст восстанавливается из снимка до этого хода
+    with timer.stage('engine'):
+        chat_inst = engines.acquire(session_id)
+    try:
+        if not chat_inst.model_loaded:
+            operation.status = "error"
+            operation.error = "Модель не загружена. Используйте кнопку 'Загрузить модель'"
+            return
 
-            if "<think>" in response and "</think>" in response:
-                import re
-                thinking_match = re.search(r'<think>(.*?)</think>', response, re.DOTALL)
-                if thinking_match:
-                    thinking_text = thinking_match.group(1).strip()
-                    final_response = re.sub(r'<think>.*?</think>', '', response, flags=re.DOTALL).strip()
+        # Отправляем сообщение в AI. Ответ идет потоком: фрагменты получают
+        # подписчики WebSocket, а отмена прерывает генерацию
+        registry.progress(operation, "Ожидание ответа от AI...")
+        start_time = time.time()
 
-            if not final_response.strip():
-                final_response = "Извините, произошла ошибка при обработке ответа."
+        splitter = ReasoningSplitter()
 
-            # Сохраняем ответ ассистента
-            db.save_message(final_session_id, 'assistant', final_response, thinking_text, response_time,
-                            files=None, user_id=user_id)
+        def on_chunk(text):
+            for kind, part in splitter.feed(text):
+                registry.emit(operation, kind, part)
 
-            # Результат операции
-            operation.result = {
-                'success': True,
-                'thinking': thinking_text,
-                'response': final_response,
-                'response_time': round(response_time, 2),
-                'session_id': final_session_id
-                # НЕ включаем 'user_message' - оно уже показано в UI
-            }
+        with timer.stage('model'):
+            response = chat_inst.send_message(payload['message'], on_chunk=on_chunk,
+                                              should_stop=lambda: operation.cancel_requested)
+        for kind, part in splitter.flush():
+            registry.emit(operation, kind, part)
 
-            operation.status = "completed"
-            operation.progress = "Готово"
+        if response is None:
+            operation.status = "cancelled"
+            operation.progress = "Отменено"
+            return
 
-        except Exception as e:
+        if isinstance(response, dict) and 'error' in response:
             operation.status = "error"
-            operation.error = str(e)
-            print(f"❌ Ошибка в асинхронной обработке: {str(e)}")
-            import traceback
-            traceback.print_exc()
+            operation.error = response['error']
+            return
 
-    # Запускаем поток
-    thread = threading.Thread(target=process_message)
-    thread.daemon = True
-    thread.start()
+        # Результат операции (без сообщения пользователя - оно уже показано в UI)
+        operation.result = pipeline.finish(session_id, user_id, original_message, response,
+                                           time.time() - start_time, chat_inst, timer)
 
-    return jsonify({
-        'success': True,
-        'operation_id': operation_id,
-        'message': 'Сообщение принято в обработку'
-    })
+        operation.status = "completed"
+        operation.progress = "Готово"
+    finally:
+        engines.release(session_id)
+
+
+job_workers = JobWorkerPool(operations, process_job,
+                            workers=app.config['JOB_WORKERS'],
+                            lease_seconds=app.config['JOB_LEASE_SECONDS'],
+                            poll_interval=app.config['JOB_POLL_INTERVAL'],
+                            max_attempts=app.config['JOB_MAX_ATTEMPTS'],
+                            max_queue=app.config['JOB_QUEUE_LIMIT'],
+                            max_queue_per_user=app.config['JOB_USER_QUEUE_LIMIT'])
+job_workers.start()
 
 
 @app.route('/operation_status/<operation_id>', methods=['GET'])
 def operation_status(operation_id):
-    """Проверка статуса асинхронной операции"""
-    with operation_lock:
-        operation = async_operations.get(operation_id)
+    """Проверка статуса асинхронной операции.
+
+    С параметрами wait (секунды), status и progress работает как long-poll:
+    отвечает, как только состояние отличается от переданного клиентом.
+    """
+    if not session.get('logged_in'):
+        return jsonify({'error': 'Не авторизован'}), 401
+
+    wait = min(request.args.get('wait', 0, type=float), app.config['OPERATION_LONG_POLL_TIMEOUT'])
+    if wait > 0:
+        response = operations.wait(operation_id, request.args.get('status'), request.args.get('progress'),
+                                   timeout=wait, user_id=session.get('user_id'))
+    else:
+        response = operations.status(operation_id, user_id=session.get('user_id'))
+
+    if not response:
+        return jsonify({'error': 'Операция не найдена'}), 404
+
+    return jsonify(response)
 
-        if not operation:
-            return jsonify({'error': 'Операция не найдена'}), 404
 
-        elapsed_time = time.time() - operation.start_time
+@app.route('/operation_events/<operation_id>', methods=['GET'])
+def operation_events(operation_id):
+    """Поток событий операции (Server-Sent Events): смена статуса, прогресс и итог"""
+    if not session.get('logged_in'):
+        return jsonify({'error': 'Не авторизован'}), 401
 
-        response = {
-            'operation_id': operation_id,
-            'status': operation.status,
-            'progress': operation.progress,
-            'elapsed_time': round(elapsed_time, 2)
-        }
+    user_id = session.get('user_id')
+    if operations.status(operation_id, user_id=user_id) is None:
+        return jsonify({'error': 'Операция не найдена'}), 404
+
+    def stream():
+        status = progress = None
+        while True:
+            response = operations.wait(operation_id, status, progress,
+                                       timeout=app.config['SSE_KEEPALIVE_INTERVAL'], user_id=user_id)
+            if response is None:
+                yield f"event: error\ndata: {json.dumps({'error': 'Операция не найдена'}, ensure_ascii=False)}\n\n"
+                return
 
-        if operation.status == "completed":
-            response['result'] = operation.result
-        elif operation.status == "error":
-            response['error'] = operation.error
+            if (response['status'], response['progress']) == (status, progress):
+                # Комментарий не дает прокси закрыть простаивающее соединение
+                yield ": keepalive\n\n"
+                continue
 
-        return jsonify(response)
+            status, progress = response['status'], response['progress']
+            yield f"data: {json.dumps(response, ensure_ascii=False)}\n\n"
+
+            if status in FINISHED_STATUSES:
+                return
+
+    return Response(stream(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@app.route('/cancel_operation/<operation_id>', methods=['POST'])
+def cancel_operation(operation_id):
+    """Отмена асинхронной операции: ожидающая снимается с очереди, выполняемая прерывается"""
+    if not session.get('logged_in'):
+        return jsonify({'error': 'Не авторизован'}), 401
+
+    outcome = operations.cancel(operation_id, user_id=session.get('user_id'))
+    if outcome is None:
+        return jsonify({'success': False, 'error': 'Операция не найдена или уже завершена'}), 404
+
+    return jsonify({'success': True, 'operation_id': operation_id, 'outcome': outcome})
+
+
+if Sock is not None:
+    sock = Sock(app)
+
+    @sock.route('/ws')
+    def chat_socket(ws):
+        """WebSocket-канал вкладки: отправка сообщений, поток ответа, очередь и отмена"""
+        if not session.get('logged_in'):
+            ws.close(reason=1008, message='Не авторизован')
+            return
+
+        user_id = session.get('user_id')
+        current_session_id = session.get('session_id', '')
+
+        def submit(owner_id, session_id, message, files_content):
+            if session_id and not owns_session(owner_id, session_id):
+                return None, 'Сессия не найдена или не принадлежит вам'
+            with tracer.trace('WS message', user_id=owner_id):
+                return enqueue_message(owner_id, session_id or current_session_id, message, files_content)
+
+        ChatChannel(ws, operations, submit, user_id,
+                    keepalive=app.config['SSE_KEEPALIVE_INTERVAL'],
+                    retry_after=app.config['JOB_RETRY_AFTER']).run()
+
+
+@app.route('/attachment/<session_id>/<blob_hash>', methods=['GET'])
+def get_attachment(session_id, blob_hash):
+    """Ленивая загрузка содержимого вложения"""
+    if not session.get('logged_in'):
+        return jsonify({'success': False, 'error': 'Не авторизован'}), 401
+
+    try:
+        if user_db.get_session_owner(session_id) != session.get('user_id'):
+            return jsonify({'success': False, 'error': 'Сессия не найдена или не принадлежит вам'}), 404
+
+        content = db.get_attachment(blob_hash, session_id=session_id)
+        if content is None:
+            return jsonify({'success': False, 'error': 'Вложение не найдено'}), 404
+
+        return jsonify({'success': True, 'hash': blob_hash, 'content': content, 'size': len(content)})
+    except Exception as e:
+        return jsonify({'success': False, 'error': f'Ошибка получения вложения: {str(e)}'}), 500
 
 
 @app.route('/delete_session/<session_id>', methods=['DELETE'])
@@ -775,36 +931,179 @@ def delete_session(session_id):
     try:
         # Проверяем, что сессия принадлежит текущему пользователю
         user_id = session.get('user_id')
-        sessions = user_db.get_user_sessions(user_id)
-
-        # Найдем сессию среди пользовательских сессий
-        session_exists = any(s['session_id'] == session_id for s in sessions)
 
-        if not session_exists:
+        if user_db.get_session_owner(session_id) != user_id:
             return jsonify({'success': False, 'error': 'Сессия не найдена или не принадлежит вам'}), 404
 
-        print(f"🗑️ Удаляем сессию {session_id} для пользователя {user_id}")
+        log.info("Удаляем сессию", extra={'session_id': session_id, 'user_id': user_id})
 
         # Удаляем сессию из базы данных
         user_db.delete_session(session_id)
+        contexts.drop(session_id)
+        # Выгружаем движок сессии вместе с историей в памяти
+        engines.discard(session_id)
 
         # Если удаляем текущую активную сессию, сбрасываем её
         if session.get('session_id') == session_id:
             session.pop('session_id', None)
-            # Очищаем историю чата в памяти
-            chat_inst = get_chat_instance()
-            chat_inst.clear_history()
-            print("🧹 Очищена история в памяти")
 
         return jsonify({'success': True, 'message': 'Сессия удалена'})
 
     except Exception as e:
-        print(f"❌ Ошибка удаления сессии {session_id}: {str(e)}")
-        import traceback
-        traceback.print_exc()
+        log.exception("Ошибка удаления сессии", extra={'session_id': session_id})
         return jsonify({'success': False, 'error': f'Ошибка удаления сессии: {str(e)}'}), 500
 
 
+def cache_metrics(name, stats):
+    """Семейства метрик одного LRUCache: попадания по типам записей, доля попаданий, объем"""
+    requests, ratios = [], []
+    for region, counts in sorted(stats['regions'].items()):
+        requests.append(({'cache': name, 'region': region, 'result': 'hit'}, counts['hits']))
+        requests.append(({'cache': name, 'region': region, 'result': 'miss'}, counts['misses']))
+        total = counts['hits'] + counts['misses']
+        ratios.append(({'cache': name, 'region': region}, round(counts['hits'] / total, 4) if total else 0))
+    ratios.append(({'cache': name, 'region': 'all'}, stats['hit_rate']))
+
+    return [
+        ('chat_cache_requests_total', 'counter', 'Обращения к кешу', requests),
+        ('chat_cache_hit_ratio', 'gauge', 'Доля попаданий в кеш', ratios),
+        ('chat_cache_entries', 'gauge', 'Записей в кеше', [({'cache': name}, stats['entries'])]),
+        ('chat_cache_bytes', 'gauge', 'Объем записей кеша', [({'cache': name}, stats['bytes'])]),
+        ('chat_cache_evictions_total', 'counter', 'Вытеснения из кеша', [({'cache': name}, stats['evictions'])])
+    ]
+
+
+def runtime_metrics():
+    """Состояние процесса на момент запроса /metrics (берется из stats() компонентов)"""
+    engine_stats = engines.stats()
+    operation_stats = operations.stats()
+    job_stats = job_workers.stats()
+
+    families = [
+        ('chat_model_loaded', 'gauge', 'Модель загружена в память', [({}, int(engines.model_loaded))]),
+        ('chat_engines', 'gauge', 'Живые движки разговоров',
+         [({'state': 'live'}, engine_stats['engines']), ({'state': 'busy'}, engine_stats['busy'])]),
+        ('chat_engine_history_bytes', 'gauge', 'Память историй живых движков', [({}, engine_stats['bytes'])]),
+        ('chat_engine_evictions_total', 'counter', 'Выгрузки движков', [({}, engine_stats['evictions'])]),
+        ('chat_engine_reloads_total', 'counter', 'Перезагрузки устаревших контекстов движков',
+         [({}, engine_stats['reloads'])]),
+        ('chat_operations_active', 'gauge', 'Незавершенные асинхронные операции процесса',
+         [({}, operation_stats['active'])]),
+        ('chat_jobs_running', 'gauge', 'Задачи, выполняемые воркерами процесса', [({}, job_stats['running'])]),
+        ('chat_job_queue_length', 'gauge', 'Ожидающие задачи в очереди БД', [({}, job_stats['queue_length'])]),
+        ('chat_jobs_rejected_total', 'counter', 'Задачи, отклоненные из-за лимита очереди',
+         [({}, job_stats['rejected'])]),
+        ('chat_markdown_renders_total', 'counter', 'Рендеры markdown в HTML', [({}, renderer.renders)]),
+        ('chat_log_dropped_total', 'counter', 'Записи журнала, отброшенные при переполнении очереди',
+         [({}, dropped_records())])
+    ]
+    families += cache_metrics('read', read_cache.stats())
+    families += cache_metrics('context', contexts.stats())
+
+    rss = process_rss()
+    if rss is not None:
+        families.append(('process_resident_memory_bytes', 'gauge', 'Резидентная память процесса', [({}, rss)]))
+    return families
+
+
+def process_rss():
+    """Резидентная память процесса из /proc (Linux) или None"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+
+
+metrics_registry.add_collector(runtime_metrics)
+
+
+@app.route('/admin/traces')
+def admin_traces():
+    """Последние трассы из буфера процесса: ?limit=20, ?trace_id=... (см. X-Trace-Id ответа)"""
+    if not admin_authorized():
+        return jsonify({'error': 'Нет доступа'}), 403
+
+    limit = request.args.get('limit', 20, type=int)
+    traces = tracer.recent(limit=limit, trace_id=request.args.get('trace_id'))
+    return jsonify({'success': True, 'sample_rate': tracer.sample_rate, 'traces': traces})
+
+
+@app.route('/admin/profile/start', methods=['POST'])
+def admin_profile_start():
+    """Выборочное профилирование всех потоков: ?seconds=10&interval=0.01"""
+    if not admin_authorized():
+        return jsonify({'error': 'Нет доступа'}), 403
+
+    seconds = request.args.get('seconds', 10, type=float)
+    interval = request.args.get('interval', 0.01, type=float)
+    if not sampling_profiler.start(seconds, interval):
+        return jsonify({'error': 'Профилирование уже идет', 'profile': sampling_profiler.status()}), 409
+
+    log.info("Профилирование всех потоков на %s с", seconds)
+    return jsonify({'success': True, 'profile': sampling_profiler.status()})
+
+
+@app.route('/admin/profile/stop', methods=['POST'])
+def admin_profile_stop():
+    """Досрочная остановка; в ответе - свернутые стеки сеанса"""
+    if not admin_authorized():
+        return jsonify({'error': 'Нет доступа'}), 403
+
+    sampling_profiler.stop()
+    return Response(sampling_profiler.collapsed(), mimetype='text/plain')
+
+
+@app.route('/admin/profile', methods=['GET'])
+def admin_profile():
+    """Свернутые стеки сеанса (flamegraph.pl, speedscope); ?status=1 - только параметры сеанса"""
+    if not admin_authorized():
+        return jsonify({'error': 'Нет доступа'}), 403
+
+    status = sampling_profiler.status()
+    if request.args.get('status') or not status.get('samples'):
+        return jsonify({'success': True, 'profile': status})
+    return Response(sampling_profiler.collapsed(), mimetype='text/plain')
+
+
+@app.route('/admin/profile/request', methods=['POST', 'GET'])
+def admin_profile_request():
+    """POST ?path=/send_message - пометить следующий запрос с этим префиксом пути.
+    GET ?format=collapsed|pstats - профиль помеченного запроса
+    """
+    if not admin_authorized():
+        return jsonify({'error': 'Нет доступа'}), 403
+
+    if request.method == 'POST':
+        path = request.args.get('path', '')
+        if not path.startswith('/') or path.startswith('/admin/'):
+            return jsonify({'error': 'Укажите путь запроса, например ?path=/send_message'}), 400
+        request_profiler.arm(path)
+        return jsonify({'success': True, 'profile': request_profiler.status()})
+
+    result = request_profiler.result
+    if result is None:
+        return jsonify({'success': True, 'profile': request_profiler.status()})
+    if request.args.get('format') == 'pstats':
+        return Response(result['pstats'], mimetype='text/plain')
+    return Response(result['collapsed'], mimetype='text/plain')
+
+
+@app.route('/metrics')
+def export_metrics():
+    """Метрики процесса в формате Prometheus. С METRICS_TOKEN - только с заголовком Authorization: Bearer.
+
+    Без токена endpoint есть только при METRICS_PUBLIC: по умолчанию метрики не видны снаружи.
+    """
+    token = app.config['METRICS_TOKEN']
+    if not token and not app.config['METRICS_PUBLIC']:
+        return Response('Not Found\n', status=404, mimetype='text/plain')
+    if token and request.headers.get('Authorization') != f'Bearer {token}':
+        return Response('Unauthorized\n', status=401, mimetype='text/plain')
+
+    return Response(metrics_registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
 if __name__ == '__main__':
     app.run(
         debug=app.config['DEBUG'],
@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Журнал сервера: уровни по модулям, сэмплирование частых событий, JSON.
+
+Потоки запросов только кладут запись в ограниченную очередь
+(QueueHandler); форматирование и вывод в stdout делает отдельный поток
+QueueListener. При переполнении очереди запись отбрасывается и
+учитывается в dropped - журнал не задерживает запросы.
+
+Частые события помечаются полем event (extra={'event': ...}); их доля
+задается LOG_SAMPLE_RATES и проверяется до постановки в очередь.
+Предупреждения и ошибки не сэмплируются.
+"""
+
+import atexit
+import copy
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import sys
+import traceback
+from datetime import datetime, timezone
+
+from tracing import TRACER
+
+# Поля LogRecord, которые не выводятся как дополнительные
+_RECORD_FIELDS = set(logging.LogRecord('', 0, '', 0, '', (), None).__dict__) | {'message', 'asctime', 'trace_id'}
+
+
+def parse_levels(text):
+    """'database=WARNING,deepseek_helpers=DEBUG' -> {'database': 'WARNING', ...}"""
+    levels = {}
+    for item in (text or '').split(','):
+        name, _, level = item.partition('=')
+        if name.strip() and level.strip():
+            levels[name.strip()] = level.strip().upper()
+    return levels
+
+
+def _extra_fields(record):
+    return {key: value for key, value in record.__dict__.items() if key not in _RECORD_FIELDS}
+
+
+class StructuredFormatter(logging.Formatter):
+    """JSON-строка на запись или текст с полями key=value"""
+
+    def __init__(self, json_output=True):
+        super().__init__('%(asctime)s %(levelname)s %(name)s: %(message)s')
+        self.json_output = json_output
+
+    def format(self, record):
+        if not self.json_output:
+            text = super().format(record)
+            fields = _extra_fields(record)
+            if getattr(record, 'trace_id', None):
+                fields['trace_id'] = record.trace_id
+            if fields:
+                # Поля - в первую строку, перед трассировкой исключения
+                head, newline, tail = text.partition('\n')
+                text = head + ' ' + ' '.join(f"{key}={value}" for key, value in fields.items()) + newline + tail
+            return text
+
+        entry = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'thread': record.threadName
+        }
+        if getattr(record, 'trace_id', None):
+            entry['trace_id'] = record.trace_id
+        entry.update(_extra_fields(record))
+        if record.exc_text:
+            entry['exc'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """Пропускает долю rates[event] записей с полем event; WARNING и выше - всегда"""
+
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = dict(rates)
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        rate = self.rates.get(getattr(record, 'event', None))
+        return rate is None or random.random() < rate
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler, который не ждет места в очереди.
+
+    В потоке запроса запись только подготавливается: сообщение
+    подставляется, исключение превращается в текст (кадры стека не
+    удерживаются очередью), добавляется trace_id текущей трассы.
+    """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        record.msg, record.args = record.message, None
+        if record.exc_info:
+            record.exc_text = ''.join(traceback.format_exception(*record.exc_info)).rstrip()
+            record.exc_info = None
+        record.trace_id = TRACER.current().trace_id
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+_listener = None
+_handler = None
+
+
+def setup_logging(level='INFO', module_levels=None, json_output=True, sample_rates=None, queue_size=10000,
+                  stream=None):
+    """Настраивает корневой журнал процесса. Повторный вызов заменяет прежнюю настройку"""
+    global _listener, _handler
+
+    root = logging.getLogger()
+    if _listener is not None:
+        _listener.stop()
+        root.removeHandler(_handler)
+
+    output = logging.StreamHandler(stream or sys.stdout)
+    output.setFormatter(StructuredFormatter(json_output))
+
+    _handler = NonBlockingQueueHandler(queue.Queue(maxsize=queue_size))
+    _handler.addFilter(SamplingFilter(sample_rates or {}))
+    _listener = logging.handlers.QueueListener(_handler.queue, output, respect_handler_level=True)
+    _listener.start()
+
+    root.addHandler(_handler)
+    root.setLevel(level)
+    for name, module_level in (module_levels or {}).items():
+        logging.getLogger(name).setLevel(module_level)
+    return _handler
+
+
+def dropped_records():
+    """Сколько записей отброшено из-за переполнения очереди"""
+    return _handler.dropped if _handler is not None else 0
+
+
+@atexit.register
+def _flush():
+    # Записи, оставшиеся в очереди, выводятся при остановке процесса
+    if _listener is not None:
+        _listener.stop()
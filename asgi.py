@@ -0,0 +1,315 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""ASGI-режим сервера: uvicorn asgi:application (или python asgi.py).
+
+Маршруты с долгим ожиданием обслуживаются корутинами:
+    POST /send_message (JSON)           - ответ модели через ollama.AsyncClient
+    GET  /operation_status/<id>?wait=N  - long-poll
+    GET  /operation_events/<id>         - Server-Sent Events
+Ожидающее соединение стоит корутину, а не поток. Остальные маршруты,
+шаблоны и multipart-загрузки по-прежнему обслуживает Flask-приложение
+через a2wsgi - короткие запросы в пуле из ASGI_WSGI_THREADS потоков.
+
+WebSocket-канал (/ws) работает только в WSGI-режиме (flask-sock), в
+ASGI-режиме клиент использует SSE.
+"""
+
+import asyncio
+import json
+import logging
+import re
+import time
+from urllib.parse import parse_qs
+
+from a2wsgi import WSGIMiddleware
+from flask import session
+
+import app as chat_app
+from operations import FINISHED_STATUSES
+from uploads import UploadError, normalize_files
+
+flask_app = chat_app.app
+registry = chat_app.operations
+log = logging.getLogger(__name__)
+
+OPERATION_STATUS_PATH = re.compile(r'^/operation_status/([^/]+)$')
+OPERATION_EVENTS_PATH = re.compile(r'^/operation_events/([^/]+)$')
+
+
+class ChangeSignal:
+    """Смена статуса одной операции для корутины.
+
+    OperationRegistry уведомляет из потоков воркеров только слушателей
+    изменившейся операции; вместо потока на ожидающего корутина ждет
+    asyncio.Event. Фрагменты ответа слушателей не будят.
+    """
+
+    def __init__(self, operation_id):
+        self.loop = asyncio.get_running_loop()
+        self.operation_id = operation_id
+        self.event = asyncio.Event()
+        registry.add_listener(operation_id, self._on_change)
+
+    def _on_change(self):
+        self.loop.call_soon_threadsafe(self.event.set)
+
+    def close(self):
+        registry.remove_listener(self.operation_id, self._on_change)
+
+
+async def wait_operation(operation_id, status, progress, timeout, user_id):
+    """Асинхронный аналог OperationRegistry.wait"""
+    signal = ChangeSignal(operation_id)
+    deadline = time.monotonic() + timeout
+
+    try:
+        while True:
+            # Событие сбрасывается до чтения статуса: изменение между ними не потеряется
+            signal.event.clear()
+            response = await asyncio.to_thread(registry.status, operation_id, user_id)
+            if response is None or (response['status'], response['progress']) != (status, progress):
+                return response
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return response
+
+            # Изменения из других процессов видны только в БД - перечитываем не реже poll_interval
+            try:
+                await asyncio.wait_for(signal.event.wait(), min(remaining, registry.poll_interval))
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        signal.close()
+
+
+def _headers(scope):
+    return [(name.decode('latin-1'), value.decode('latin-1')) for name, value in scope['headers']]
+
+
+def _load_session(scope):
+    """Данные Flask-сессии запроса (cookie и хранилище flask-session)"""
+    with flask_app.test_request_context(scope['path'], headers=_headers(scope)):
+        return dict(session)
+
+
+def _update_session(scope, **values):
+    """Записывает значения в Flask-сессию запроса (cookie при этом не меняется)"""
+    with flask_app.test_request_context(scope['path'], headers=_headers(scope)):
+        session.update(values)
+        flask_app.session_interface.save_session(flask_app, session, flask_app.response_class())
+
+
+async def _read_body(receive):
+    body = b''
+    while True:
+        message = await receive()
+        body += message.get('body', b'')
+        if not message.get('more_body'):
+            return body
+
+
+async def _send_json(send, status, data):
+    body = json.dumps(data, ensure_ascii=False).encode('utf-8')
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': [(b'content-type', b'application/json; charset=utf-8'),
+                            (b'content-length', str(len(body)).encode())]})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+def _query(scope):
+    return {key: values[-1] for key, values in parse_qs(scope['query_string'].decode('latin-1')).items()}
+
+
+def _wait_seconds(query):
+    """Параметр wait long-poll запроса, ограниченный OPERATION_LONG_POLL_TIMEOUT"""
+    try:
+        wait = float(query.get('wait', 0))
+    except ValueError:
+        return 0
+    return min(wait, flask_app.config['OPERATION_LONG_POLL_TIMEOUT'])
+
+
+async def send_message(scope, receive, send):
+    """Синхронная отправка сообщения: запрос ждет ответ модели, не занимая поток"""
+    user = await asyncio.to_thread(_load_session, scope)
+    if not user.get('logged_in'):
+        await _send_json(send, 401, {'error': 'Не авторизован'})
+        return
+
+    try:
+        data = json.loads(await _read_body(receive) or b'{}')
+    except ValueError:
+        await _send_json(send, 400, {'error': 'Некорректный JSON'})
+        return
+
+    message = data.get('message', '').strip()
+    session_id = data.get('session_id', '')
+    user_id = user.get('user_id')
+    try:
+        files_content = normalize_files(data.get('files'))
+    except UploadError as e:
+        await _send_json(send, e.status, {'error': str(e)})
+        return
+
+    if not message:
+        await _send_json(send, 400, {'error': 'Пустое сообщение'})
+        return
+
+    if not session_id:
+        session_id = user.get('session_id') or await asyncio.to_thread(chat_app.user_db.create_session, user_id)
+    elif session_id != user.get('session_id'):
+        # Чужая сессия не попадает ни в сессию Flask, ни в пул движков
+        if not await asyncio.to_thread(chat_app.owns_session, user_id, session_id):
+            await _send_json(send, 404, {'error': 'Сессия не найдена или не принадлежит вам'})
+            return
+    if session_id != user.get('session_id'):
+        await asyncio.to_thread(_update_session, scope, session_id=session_id)
+
+    # asyncio.to_thread переносит текущий спан в поток вместе с контекстом
+    with chat_app.tracer.trace('POST /send_message', user_id=user_id):
+        # Движок сессии не выгружается, пока идет генерация
+        timer = chat_app.StageTimer()
+        with timer.stage('engine'):
+            chat_inst = await asyncio.to_thread(chat_app.engines.acquire, session_id)
+        try:
+            if not chat_inst.model_loaded:
+                await _send_json(send, 400, {'error': 'Модель не загружена. Используйте кнопку "Загрузить модель"'})
+                return
+
+            pipeline = chat_app.pipeline
+            prompt = await asyncio.to_thread(pipeline.prepare, session_id, user_id, message, files_content, timer)
+
+            start_time = time.time()
+            log.info("Отправляю сообщение в модель (async)",
+                     extra={'event': 'turn.sent', 'session_id': session_id, 'prompt_chars': len(prompt)})
+            with timer.stage('model'):
+                response = await chat_inst.send_message_async(prompt)
+
+            response_data = await asyncio.to_thread(pipeline.finish, session_id, user_id, message, response,
+                                                    time.time() - start_time, chat_inst, timer)
+            await _send_json(send, 200, response_data)
+
+        except Exception as e:
+            log.exception("Ошибка в send_message (async)")
+            await _send_json(send, 500, {'error': f'Ошибка при отправке сообщения: {str(e)}'})
+        finally:
+            await asyncio.to_thread(chat_app.engines.release, session_id)
+
+
+async def operation_status(scope, receive, send, operation_id):
+    """Long-poll статуса операции (см. /operation_status в app.py)"""
+    user = await asyncio.to_thread(_load_session, scope)
+    if not user.get('logged_in'):
+        await _send_json(send, 401, {'error': 'Не авторизован'})
+        return
+
+    query = _query(scope)
+    response = await wait_operation(operation_id, query.get('status'), query.get('progress'),
+                                    _wait_seconds(query), user.get('user_id'))
+    if not response:
+        await _send_json(send, 404, {'error': 'Операция не найдена'})
+        return
+
+    await _send_json(send, 200, response)
+
+
+async def operation_events(scope, receive, send, operation_id):
+    """Поток событий операции (см. /operation_events в app.py)"""
+    user = await asyncio.to_thread(_load_session, scope)
+    if not user.get('logged_in'):
+        await _send_json(send, 401, {'error': 'Не авторизован'})
+        return
+
+    user_id = user.get('user_id')
+    if await asyncio.to_thread(registry.status, operation_id, user_id) is None:
+        await _send_json(send, 404, {'error': 'Операция не найдена'})
+        return
+
+    await send({'type': 'http.response.start', 'status': 200,
+                'headers': [(b'content-type', b'text/event-stream; charset=utf-8'),
+                            (b'cache-control', b'no-cache'),
+                            (b'x-accel-buffering', b'no')]})
+
+    async def emit(chunk, more=True):
+        await send({'type': 'http.response.body', 'body': chunk.encode('utf-8'), 'more_body': more})
+
+    status = progress = None
+    while True:
+        response = await wait_operation(operation_id, status, progress,
+                                        flask_app.config['SSE_KEEPALIVE_INTERVAL'], user_id)
+        if response is None:
+            error = json.dumps({'error': 'Операция не найдена'}, ensure_ascii=False)
+            await emit(f"event: error\ndata: {error}\n\n", more=False)
+            return
+
+        if (response['status'], response['progress']) == (status, progress):
+            # Комментарий не дает прокси закрыть простаивающее соединение
+            await emit(": keepalive\n\n")
+            continue
+
+        status, progress = response['status'], response['progress']
+        finished = status in FINISHED_STATUSES
+        await emit(f"data: {json.dumps(response, ensure_ascii=False)}\n\n", more=not finished)
+        if finished:
+            return
+
+
+class ChatApplication:
+    """ASGI-приложение: асинхронные маршруты ожидания и Flask для остального"""
+
+    def __init__(self):
+        self.wsgi = WSGIMiddleware(flask_app, workers=flask_app.config['ASGI_WSGI_THREADS'])
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+            return
+
+        if scope['type'] == 'websocket':
+            # flask-sock требует WSGI-сервер: клиент переключится на SSE
+            await send({'type': 'websocket.close', 'code': 1000})
+            return
+
+        path = scope['path']
+        method = scope['method']
+        headers = dict(scope['headers'])
+
+        if method == 'POST' and path == '/send_message' and \
+                b'multipart/form-data' not in headers.get(b'content-type', b''):
+            await send_message(scope, receive, send)
+            return
+
+        if method == 'GET':
+            match = OPERATION_EVENTS_PATH.match(path)
+            if match:
+                await operation_events(scope, receive, send, match.group(1))
+                return
+
+            match = OPERATION_STATUS_PATH.match(path)
+            if match and _wait_seconds(_query(scope)) > 0:
+                await operation_status(scope, receive, send, match.group(1))
+                return
+
+        await self.wsgi(scope, receive, send)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+
+application = ChatApplication()
+
+
+if __name__ == '__main__':
+    import uvicorn
+
+    uvicorn.run(application,
+                host=flask_app.config['SERVER_HOST'],
+                port=flask_app.config['SERVER_PORT'],
+                timeout_keep_alive=flask_app.config['SSE_KEEPALIVE_INTERVAL'])
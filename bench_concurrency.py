@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Бенчмарк конкурентных долгих генераций: WSGI (потоки) против ASGI (корутины).
+
+Для каждого режима запускает сервер в отдельном процессе с чистой БД
+во временном каталоге и поддельным Ollama, который держит каждый ответ
+--delay секунд. Затем --clients клиентов одновременно вызывают
+POST /send_message. Выводит время до последнего ответа, p50/p95
+задержки, ошибки, пиковое число потоков и RSS серверного процесса.
+
+    python bench_concurrency.py --clients 200 --delay 5
+    python bench_concurrency.py --clients 1000 --delay 10 --modes asgi
+
+ASGI-режим требует a2wsgi и uvicorn.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import httpx
+from werkzeug.security import generate_password_hash
+
+from schema import migrate
+
+PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+USERNAME = 'bench'
+PASSWORD = 'bench'
+
+SERVER_COMMANDS = {
+    'wsgi': lambda port: [sys.executable, '-c',
+                          'import app; from werkzeug.serving import run_simple; '
+                          f'run_simple("127.0.0.1", {port}, app.app, threaded=True)'],
+    'asgi': lambda port: [sys.executable, '-m', 'uvicorn', 'asgi:application', '--host', '127.0.0.1',
+                          '--port', str(port), '--log-level', 'warning', '--backlog', '4096'],
+}
+
+
+def percentile(sorted_values, fraction):
+    """Перцентиль по отсортированному списку"""
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+class FakeOllama:
+    """Минимальный /api/chat: предзагрузка отвечает сразу, обычные запросы - через delay секунд"""
+
+    def __init__(self, port, delay):
+        self.port = port
+        self.delay = delay
+        self.requests = []  # история сообщений каждого запроса, кроме предзагрузки
+        self.loop = asyncio.new_event_loop()
+
+    def start(self):
+        ready = threading.Event()
+
+        def run():
+            asyncio.set_event_loop(self.loop)
+            server = self.loop.run_until_complete(
+                asyncio.start_server(self._handle, '127.0.0.1', self.port, backlog=4096))
+            ready.set()
+            self.loop.run_until_complete(server.serve_forever())
+
+        thread = threading.Thread(target=run, name='fake-ollama')
+        thread.daemon = True
+        thread.start()
+        ready.wait()
+
+    async def _handle(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    return
+
+                length = 0
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    if name.strip().lower() == 'content-length':
+                        length = int(value.strip())
+                request = json.loads(await reader.readexactly(length) or b'{}')
+
+                content = request.get('messages', [{}])[-1].get('content', '')
+                if not content.startswith('Привет!'):
+                    self.requests.append(request.get('messages', []))
+                    await asyncio.sleep(self.delay)
+
+                message = {'role': 'assistant', 'content': '<think>bench</think>Готово'}
+                # Статистика генерации в формате Ollama (длительности в наносекундах)
+                stats = {'prompt_eval_count': sum(len(m.get('content', '')) // 4 for m in request.get('messages', [])),
+                         'prompt_eval_duration': 1_000_000, 'eval_count': 8,
+                         'eval_duration': max(int(self.delay * 1e9), 1_000_000),
+                         'total_duration': int(self.delay * 1e9) + 1_000_000}
+                if request.get('stream'):
+                    body = (json.dumps({'model': request.get('model'), 'message': message, 'done': False}) + '\n' +
+                            json.dumps({'model': request.get('model'), 'message': {'role': 'assistant', 'content': ''},
+                                        'done': True, **stats}) + '\n').encode()
+                    content_type = b'application/x-ndjson'
+                else:
+                    body = json.dumps({'model': request.get('model'), 'message': message, 'done': True,
+                                       **stats}).encode()
+                    content_type = b'application/json'
+
+                writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: ' + content_type +
+                             b'\r\nContent-Length: ' + str(len(body)).encode() + b'\r\n\r\n' + body)
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+
+def prepare_work_dir():
+    """Пустая БД с пользователем для бенчмарка"""
+    work_dir = tempfile.mkdtemp(prefix='bench_concurrency_')
+    db_path = os.path.join(work_dir, 'chat_history.db')
+    migrate(db_path)
+
+    conn = sqlite3.connect(db_path)
+    conn.execute('INSERT INTO users (username, password_hash) VALUES (?, ?)',
+                 (USERNAME, generate_password_hash(PASSWORD)))
+    conn.commit()
+    conn.close()
+    return work_dir
+
+
+def process_usage(pid):
+    """(потоки, RSS в МБ) процесса из /proc или (None, None) вне Linux"""
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            fields = dict(line.split(':', 1) for line in f if ':' in line)
+        return int(fields['Threads']), int(fields['VmRSS'].split()[0]) / 1024
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+
+async def wait_ready(base_url, timeout=60):
+    deadline = time.time() + timeout
+    async with httpx.AsyncClient() as client:
+        while time.time() < deadline:
+            try:
+                if (await client.get(f'{base_url}/login')).status_code == 200:
+                    return
+            except httpx.HTTPError:
+                pass
+            await asyncio.sleep(0.2)
+    raise RuntimeError('Сервер не запустился')
+
+
+async def run_clients(base_url, clients):
+    limits = httpx.Limits(max_connections=clients + 10, max_keepalive_connections=clients + 10)
+    async with httpx.AsyncClient(base_url=base_url, timeout=None, limits=limits) as client:
+        await client.post('/login', data={'username': USERNAME, 'password': PASSWORD})
+        response = await client.post('/preload_model')
+        if response.status_code != 200:
+            raise RuntimeError(f'Предзагрузка модели: {response.text}')
+
+        # Отдельная сессия чата на клиента: генерации не делят контекст
+        session_ids = []
+        for _ in range(clients):
+            session_ids.append((await client.post('/new_chat')).json()['session_id'])
+
+        async def one(session_id):
+            start = time.perf_counter()
+            try:
+                response = await client.post('/send_message', json={'message': 'Ответь', 'session_id': session_id})
+                ok = response.status_code == 200 and response.json().get('success')
+            except httpx.HTTPError:
+                ok = False
+            return time.perf_counter() - start, ok
+
+        start = time.perf_counter()
+        results = await asyncio.gather(*(one(session_id) for session_id in session_ids))
+        return time.perf_counter() - start, results
+
+
+def run_mode(mode, args, port):
+    work_dir = prepare_work_dir()
+    env = dict(os.environ, PYTHONPATH=PROJECT_DIR, OLLAMA_HOST=f'http://127.0.0.1:{args.ollama_port}')
+    server = subprocess.Popen(SERVER_COMMANDS[mode](port), cwd=work_dir, env=env,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    peak = {'threads': 0, 'rss': 0.0}
+    sampling = threading.Event()
+
+    def sample():
+        while not sampling.is_set():
+            threads, rss = process_usage(server.pid)
+            if threads is not None:
+                peak['threads'] = max(peak['threads'], threads)
+                peak['rss'] = max(peak['rss'], rss)
+            time.sleep(0.1)
+
+    base_url = f'http://127.0.0.1:{port}'
+    try:
+        asyncio.run(wait_ready(base_url))
+        idle_threads, idle_rss = process_usage(server.pid)
+
+        sampler = threading.Thread(target=sample)
+        sampler.start()
+        elapsed, results = asyncio.run(run_clients(base_url, args.clients))
+        sampling.set()
+        sampler.join()
+    finally:
+        server.terminate()
+        server.wait()
+
+    latencies = sorted(latency for latency, ok in results if ok)
+    return {
+        'mode': mode,
+        'elapsed': elapsed,
+        'ok': len(latencies),
+        'errors': len(results) - len(latencies),
+        'p50': percentile(latencies, 0.5),
+        'p95': percentile(latencies, 0.95),
+        'idle_threads': idle_threads,
+        'peak_threads': peak['threads'],
+        'idle_rss': idle_rss,
+        'peak_rss': peak['rss']
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Конкурентные генерации: WSGI против ASGI')
+    parser.add_argument('--clients', type=int, default=200, help='одновременных запросов /send_message')
+    parser.add_argument('--delay', type=float, default=5.0, help='секунд, которые модель держит каждый ответ')
+    parser.add_argument('--modes', default='wsgi,asgi', help='режимы через запятую: wsgi, asgi')
+    parser.add_argument('--port', type=int, default=5099, help='порт сервера')
+    parser.add_argument('--ollama-port', type=int, default=11499, help='порт поддельного Ollama')
+    args = parser.parse_args()
+
+    FakeOllama(args.ollama_port, args.delay).start()
+
+    rows = []
+    for index, mode in enumerate(args.modes.split(',')):
+        mode = mode.strip()
+        print(f"🚀 {mode}: {args.clients} клиентов, ответ модели {args.delay:.1f} с")
+        rows.append(run_mode(mode, args, args.port + index))
+
+    print()
+    print(f"{'режим':<6} {'время, с':>9} {'ok':>6} {'ошибки':>7} {'p50, с':>7} {'p95, с':>7} "
+          f"{'потоки':>13} {'RSS, МБ':>15}")
+    for row in rows:
+        threads = f"{row['idle_threads']}->{row['peak_threads']}"
+        rss = f"{row['idle_rss'] or 0:.0f}->{row['peak_rss']:.0f}"
+        print(f"{row['mode']:<6} {row['elapsed']:>9.2f} {row['ok']:>6} {row['errors']:>7} "
+              f"{row['p50']:>7.2f} {row['p95']:>7.2f} {threads:>13} {rss:>15}")
+
+
+if __name__ == '__main__':
+    main()
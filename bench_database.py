@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Бенчмарк операций database.py под конкурентной нагрузкой.
+
+Работает с БД, созданной workload.py, и выполняет смесь операций
+save_message, get_messages, get_user_sessions, get_session_stats
+и delete_session из нескольких потоков. Для каждой операции выводит
+p50/p95/p99 задержки и количество операций в секунду.
+
+    python workload.py --db bench.db --messages 1000000
+    python bench_database.py --db bench.db --threads 8 --duration 30
+    python bench_database.py --db bench.db --threads 8 --shards 4
+    python bench_database.py --db bench.db --threads 8 --cache
+"""
+
+import argparse
+import os
+import random
+import sqlite3
+import threading
+import time
+
+from cache import LRUCache
+from database import ChatDatabase, UserDatabase
+from rebalance_shards import rebalance
+from sharding import ShardRouter
+from workload import WorkloadGenerator
+
+DEFAULT_MIX = 'save=30,get=40,sessions=15,stats=10,delete=5'
+
+
+def percentile(sorted_values, fraction):
+    """Перцентиль по отсортированному списку"""
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def load_session_pool(db_path, limit):
+    """Выборка (user_id, session_id) для запросов бенчмарка"""
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+    cursor.execute('SELECT COUNT(*) FROM chat_sessions')
+    total = cursor.fetchone()[0]
+    step = max(1, total // limit)
+    cursor.execute('SELECT user_id, session_id FROM chat_sessions WHERE id % ? = 0 LIMIT ?', (step, limit))
+    pool = cursor.fetchall()
+    conn.close()
+    return pool
+
+
+class DatabaseBenchmark:
+    def __init__(self, db_path, mix, seed=1, router=None, cache=None):
+        self.cache = cache
+        self.db = ChatDatabase(db_path, router=router, cache=cache)
+        self.user_db = UserDatabase(db_path, router=router, cache=cache)
+        self.generator = WorkloadGenerator(seed=seed)
+        self.sessions = load_session_pool(db_path, 100000)
+        self.sessions_lock = threading.Lock()
+        self.operations = {
+            'save': self.op_save,
+            'get': self.op_get,
+            'sessions': self.op_sessions,
+            'stats': self.op_stats,
+            'delete': self.op_delete,
+        }
+        self.mix = mix
+        self.latencies = {name: [] for name in self.operations}
+        self.latencies_lock = threading.Lock()
+
+    def _pick_session(self, rnd):
+        with self.sessions_lock:
+            return rnd.choice(self.sessions)
+
+    def op_save(self, rnd):
+        user_id, session_id = self._pick_session(rnd)
+        role = rnd.choice(['user', 'assistant'])
+        content, thinking, response_time, files = self.generator.message(role)
+        self.db.save_message(session_id, role, content, thinking, response_time, files=files, user_id=user_id)
+
+    def op_get(self, rnd):
+        self.db.get_messages(self._pick_session(rnd)[1])
+
+    def op_sessions(self, rnd):
+        self.user_db.get_user_sessions(self._pick_session(rnd)[0])
+
+    def op_stats(self, rnd):
+        self.db.get_session_stats(self._pick_session(rnd)[1])
+
+    def op_delete(self, rnd):
+        with self.sessions_lock:
+            if len(self.sessions) <= 1:
+                return
+            user_id, session_id = self.sessions.pop(rnd.randrange(len(self.sessions)))
+        self.user_db.delete_session(session_id)
+
+    def worker(self, deadline, seed):
+        rnd = random.Random(seed)
+        names = list(self.mix)
+        weights = [self.mix[name] for name in names]
+        local = {name: [] for name in self.operations}
+
+        while time.perf_counter() < deadline:
+            name = rnd.choices(names, weights=weights)[0]
+            start = time.perf_counter()
+            self.operations[name](rnd)
+            local[name].append(time.perf_counter() - start)
+
+        with self.latencies_lock:
+            for name, values in local.items():
+                self.latencies[name].extend(values)
+
+    def run(self, threads, duration):
+        deadline = time.perf_counter() + duration
+        workers = [threading.Thread(target=self.worker, args=(deadline, i)) for i in range(threads)]
+        start = time.perf_counter()
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+        return time.perf_counter() - start
+
+    def report(self, elapsed):
+        print(f"\n{'операция':<10} {'кол-во':>8} {'ops/s':>10} {'p50 мс':>9} {'p95 мс':>9} {'p99 мс':>9}")
+        total = 0
+        for name, values in self.latencies.items():
+            if not values:
+                continue
+            values.sort()
+            total += len(values)
+            print(f"{name:<10} {len(values):>8} {len(values) / elapsed:>10.1f} "
+                  f"{percentile(values, 0.50) * 1000:>9.2f} {percentile(values, 0.95) * 1000:>9.2f} "
+                  f"{percentile(values, 0.99) * 1000:>9.2f}")
+        print(f"{'всего':<10} {total:>8} {total / elapsed:>10.1f}")
+        if self.cache is not None:
+            stats = self.cache.stats()
+            print(f"📊 Кеш: попаданий {stats['hit_rate']:.1%}, записей {stats['entries']}, "
+                  f"{stats['bytes'] / 1024 / 1024:.1f} МБ, вытеснений {stats['evictions']}")
+
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(','):
+        name, _, weight = part.partition('=')
+        mix[name.strip()] = float(weight)
+    return mix
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Бенчмарк операций ChatDatabase/UserDatabase')
+    parser.add_argument('--db', default='bench_history.db')
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--duration', type=float, default=10.0, help='секунд')
+    parser.add_argument('--mix', default=DEFAULT_MIX, help=f'веса операций, по умолчанию {DEFAULT_MIX}')
+    parser.add_argument('--shards', type=int, default=0, help='количество шардов (0 - без шардирования)')
+    parser.add_argument('--cache', action='store_true', help='включить кеш чтения LRUCache')
+    parser.add_argument('--users', type=int, default=1000, help='если БД нет - сколько пользователей создать')
+    parser.add_argument('--messages', type=int, default=100000, help='если БД нет - сколько сообщений создать')
+    args = parser.parse_args()
+
+    if not os.path.exists(args.db):
+        print(f"🔄 БД {args.db} не найдена, генерирую {args.messages:,} сообщений...")
+        WorkloadGenerator().populate(args.db, args.users, args.messages)
+
+    router = None
+    if args.shards > 0:
+        shard_dir = os.path.splitext(args.db)[0] + '_shards'
+        print(f"🔄 Раскладываю сообщения по {args.shards} шардам в {shard_dir}...")
+        rebalance(args.db, shard_dir, args.shards)
+        router = ShardRouter(args.db, args.shards, shard_dir)
+
+    cache = LRUCache() if args.cache else None
+    benchmark = DatabaseBenchmark(args.db, parse_mix(args.mix), router=router, cache=cache)
+    print(f"🚀 {args.threads} потоков, {args.duration:.0f} с, шардов: {args.shards}, "
+          f"кеш: {'да' if cache else 'нет'}, смесь: {args.mix}")
+    elapsed = benchmark.run(args.threads, args.duration)
+    benchmark.report(elapsed)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Бенчмарк времени запуска воркера (импорт app.py).
+
+Каждый замер - отдельный процесс, как при перезапуске воркера.
+Первый запуск создает схему в пустом каталоге, остальные
+работают с актуальной БД и должны укладываться в миллисекунды.
+
+    python bench_startup.py --runs 10
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from schema import migrate
+
+PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Модули, которые не должны загружаться при старте
+HEAVY_MODULES = ['markdown', 'pygments', 'ollama', 'bcrypt']
+
+CHILD_CODE = f'''
+import sys, time
+sys.path.insert(0, {PROJECT_DIR!r})
+start = time.perf_counter()
+import app
+elapsed = time.perf_counter() - start
+loaded = [m for m in {HEAVY_MODULES!r} if m in sys.modules]
+print(f"{{elapsed * 1000:.2f}} {{','.join(loaded)}}")
+'''
+
+
+def run_import(work_dir):
+    """Импортирует app в отдельном процессе, возвращает (мс, загруженные тяжелые модули)"""
+    output = subprocess.run([sys.executable, '-c', CHILD_CODE], cwd=work_dir,
+                            capture_output=True, text=True, check=True).stdout
+    elapsed, _, loaded = output.strip().splitlines()[-1].partition(' ')
+    return float(elapsed), [m for m in loaded.split(',') if m]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Время запуска воркера')
+    parser.add_argument('--runs', type=int, default=10, help='количество теплых запусков')
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp()
+
+    cold_ms, _ = run_import(work_dir)
+    print(f"🧊 Холодный запуск (создание схемы): {cold_ms:.1f} мс")
+
+    timings = []
+    heavy = set()
+    for _ in range(args.runs):
+        elapsed, loaded = run_import(work_dir)
+        timings.append(elapsed)
+        heavy.update(loaded)
+
+    print(f"🔥 Теплый запуск: медиана {statistics.median(timings):.1f} мс, "
+          f"мин {min(timings):.1f} мс, макс {max(timings):.1f} мс ({args.runs} запусков)")
+
+    # Проверка схемы на актуальной БД без импорта приложения
+    db_path = os.path.join(work_dir, 'chat_history.db')
+    start_time = time.perf_counter()
+    migrate(db_path)
+    print(f"📋 Проверка версии схемы: {(time.perf_counter() - start_time) * 1000:.2f} мс")
+
+    if heavy:
+        print(f"⚠️ При старте загружены тяжелые модули: {', '.join(sorted(heavy))}")
+    else:
+        print("✅ markdown, ollama и bcrypt не загружаются при старте")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import logging
+import sys
+import time
+from collections import OrderedDict
+from threading import Lock
+
+log = logging.getLogger(__name__)
+
+
+def estimate_size(value):
+    """Приблизительный размер значения в байтах (строки, списки, словари)"""
+    if isinstance(value, str):
+        return sys.getsizeof(value)
+    if isinstance(value, (list, tuple)):
+        return sys.getsizeof(value) + sum(estimate_size(item) for item in value)
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(estimate_size(k) + estimate_size(v) for k, v in value.items())
+    return sys.getsizeof(value)
+
+
+class LRUCache:
+    """Потокобезопасный LRU-кеш с ограничением по количеству записей, памяти и TTL.
+
+    TTL ограничивает устаревание, если БД меняет другой процесс.
+    Запись, прочитанная до инвалидации, не попадет в кеш после неё:
+    put() принимает поколение, полученное через generation(key) до чтения из БД.
+    Поколения ведутся по фиксированному числу полос (хеш ключа), поэтому
+    запись в одну сессию не отбрасывает чтения других.
+
+    Если задан publisher, инвалидации передаются ему словарем (см. apply),
+    чтобы другие процессы сбросили те же записи у себя.
+    """
+
+    STRIPES = 1024
+
+    def __init__(self, max_entries=10000, max_bytes=64 * 1024 * 1024, ttl=60, publisher=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.lock = Lock()
+        self._entries = OrderedDict()  # key -> (value, size, expires_at)
+        self._bytes = 0
+        self._epoch = 0  # меняется при invalidate_prefix/clear
+        self._stripes = [0] * self.STRIPES
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # Попадания по типам записей: первый элемент ключа ('messages', 'sessions', ...)
+        self.region_stats = {}
+        self.publisher = publisher
+
+    def _stripe(self, key):
+        return hash(key) % self.STRIPES
+
+    def generation(self, key):
+        """Поколение ключа - взять до чтения из БД и передать в put()"""
+        with self.lock:
+            return self._epoch, self._stripes[self._stripe(key)]
+
+    def get(self, key):
+        with self.lock:
+            region = self.region_stats.setdefault(key[0], {'hits': 0, 'misses': 0})
+            entry = self._entries.get(key)
+            if entry is None or entry[2] < time.monotonic():
+                if entry is not None:
+                    self._remove(key)
+                self.misses += 1
+                region['misses'] += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            region['hits'] += 1
+            return entry[0]
+
+    def peek(self, key):
+        """Значение без учета в статистике и без продления LRU"""
+        with self.lock:
+            entry = self._entries.get(key)
+            return entry[0] if entry is not None else None
+
+    def put(self, key, value, generation=None):
+        size = estimate_size(value)
+        if size > self.max_bytes:
+            return
+
+        with self.lock:
+            if generation is not None and generation != (self._epoch, self._stripes[self._stripe(key)]):
+                # Между чтением из БД и записью в кеш была инвалидация
+                return
+
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, size, time.monotonic() + self.ttl)
+            self._bytes += size
+
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def _remove(self, key):
+        value, size, _ = self._entries.pop(key)
+        self._bytes -= size
+
+    def invalidate(self, *keys):
+        self._invalidate(keys)
+        self._publish({'op': 'invalidate', 'keys': [list(key) for key in keys]})
+
+    def invalidate_prefix(self, prefix):
+        """Удаляет все записи, ключ которых начинается с prefix (кортеж)"""
+        self._invalidate_prefix(prefix)
+        self._publish({'op': 'invalidate_prefix', 'prefix': list(prefix)})
+
+    def clear(self):
+        self._clear()
+        self._publish({'op': 'clear'})
+
+    def apply(self, event):
+        """Применяет инвалидацию из другого процесса (без повторной публикации)"""
+        if event['op'] == 'invalidate':
+            self._invalidate([tuple(key) for key in event['keys']])
+        elif event['op'] == 'invalidate_prefix':
+            self._invalidate_prefix(tuple(event['prefix']))
+        elif event['op'] == 'clear':
+            self._clear()
+
+    def _publish(self, event):
+        if self.publisher is None:
+            return
+        try:
+            self.publisher(event)
+        except Exception:
+            # Другие процессы сбросят запись не позже чем через TTL
+            log.exception("Ошибка публикации инвалидации кеша")
+
+    def _invalidate(self, keys):
+        with self.lock:
+            for key in keys:
+                self._stripes[self._stripe(key)] += 1
+                if key in self._entries:
+                    self._remove(key)
+
+    def _invalidate_prefix(self, prefix):
+        with self.lock:
+            self._epoch += 1
+            for key in [k for k in self._entries if k[:len(prefix)] == prefix]:
+                self._remove(key)
+
+    def _clear(self):
+        with self.lock:
+            self._epoch += 1
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self.lock:
+            requests = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': round(self.hits / requests, 3) if requests else 0.0,
+                'regions': {name: dict(region) for name, region in self.region_stats.items()}
+            }
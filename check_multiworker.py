@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Проверка работы нескольких процессов-воркеров с общей БД (STATE_STORE=sqlite).
+
+Запускает два сервера на разных портах в одном рабочем каталоге
+(общие БД и flask_session) и поддельный Ollama, затем проверяет,
+что состояние одного воркера видно другому:
+    - модель, загруженная через A, считается загруженной на B;
+    - ход на A попадает в контекст следующего хода на B и обратно;
+    - асинхронную операцию, поставленную через A, можно опрашивать через B;
+    - история, закешированная на A, обновляется после сообщения на B;
+    - после очистки истории на A воркер B не отправляет модели старый контекст;
+    - другой пользователь не может отправить сообщение в чужую сессию
+      и прочитать чужое вложение по его хешу.
+
+    python check_multiworker.py
+    python check_multiworker.py --port 5120 --ollama-port 11520
+    python check_multiworker.py --state-store memory   # без общего состояния проверки падают
+"""
+
+import argparse
+import hashlib
+import os
+import sqlite3
+import subprocess
+import sys
+import time
+
+import httpx
+from werkzeug.security import generate_password_hash
+
+from bench_concurrency import FakeOllama, PROJECT_DIR, PASSWORD, USERNAME, prepare_work_dir
+
+OTHER_USERNAME = 'intruder'
+OTHER_PASSWORD = 'intruder'
+
+SERVER_COMMAND = ('import app; from werkzeug.serving import run_simple; '
+                  'run_simple("127.0.0.1", {port}, app.app, threaded=True)')
+
+
+def wait_ready(client, timeout=60):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            if client.get('/login').status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f'Сервер {client.base_url} не запустился')
+
+
+def wait_for(predicate, timeout):
+    """Ждет, пока predicate() не вернет истину. Возвращает последний результат"""
+    deadline = time.time() + timeout
+    result = predicate()
+    while not result and time.time() < deadline:
+        time.sleep(0.1)
+        result = predicate()
+    return result
+
+
+def contents(messages):
+    return [message['content'] for message in messages]
+
+
+def add_user(work_dir, username, password):
+    conn = sqlite3.connect(os.path.join(work_dir, 'chat_history.db'))
+    conn.execute('INSERT INTO users (username, password_hash) VALUES (?, ?)',
+                 (username, generate_password_hash(password)))
+    conn.commit()
+    conn.close()
+
+
+def run_checks(a, b, other, ollama, sync_timeout):
+    failures = []
+
+    def check(name, ok, details=''):
+        print(f"{'✅' if ok else '❌'} {name}" + (f": {details}" if details and not ok else ''))
+        if not ok:
+            failures.append(name)
+
+    a.post('/login', data={'username': USERNAME, 'password': PASSWORD})
+    b.cookies = a.cookies  # общая файловая сессия Flask
+
+    a.post('/preload_model')
+    status = b.get('/get_status').json()
+    check('модель, загруженная через A, загружена на B', status.get('model_loaded') is True, status)
+
+    session_id = a.post('/new_chat').json()['session_id']
+
+    # Контекст переходит между воркерами в обе стороны
+    response = a.post('/send_message', json={'message': 'Первый вопрос', 'session_id': session_id})
+    check('ход на A', response.status_code == 200 and response.json().get('success'), response.text)
+
+    b.post('/send_message', json={'message': 'Второй вопрос', 'session_id': session_id})
+    sent = contents(ollama.requests[-1])
+    check('контекст хода на B содержит ход с A', sent[:1] == ['Первый вопрос'] and len(sent) == 3, sent)
+
+    a.post('/send_message', json={'message': 'Третий вопрос', 'session_id': session_id})
+    sent = contents(ollama.requests[-1])
+    check('контекст хода на A содержит ход с B', 'Второй вопрос' in sent and len(sent) == 5, sent)
+
+    # Асинхронная операция: очередь и статусы в БД
+    operation_id = a.post('/send_message_async',
+                          json={'message': 'Асинхронный вопрос', 'session_id': session_id}).json()['operation_id']
+    status = wait_for(lambda: (b.get(f'/operation_status/{operation_id}').json().get('status') == 'completed'
+                               and b.get(f'/operation_status/{operation_id}').json()), 30)
+    check('операция с A завершена и видна через B', bool(status), status)
+
+    # Кеш истории: A закешировал историю, B дописал сообщение
+    before = len(a.get('/get_history').json()['messages'])
+    b.post('/send_message', json={'message': 'Вопрос для кеша', 'session_id': session_id})
+    fresh = wait_for(lambda: len(a.get('/get_history').json()['messages']) == before + 2, sync_timeout)
+    check('история на A обновилась после сообщения на B', bool(fresh))
+
+    # Очистка на A: B не должен отправить модели старый контекст
+    a.post('/clear_history')
+    b.post('/send_message', json={'message': 'После очистки', 'session_id': session_id})
+    sent = contents(ollama.requests[-1])
+    check('после очистки на A контекст B пуст', sent == ['После очистки'], sent)
+
+    history = wait_for(lambda: contents(a.get('/get_history').json()['messages']), sync_timeout)
+    # Сообщения одной секунды могут идти в любом порядке
+    check('история на A после очистки и хода на B', sorted(history) == ['Готово', 'После очистки'], history)
+
+    # Чужая сессия: сообщение не доходит ни до модели, ни до истории владельца
+    other.post('/login', data={'username': OTHER_USERNAME, 'password': OTHER_PASSWORD})
+    requests_before = len(ollama.requests)
+    response = other.post('/send_message', json={'message': 'Чужой вопрос', 'session_id': session_id})
+    check('отправка в чужую сессию отклонена', response.status_code == 404, response.text)
+    response = other.post('/send_message_async', json={'message': 'Чужой вопрос', 'session_id': session_id})
+    check('асинхронная отправка в чужую сессию отклонена', response.status_code == 404, response.text)
+    check('модель не получила запрос в чужую сессию', len(ollama.requests) == requests_before)
+    history = contents(a.get('/get_history').json()['messages'])
+    check('история владельца не изменилась', 'Чужой вопрос' not in history, history)
+
+    # Вложение владельца: его хеш в запросе другого пользователя не ссылка на файл
+    secret = 'Секрет владельца'
+    a.post('/send_message', json={'message': 'С файлом', 'session_id': session_id,
+                                  'files': [{'name': 'secret.txt', 'content': secret}]})
+    secret_hash = hashlib.sha256(secret.encode('utf-8')).hexdigest()
+    other_session = other.post('/new_chat').json()['session_id']
+    other.post('/send_message', json={'message': 'Ссылка на чужой файл', 'session_id': other_session,
+                                      'files': [{'name': 'x', 'hash': secret_hash}]})
+    response = other.get(f'/attachment/{other_session}/{secret_hash}')
+    check('чужое вложение не читается по хешу', response.status_code == 404, response.text)
+    response = other.post('/send_message', json={'message': 'Не объект', 'session_id': other_session,
+                                                 'files': ['secret.txt']})
+    check('вложение не-объект отклонено', response.status_code == 400, response.text)
+
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Проверка нескольких воркеров с общим состоянием')
+    parser.add_argument('--port', type=int, default=5110, help='порт воркера A (B - следующий)')
+    parser.add_argument('--ollama-port', type=int, default=11510, help='порт поддельного Ollama')
+    parser.add_argument('--sync-timeout', type=float, default=5.0,
+                        help='секунд на распространение инвалидаций кеша')
+    parser.add_argument('--state-store', default='sqlite', help='STATE_STORE воркеров: sqlite или memory')
+    args = parser.parse_args()
+
+    ollama = FakeOllama(args.ollama_port, 0)
+    ollama.start()
+
+    work_dir = prepare_work_dir()
+    add_user(work_dir, OTHER_USERNAME, OTHER_PASSWORD)
+    env = dict(os.environ, PYTHONPATH=PROJECT_DIR, STATE_STORE=args.state_store,
+               OLLAMA_HOST=f'http://127.0.0.1:{args.ollama_port}')
+    ports = (args.port, args.port + 1)
+    servers = [subprocess.Popen([sys.executable, '-c', SERVER_COMMAND.format(port=port)], cwd=work_dir, env=env,
+                                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+               for port in ports]
+
+    try:
+        with httpx.Client(base_url=f'http://127.0.0.1:{ports[0]}', timeout=60) as a, \
+                httpx.Client(base_url=f'http://127.0.0.1:{ports[1]}', timeout=60) as b, \
+                httpx.Client(base_url=f'http://127.0.0.1:{ports[0]}', timeout=60) as other:
+            wait_ready(a)
+            wait_ready(b)
+            print(f"🚀 Воркеры: {ports[0]}, {ports[1]}, каталог {work_dir}")
+            failures = run_checks(a, b, other, ollama, args.sync_timeout)
+    finally:
+        for server in servers:
+            server.terminate()
+            server.wait()
+
+    if failures:
+        print(f"❌ Не пройдено проверок: {len(failures)}")
+        sys.exit(1)
+    print("✅ Все проверки пройдены")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,351 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Проверка планов запросов database.py на синтетической БД.
+
+Создает БД с миллионами сообщений по актуальной схеме (schema.migrate),
+вызывает каждый публичный метод классов БД (database.py, state_store.py,
+sharding.py) и перехватывает выполненные ими запросы через
+set_trace_callback соединений. Каждый перехваченный запрос проверяется
+через EXPLAIN QUERY PLAN: полный просмотр таблицы и временная сортировка
+(USE TEMP B-TREE) считаются ошибкой. Запросы не копируются в проверку
+вручную, поэтому новый запрос в существующем методе проверяется сам, а
+новый метод, который проверка не вызывает, тоже считается ошибкой.
+
+    python check_query_plans.py --messages 2000000
+"""
+
+import argparse
+import contextlib
+import functools
+import os
+import random
+import re
+import sqlite3
+import sys
+import tempfile
+import time
+import types
+
+from werkzeug.security import generate_password_hash
+
+from database import ChatDatabase, UserDatabase, OperationDatabase
+from rendering import MarkdownRenderer
+from schema import migrate
+from sharding import ShardRouter
+from state_store import SQLiteStateStore
+
+ARCHIVE_NAME = 'query_plans_archive.db'
+CHECKED_CLASSES = (ChatDatabase, UserDatabase, OperationDatabase, SQLiteStateStore, ShardRouter)
+
+# Допустимые отступления от правила: (метод, таблица или 'TEMP B-TREE') -> причина
+ALLOWED = {
+    ('OperationDatabase.purge_operations', 'operations'):
+        'фоновая очистка раз в час; таблица сама ограничена этой очисткой',
+    ('SQLiteStateStore.purge_events', 'cache_invalidations'):
+        'фоновая очистка; в таблице только события за последние минуты',
+    ('OperationDatabase.claim_operation', 'TEMP B-TREE'):
+        'сортируются только ожидающие задачи и задачи с истекшей арендой - их число ограничено JOB_QUEUE_LIMIT',
+}
+
+# Запросы, план которых не проверяется: служебные команды без плана
+UNPLANNED = re.compile(r'^\s*(BEGIN|COMMIT|ROLLBACK|PRAGMA|ATTACH|DETACH|CREATE|DROP|ANALYZE|VACUUM|SAVEPOINT|'
+                       r'RELEASE)\b', re.IGNORECASE)
+# Литералы подставленных параметров: одинаковые запросы с разными значениями проверяются один раз
+LITERALS = re.compile(r"X'[0-9A-Fa-f]*'|'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+SCAN = re.compile(r'\bSCAN (\w+(?:\.\w+)?)')
+
+
+class QueryRecorder:
+    """Запросы, выполненные публичными методами проверяемых классов.
+
+    Методы классов оборачиваются: вызов отмечается как проверенный, а
+    запросы его соединений записываются с именем метода (вложенные
+    вызовы - с именем самого внутреннего).
+    """
+
+    def __init__(self, classes):
+        self.classes = classes
+        self.methods = set()
+        self.called = set()
+        self.queries = {}  # (метод, запрос без литералов) -> запрос с литералами
+        self._stack = []
+
+    def public_methods(self, cls):
+        return [name for name, attribute in vars(cls).items()
+                if not name.startswith('_') and isinstance(attribute, types.FunctionType)]
+
+    @contextlib.contextmanager
+    def recording(self):
+        originals = []
+        for cls in self.classes:
+            for name in self.public_methods(cls):
+                label = f"{cls.__name__}.{name}"
+                self.methods.add(label)
+                originals.append((cls, name, vars(cls)[name]))
+                setattr(cls, name, self._wrap(vars(cls)[name], label))
+
+        connect = sqlite3.connect
+
+        @functools.wraps(connect)
+        def traced_connect(*args, **kwargs):
+            conn = connect(*args, **kwargs)
+            conn.set_trace_callback(self._record)
+            return conn
+
+        sqlite3.connect = traced_connect
+        try:
+            yield self
+        finally:
+            sqlite3.connect = connect
+            for cls, name, function in originals:
+                setattr(cls, name, function)
+
+    def _wrap(self, function, label):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            self.called.add(label)
+            self._stack.append(label)
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self._stack.pop()
+        return wrapper
+
+    def _record(self, sql):
+        # Запросы самой проверки (подготовка данных) не проверяются
+        if not self._stack or UNPLANNED.match(sql):
+            return
+        key = (self._stack[-1], ' '.join(LITERALS.sub('?', sql).split()))
+        self.queries.setdefault(key, sql)
+
+
+def build_database(db_path, messages, users, sessions_per_user, operations):
+    """Заполняет БД синтетическими пользователями, сессиями, сообщениями и операциями"""
+    migrate(db_path)
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+
+    cursor.executemany('INSERT INTO users (username, password_hash) VALUES (?, ?)',
+                       ((f'user_{u}', 'x') for u in range(1, users + 1)))
+    # Настоящий хеш у одного пользователя: verify_user доходит до обновления last_login
+    cursor.execute('UPDATE users SET password_hash = ? WHERE username = ?', (generate_password_hash('x'), 'user_1'))
+    cursor.executemany('''
+                       INSERT INTO chat_sessions (user_id, session_id, updated_at)
+                       VALUES (?, ?, datetime('now', ?))
+                       ''', ((u, f'session_{u}_{s}', f'-{random.randint(0, 720)} days')
+                             for u in range(1, users + 1) for s in range(sessions_per_user)))
+
+    def rows():
+        for i in range(messages):
+            u = random.randint(1, users)
+            s = random.randrange(sessions_per_user)
+            role = 'user' if i % 2 == 0 else 'assistant'
+            yield (f'session_{u}_{s}', role, 'x' * random.randint(10, 200), None,
+                   random.random() * 60, f'2025-01-01 00:00:{i % 60:02d}', None, u)
+
+    cursor.executemany('''
+                       INSERT INTO chat_messages
+                           (session_id, role, content, thinking, response_time, timestamp, files, user_id)
+                       VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                       ''', rows())
+    cursor.executemany('INSERT INTO attachment_blobs (hash, content, size, ref_count) VALUES (?, ?, ?, ?)',
+                       ((f'{i:064x}', 'data', 4, 1) for i in range(1000)))
+
+    # Очередь: в основном завершенные операции, немного ожидающих и выполняемых
+    now = time.time()
+
+    def operation_rows():
+        for i in range(operations):
+            u = random.randint(1, users)
+            status = random.choices(('completed', 'error', 'pending', 'running'), (90, 5, 3, 2))[0]
+            created_at = now - random.random() * 7 * 86400
+            finished_at = created_at + 5 if status in ('completed', 'error') else None
+            lease_expires = now + 60 if status == 'running' else None
+            yield (f'op_{i}', u, f'session_{u}_{random.randrange(sessions_per_user)}', status, created_at,
+                   finished_at, lease_expires)
+
+    cursor.executemany('''
+                       INSERT INTO operations
+                           (operation_id, user_id, session_id, status, created_at, finished_at, lease_expires)
+                       VALUES (?, ?, ?, ?, ?, ?, ?)
+                       ''', operation_rows())
+    cursor.executemany('INSERT INTO shared_state (key, value, updated_at) VALUES (?, ?, ?)',
+                       ((f'context_version:session_{i}', '1', now) for i in range(10000)))
+    cursor.executemany('INSERT INTO cache_invalidations (origin, payload, created_at) VALUES (?, ?, ?)',
+                       (('bench', '{}', now - i) for i in range(10000)))
+    conn.commit()
+    cursor.execute('ANALYZE')
+    conn.close()
+
+
+def exercise(db_path, work_dir):
+    """Вызывает каждый публичный метод проверяемых классов"""
+    archive_path = os.path.join(work_dir, ARCHIVE_NAME)
+    chat = ChatDatabase(db_path, archive_path=archive_path, renderer=MarkdownRenderer())
+    users = UserDatabase(db_path, archive_path=archive_path)
+    operations = OperationDatabase(db_path)
+    state = SQLiteStateStore(db_path)
+    router = ShardRouter(db_path, 2, os.path.join(work_dir, 'query_plans_shards'))
+
+    chat.init_database()
+    users.init_user_table()
+    users.verify_user('user_1', 'x')
+
+    # Сессия проверки: сообщения, вложение, снимок контекста
+    session_id = users.create_session(1)
+    users.update_session_title(session_id, 'Проверка планов')
+    users.get_session_owner(session_id)
+    users.get_user_sessions(1)
+    chat.save_message(session_id, 'user', 'Вопрос', files=[{'name': 'a.txt', 'content': 'данные'}], user_id=1)
+    chat.save_message(session_id, 'assistant', '**Ответ**', user_id=1, timings={'model': 1.0})
+    # Ответ без HTML: get_messages отрендерит и сохранит его
+    messages = chat.get_messages(session_id)
+    blob_hash = next(message['files'][0]['hash'] for message in messages if message['files'])
+    chat.get_messages('session_1_0')
+    chat.get_session_revision('session_1_0')
+    chat.has_answer('session_1_0')
+    chat.get_context_messages('session_1_0')
+    chat.get_session_stats('session_1_0')
+    chat.save_context_snapshot(session_id, [{'role': 'user', 'content': 'Вопрос'}], 10)
+    chat.get_context_snapshot(session_id)
+    chat.get_attachment(blob_hash, session_id)
+    chat.get_compression_stats()
+
+    # Архив: сессия проверки старше всех синтетических (до 720 дней)
+    conn = sqlite3.connect(db_path)
+    conn.execute("UPDATE chat_sessions SET updated_at = datetime('now', '-3000 days') WHERE session_id = ?",
+                 (session_id,))
+    conn.commit()
+    conn.close()
+    chat.archive_idle_sessions(max_idle_days=2000)
+    chat.get_messages(session_id)
+    chat.get_session_revision(session_id)
+    chat.has_answer(session_id)
+    chat.get_context_messages(session_id)
+    chat.get_attachment(blob_hash, session_id)
+    # Продолжение архивной сессии возвращает её в горячую БД
+    chat.save_message(session_id, 'user', 'Снова', user_id=1)
+
+    # Фоновые миграции проходят только последние сообщения
+    conn = sqlite3.connect(db_path)
+    conn.execute("INSERT OR REPLACE INTO db_meta (key, value) "
+                 "SELECT 'compress_watermark', MAX(id) - 100 FROM chat_messages")
+    conn.commit()
+    conn.close()
+    chat.compress_existing_messages()
+    chat.migrate_inline_attachments()
+    chat.enable_incremental_vacuum()
+    chat.incremental_vacuum()
+
+    chat.delete_session_messages(session_id)
+    chat.clear_session(session_id)
+    users.delete_session(session_id)
+
+    # Очередь операций
+    now = time.time()
+    for index in range(3):
+        operations.create_operation(f'check_{index}', 1, f'session_1_{index}', now + index, {'message': 'x'})
+    job, _ = operations.claim_operation('check-worker', 60, 2)
+    operations.queue_length()
+    operations.queue_length(1)
+    operations.queue_position('check_2')
+    operations.renew_leases([job['operation_id']], 'check-worker', 60)
+    operations.cancel_requests([job['operation_id']])
+    operations.set_progress(job['operation_id'], 'Проверка')
+    operations.cancel_operation('check_2', now)
+    operations.finish_operation(job['operation_id'], 'completed', 'Готово', {'response': 'x'}, None, now,
+                                'check-worker')
+    operations.get_operation(job['operation_id'])
+    operations.purge_operations()
+
+    # Общее состояние процессов
+    state.set('context_version:check', 1)
+    state.get('context_version:check')
+    state.delete('context_version:check')
+    state.purge('context_version:', 3600)
+    state.publish({'keys': []})
+    state.events_since(None)
+    state.events_since(0)
+    state.purge_events(3600)
+
+    # Каталог шардов
+    router.shard_for_user(1)
+    router.user_for_session('session_1_0')
+    router.locate('session_1_0')
+    router.touch_session('session_1_0')
+    router.is_archived('session_1_0')
+    router.set_archived('session_1_0', True)
+    router.set_archived('session_1_0', False)
+    router.forget_session('session_1_0')
+    router.forget_users()
+
+
+def check_plans(db_path, recorder):
+    """Проверяет планы всех перехваченных запросов, возвращает количество ошибок"""
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+    # Запросы к архиву выполнялись через ATTACH
+    cursor.execute('ATTACH DATABASE ? AS archive', (os.path.join(os.path.dirname(os.path.abspath(db_path)),
+                                                                 ARCHIVE_NAME),))
+    failures = 0
+
+    for method in sorted(recorder.methods - recorder.called):
+        failures += 1
+        print(f"❌ {method}: метод не вызывается проверкой - добавьте его в exercise()")
+
+    for (method, _), sql in sorted(recorder.queries.items()):
+        cursor.execute(f'EXPLAIN QUERY PLAN {sql}')
+        plan = ' | '.join(row[-1] for row in cursor.fetchall())
+        statement = ' '.join(sql.split())
+
+        problems = []
+        for table in SCAN.findall(plan):
+            # SCAN CONSTANT ROW - выражение без таблицы
+            name = table.split('.')[-1]
+            if name != 'CONSTANT' and (method, name) not in ALLOWED:
+                problems.append(f'полный просмотр {table}')
+        if 'TEMP B-TREE' in plan and (method, 'TEMP B-TREE') not in ALLOWED:
+            problems.append('временная сортировка')
+
+        if problems:
+            failures += 1
+            print(f"❌ {method}: {', '.join(problems)}\n   запрос: {statement[:200]}\n   план: {plan}")
+        else:
+            print(f"✅ {method}: {plan or '-'}  ← {statement[:60]}")
+
+    conn.close()
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Проверка EXPLAIN QUERY PLAN для запросов чата')
+    parser.add_argument('--messages', type=int, default=2_000_000, help='сообщений в синтетической БД')
+    parser.add_argument('--users', type=int, default=10_000)
+    parser.add_argument('--sessions-per-user', type=int, default=20)
+    parser.add_argument('--operations', type=int, default=100_000, help='операций в очереди')
+    parser.add_argument('--db', help='путь к БД (по умолчанию временный файл)')
+    args = parser.parse_args()
+
+    db_path = args.db or os.path.join(tempfile.mkdtemp(), 'query_plans.db')
+
+    if not os.path.exists(db_path):
+        print(f"🔄 Создаю синтетическую БД: {args.messages:,} сообщений → {db_path}")
+        start_time = time.time()
+        build_database(db_path, args.messages, args.users, args.sessions_per_user, args.operations)
+        print(f"⏱️ БД создана за {time.time() - start_time:.1f} секунд")
+    else:
+        migrate(db_path)
+
+    recorder = QueryRecorder(CHECKED_CLASSES)
+    with recorder.recording():
+        exercise(db_path, os.path.dirname(os.path.abspath(db_path)))
+
+    failures = check_plans(db_path, recorder)
+    if failures:
+        print(f"❌ Запросов с неверным планом: {failures}")
+        sys.exit(1)
+    print("✅ Все запросы используют индексы")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Сжатые значения хранятся как BLOB с маркером формата в начале.
+# Старые строки остаются TEXT и читаются без изменений.
+MARKER_ZLIB = b'\x00Z1'
+MARKER_ZSTD = b'\x00S1'
+
+DEFAULT_THRESHOLD = 4096  # байт, меньше - не сжимаем
+DEFAULT_LEVEL = 6
+
+
+def pack_text(text, threshold=DEFAULT_THRESHOLD, level=DEFAULT_LEVEL):
+    """Сжимает текст, если он больше порога и сжатие выгодно.
+
+    Возвращает исходную строку или bytes с маркером формата.
+    """
+    if text is None or not isinstance(text, str):
+        return text
+
+    raw = text.encode('utf-8')
+    if len(raw) < threshold:
+        return text
+
+    if zstandard is not None:
+        packed = MARKER_ZSTD + zstandard.ZstdCompressor(level=level).compress(raw)
+    else:
+        packed = MARKER_ZLIB + zlib.compress(raw, level)
+
+    if len(packed) >= len(raw):
+        return text
+    return packed
+
+
+def unpack_text(value):
+    """Возвращает текст из значения колонки (сжатого или обычного)"""
+    if not isinstance(value, (bytes, bytearray)):
+        return value
+
+    value = bytes(value)
+    if value.startswith(MARKER_ZLIB):
+        return zlib.decompress(value[len(MARKER_ZLIB):]).decode('utf-8')
+    if value.startswith(MARKER_ZSTD):
+        if zstandard is None:
+            raise RuntimeError("Для чтения данных нужен пакет zstandard")
+        return zstandard.ZstdDecompressor().decompress(value[len(MARKER_ZSTD):]).decode('utf-8')
+
+    # BLOB без маркера - считаем, что это обычный текст в utf-8
+    return value.decode('utf-8')
+
+
+def stored_size(value):
+    """Размер значения в базе в байтах"""
+    if value is None:
+        return 0
+    if isinstance(value, (bytes, bytearray)):
+        return len(value)
+    return len(str(value).encode('utf-8'))
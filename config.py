@@ -28,9 +28,111 @@ class Config:
 
     # Настройки загрузки файлов
     MAX_CONTENT_LENGTH = 10 * 1024 * 1024  # 10MB
-    UPLOAD_FOLDER = 'uploads'
+    # Вложения читаются из запроса потоково: лимиты проверяются по ходу чтения
+    UPLOAD_MAX_FILE_BYTES = 5 * 1024 * 1024
+    UPLOAD_MAX_FILE_TOKENS = 64000  # оценка как estimate_tokens: символов / 4
+    UPLOAD_MAX_FILES = 10  # файлов в одном сообщении
     ALLOWED_EXTENSIONS = {'txt', 'csv', 'json', 'md', 'py', 'js', 'html', 'xml'}
 
+    # Сжатие больших сообщений в БД
+    COMPRESS_THRESHOLD = 4096  # байт
+    COMPRESS_LEVEL = 6
+    COMPRESS_MIGRATE_ON_START = True
+
+    # Архивирование старых сессий и очистка БД
+    ARCHIVE_PATH = 'chat_archive.db'
+    ARCHIVE_IDLE_DAYS = 90  # сессии без активности дольше - в архив
+    MAINTENANCE_INTERVAL = 3600  # секунд между запусками обслуживания БД
+    VACUUM_PAGES = 1000  # страниц за один шаг incremental_vacuum
+
+    # Шардирование сообщений по user_id (0 - одна БД chat_history.db).
+    # После изменения количества шардов запустите rebalance_shards.py
+    SHARD_COUNT = int(os.environ.get('SHARD_COUNT', 0))
+    SHARD_DIR = 'shards'
+
+    # Кеш чтения сессий и последних сообщений (в памяти процесса).
+    # TTL ограничивает устаревание, если БД меняют другие процессы
+    CACHE_MAX_ENTRIES = 10000
+    CACHE_MAX_BYTES = 64 * 1024 * 1024
+    CACHE_TTL = 60  # секунд
+
+    # Живые контексты модели по сессиям (снимки также хранятся в БД)
+    CONTEXT_CACHE_SIZE = 200
+    CONTEXT_CACHE_MAX_BYTES = 256 * 1024 * 1024
+    CONTEXT_CACHE_TTL = 3600  # секунд
+
+    # Живые движки разговоров по сессиям: лимиты и выгрузка простаивающих
+    ENGINE_POOL_SIZE = 100
+    ENGINE_POOL_MAX_BYTES = 512 * 1024 * 1024
+    ENGINE_IDLE_TIMEOUT = 1800  # секунд без обращений до выгрузки
+    ENGINE_CLEANUP_INTERVAL = 60  # секунд между проверками
+
+    # Асинхронные операции: сколько держать в памяти (итоги хранятся в БД)
+    OPERATION_REGISTRY_SIZE = 1000
+    OPERATION_TTL = 3600  # секунд после завершения
+    OPERATION_FETCHED_TTL = 60  # секунд после того, как клиент получил результат
+    OPERATION_RETENTION_DAYS = 7  # сколько хранить итоги в БД
+
+    # Очередь задач в БД: воркеры процесса, аренда и повторы после сбоя
+    JOB_WORKERS = 2
+    JOB_LEASE_SECONDS = 60  # аренда продлевается каждые JOB_LEASE_SECONDS / 3
+    JOB_POLL_INTERVAL = 1.0  # секунд между проверками очереди без задач
+    JOB_MAX_ATTEMPTS = 2  # сколько раз запускать задачу, прерванную остановкой процесса
+    JOB_QUEUE_LIMIT = 100  # ожидающих задач всего, сверх - ответ 429
+    JOB_USER_QUEUE_LIMIT = 5  # ожидающих задач одного пользователя
+    JOB_RETRY_AFTER = 30  # секунд, заголовок Retry-After при отказе
+
+    # Доставка статуса операций: SSE и long-poll вместо опроса каждые 2 секунды
+    SSE_KEEPALIVE_INTERVAL = 15  # секунд между keepalive-комментариями в потоке событий
+    OPERATION_LONG_POLL_TIMEOUT = 30  # максимальное ожидание одного long-poll запроса
+
+    # WebSocket-канал чата (нужен flask-sock, без него клиент работает через REST)
+    SOCK_SERVER_OPTIONS = {'ping_interval': 25}  # секунд между ping-кадрами, держит соединение за прокси
+
+    # ASGI-режим (uvicorn asgi:application): потоки для обычных Flask-маршрутов
+    ASGI_WSGI_THREADS = 32
+
+    # Сжатие JSON-ответов (brotli при наличии пакета, иначе gzip)
+    RESPONSE_COMPRESS_MIN_SIZE = 1024  # байт, меньшие ответы не сжимаются
+    RESPONSE_GZIP_LEVEL = 6
+    RESPONSE_BROTLI_QUALITY = 5  # 0-11, выше 5 заметно дороже по CPU
+
+    # Журнал: уровень, уровни модулей (LOG_LEVELS=database=WARNING,deepseek_helpers=DEBUG), json или text
+    LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO')
+    LOG_LEVELS = os.environ.get('LOG_LEVELS', 'httpx=WARNING')
+    LOG_FORMAT = os.environ.get('LOG_FORMAT', 'json')
+    LOG_QUEUE_SIZE = 10000  # записей; при переполнении новые записи отбрасываются
+    # Доля записываемых частых событий (поле event); предупреждения и ошибки пишутся всегда
+    LOG_SAMPLE_RATES = {
+        'turn.sent': 0.1,
+        'model.request': 0.1,
+        'model.response': 0.1,
+        'message.preview': 0.01
+    }
+
+    # Метрики Prometheus (/metrics): с токеном - только с заголовком Authorization: Bearer <токен>.
+    # Без токена endpoint выключен (404), пока METRICS_PUBLIC не открывает его явно
+    METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+    METRICS_PUBLIC = os.environ.get('METRICS_PUBLIC', '').lower() in ('1', 'true', 'yes')
+
+    # Трассировка запросов и задач: доля записываемых трасс, буфер для /admin/traces, JSONL-файл спанов
+    TRACE_SAMPLE_RATE = float(os.environ.get('TRACE_SAMPLE_RATE', 0.01))
+    TRACE_BUFFER_SPANS = 5000
+    TRACE_FILE = os.environ.get('TRACE_FILE')  # None - только буфер в памяти
+
+    # Служебные endpoint-ы /admin/*: доступны только с заголовком Authorization: Bearer <ADMIN_TOKEN>
+    ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN')
+
+    # Профилирование по запросу (/admin/profile): пределы сеанса выборочного профилировщика
+    PROFILE_MAX_SECONDS = 120
+    PROFILE_MIN_INTERVAL = 0.005  # секунд между выборками стеков, не чаще 200 раз в секунду
+
+    # Общее состояние процессов: версии контекстов, загрузка модели, инвалидации кеша.
+    # memory - один процесс; sqlite - несколько воркеров с общей БД (gunicorn -w N)
+    STATE_STORE = os.environ.get('STATE_STORE', 'memory')
+    CACHE_SYNC_INTERVAL = 1.0  # секунд между чтениями инвалидаций других процессов
+    STATE_RETENTION_SECONDS = 86400  # сколько хранить версии контекстов и события инвалидации
+
     # Настройки DeepSeek
     DEEPSEEK_MODEL = 'deepseek-r1:8b'
     MAX_CONTEXT_TOKENS = 128000
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import uuid
+
+from cache import LRUCache
+
+
+class ContextStore:
+    """Контексты модели по сессиям.
+
+    После каждого хода точный контекст (уже обрезанный manage_context,
+    с развернутыми вложениями) сохраняется в таблицу context_snapshots и
+    в LRU живых контекстов. Переключение сессии берет снимок из памяти или
+    одной строкой из БД вместо пересборки истории по сообщениям.
+
+    Каждое сохранение и сброс контекста меняет его версию в общем
+    хранилище состояния (state). Снимок в памяти и контекст движка
+    помнят версию, с которой получены: если сессию изменил другой
+    процесс, версии расходятся и контекст перечитывается из БД.
+    """
+
+    def __init__(self, db, state=None, max_entries=200, max_bytes=256 * 1024 * 1024, ttl=3600):
+        self.db = db
+        self.state = state
+        self.cache = LRUCache(max_entries=max_entries, max_bytes=max_bytes, ttl=ttl)
+
+    def _version(self, session_id):
+        if self.state is None:
+            return None
+        return self.state.get(f"context:{session_id}")
+
+    def _bump(self, session_id):
+        """Новая версия контекста. Случайная, а не счетчик: удаленный ключ не вернет старую"""
+        if self.state is None:
+            return None
+        version = uuid.uuid4().hex
+        self.state.set(f"context:{session_id}", version)
+        return version
+
+    def save(self, session_id, engine):
+        """Сохраняет контекст движка после завершенного хода"""
+        snapshot = engine.export_context()
+        self.db.save_context_snapshot(session_id, snapshot['messages'], snapshot['token_count'])
+        snapshot['version'] = engine.context_version = self._bump(session_id)
+        self.cache.put(('context', session_id), snapshot)
+        return snapshot
+
+    def load(self, session_id):
+        """Снимок контекста сессии: из памяти, из БД или собранный по всей истории"""
+        key = ('context', session_id)
+        version = self._version(session_id)
+        snapshot = self.cache.get(key)
+        if snapshot is not None and snapshot.get('version') == version:
+            return snapshot
+
+        generation = self.cache.generation(key)
+        snapshot = self.db.get_context_snapshot(session_id)
+        if snapshot is None:
+            # Сессии, сохраненные до появления снимков (или возвращенные из архива).
+            # Сообщения пользователя без ответа в конце - ходы, которые еще в очереди
+            # (или сорвались): обработчик сам добавит сообщение своего хода
+            messages = self.db.get_context_messages(session_id)
+            while messages and messages[-1]['role'] == 'user':
+                messages.pop()
+            snapshot = {'messages': messages, 'token_count': None}
+        snapshot['version'] = version
+        self.cache.put(key, snapshot, generation)
+        return snapshot
+
+    def restore(self, session_id, engine):
+        """Загружает контекст сессии в движок"""
+        snapshot = self.load(session_id)
+        engine.restore_context(snapshot['messages'])
+        engine.context_version = snapshot['version']
+        return snapshot
+
+    def is_stale(self, session_id, engine):
+        """Контекст движка устарел: сессию с тех пор изменил другой процесс"""
+        if self.state is None or not self.state.shared:
+            return False
+        return engine.context_version != self._version(session_id)
+
+    def drop(self, session_id):
+        """Забывает живой контекст (снимок в БД удаляется вместе с сообщениями)"""
+        self.cache.invalidate(('context', session_id))
+        self._bump(session_id)
+
+    def stats(self):
+        return self.cache.stats()
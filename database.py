@@ -1,136 +1,781 @@
 import sqlite3
 import json
+import logging
 import os
+import hashlib
+import time
+import uuid
 from datetime import datetime
 from threading import Lock
-import bcrypt
 from werkzeug.security import generate_password_hash, check_password_hash
 
+from compression import pack_text, unpack_text, stored_size, DEFAULT_THRESHOLD, DEFAULT_LEVEL
+from schema import ensure_schema, ensure_archive_schema
+from sharding import Shard
+from metrics import instrument_methods, DB_LATENCY, DB_ERRORS
+from tracing import trace_methods
 
+log = logging.getLogger(__name__)
+
+
+def _store_attachments(cursor, files, pack, references=False):
+    """Сохраняет содержимое файлов в attachment_blobs и возвращает ссылки.
+
+    Одинаковое содержимое хранится один раз (ключ - SHA-256),
+    для каждой ссылки увеличивается счетчик ref_count.
+    references=True - в files могут быть готовые ссылки {'name', 'hash', 'size'}
+    (только для данных самой БД: перенос старых сообщений). Из запросов
+    клиентов ссылки не принимаются: знание хеша не дает доступа к чужому файлу.
+    """
+    refs = []
+    for file_data in files:
+        if references and 'hash' in file_data and 'content' not in file_data:
+            # Уже ссылка - только увеличиваем счетчик
+            cursor.execute('UPDATE attachment_blobs SET ref_count = ref_count + 1 WHERE hash = ?',
+                           (file_data['hash'],))
+            refs.append(file_data)
+            continue
+
+        content = file_data.get('content', '')
+        blob_hash = hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+        cursor.execute('''
+                       INSERT OR IGNORE INTO attachment_blobs (hash, content, size, ref_count)
+                       VALUES (?, ?, ?, 0)
+                       ''', (blob_hash, pack(content), len(content)))
+        cursor.execute('UPDATE attachment_blobs SET ref_count = ref_count + 1 WHERE hash = ?', (blob_hash,))
+
+        refs.append({
+            'name': file_data.get('name', 'unknown'),
+            'hash': blob_hash,
+            'size': len(content)
+        })
+    return refs
+
+
+def _attachment_hashes(files_value):
+    """Список хешей вложений из значения колонки files"""
+    files_json = unpack_text(files_value)
+    if not files_json:
+        return []
+    return [f['hash'] for f in json.loads(files_json) if isinstance(f, dict) and f.get('hash')]
+
+
+def _release_attachments(cursor, where_sql, params, table='chat_messages'):
+    """Уменьшает ref_count вложений удаляемых сообщений и удаляет ненужные блобы.
+
+    Вызывается в той же транзакции, что и DELETE из chat_messages.
+    """
+    cursor.execute(f'SELECT files FROM {table} WHERE files IS NOT NULL AND {where_sql}', params)
+    released = 0
+    for (files_value,) in cursor.fetchall():
+        for blob_hash in _attachment_hashes(files_value):
+            cursor.execute('UPDATE attachment_blobs SET ref_count = ref_count - 1 WHERE hash = ?', (blob_hash,))
+            released += 1
+
+    if released:
+        cursor.execute('DELETE FROM attachment_blobs WHERE ref_count <= 0')
+    return released
+
+
+def _attach_archive(cursor, archive_path):
+    """Подключает архивную БД как схему archive.
+
+    Схема архива создается и обновляется один раз на процесс (ensure_archive_schema),
+    здесь - только ATTACH. Его нельзя выполнять внутри транзакции, поэтому
+    вызывается до любых изменений.
+    """
+    ensure_archive_schema(archive_path)
+    cursor.execute('ATTACH DATABASE ? AS archive', (archive_path,))
+
+
+def _is_archived(cursor, session_id):
+    """Проверяет, перенесена ли сессия в архив"""
+    cursor.execute('SELECT archived_at FROM chat_sessions WHERE session_id = ?', (session_id,))
+    row = cursor.fetchone()
+    return bool(row and row[0])
+
+
+def _get_meta(cursor, key, default=None):
+    """Служебное значение из db_meta"""
+    cursor.execute('SELECT value FROM db_meta WHERE key = ?', (key,))
+    row = cursor.fetchone()
+    return row[0] if row else default
+
+
+def _set_meta(cursor, key, value):
+    """Запись служебного значения в db_meta"""
+    cursor.execute('INSERT OR REPLACE INTO db_meta (key, value) VALUES (?, ?)', (key, str(value)))
+
+
+ARCHIVE_COLUMNS = ('id, session_id, role, content, thinking, response_time, timestamp, files, user_id, '
+                   'html, html_version, timings')
+
+
+@instrument_methods(DB_LATENCY, DB_ERRORS)
+@trace_methods('db')
 class ChatDatabase:
-    def __init__(self, db_path="chat_history.db"):
+    def __init__(self, db_path="chat_history.db", compress_threshold=DEFAULT_THRESHOLD,
+                 compress_level=DEFAULT_LEVEL, archive_path=None, router=None, cache=None, renderer=None):
         self.db_path = db_path
+        self.archive_path = archive_path
         self.lock = Lock()
+        # При шардировании db_path - каталог сессий, а сообщения лежат в шардах
+        self.router = router
+        # Общий с UserDatabase кеш чтения (cache.LRUCache) или None
+        self.cache = cache
+        # Рендер ответов в HTML (rendering.MarkdownRenderer): HTML устаревшей версии обновляется при чтении
+        self.renderer = renderer
+        self.compress_threshold = compress_threshold
+        self.compress_level = compress_level
+        # Статистика сжатия: сколько байт пришло и сколько реально записано
+        self.compression_stats = {'bytes_in': 0, 'bytes_stored': 0}
         self.init_database()
 
-    def init_database(self):
-        """Инициализация базы данных"""
-        with self.lock:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
+    def _pack(self, value):
+        """Сжимает значение колонки и обновляет статистику"""
+        packed = pack_text(value, self.compress_threshold, self.compress_level)
+        self.compression_stats['bytes_in'] += stored_size(value)
+        self.compression_stats['bytes_stored'] += stored_size(packed)
+        return packed
 
-            cursor.execute('''
-                           CREATE TABLE IF NOT EXISTS chat_messages
-                           (
-                               id            INTEGER PRIMARY KEY AUTOINCREMENT,
-                               session_id    TEXT NOT NULL,
-                               role          TEXT NOT NULL,
-                               content       TEXT NOT NULL,
-                               thinking      TEXT,
-                               response_time REAL,
-                               timestamp     DATETIME DEFAULT CURRENT_TIMESTAMP,
-                               files         TEXT
-                           )
-                           ''')
+    def _shard(self, session_id):
+        """Файл БД, в котором хранятся сообщения сессии"""
+        if self.router is None:
+            return Shard(0, self.db_path, self.lock, self.archive_path)
+        return self.router.locate(session_id)
 
-            cursor.execute('''
-                           CREATE INDEX IF NOT EXISTS idx_session_timestamp
-                               ON chat_messages(session_id, timestamp)
-                           ''')
+    def _shards(self):
+        """Все файлы с сообщениями"""
+        if self.router is None:
+            return [Shard(0, self.db_path, self.lock, self.archive_path)]
+        return self.router.shards
 
-            conn.commit()
-            conn.close()
+    def _invalidate_session(self, session_id, user_id=None):
+        """Сбрасывает кеш истории сессии и списка сессий её владельца"""
+        if self.cache is None:
+            return
+        owner = user_id if user_id is not None else self.cache.peek(('owner', session_id))
+        self.cache.invalidate(('messages', session_id), ('revision', session_id))
+        if owner is not None:
+            self.cache.invalidate(('sessions', owner))
+        else:
+            self.cache.invalidate_prefix(('sessions',))
+
+    def _session_archived(self, cursor, shard, session_id):
+        """Отметка archived_at берется из каталога сессий"""
+        if not shard.archive_path:
+            return False
+        if self.router is not None:
+            return self.router.is_archived(session_id)
+        return _is_archived(cursor, session_id)
+
+    def _messages_table(self, cursor, shard, session_id):
+        """Таблица с сообщениями сессии: горячая или архивная"""
+        if self._session_archived(cursor, shard, session_id):
+            _attach_archive(cursor, shard.archive_path)
+            return 'archive.chat_messages'
+        return 'chat_messages'
 
-    def save_message(self, session_id, role, content, thinking="", response_time=0, files=None, user_id=None):
-        """Сохранить сообщение в базу данных"""
+    def init_database(self):
+        """Инициализация базы данных"""
         with self.lock:
-            conn = sqlite3.connect(self.db_path)
+            ensure_schema(self.db_path)
+
+    def save_message(self, session_id, role, content, thinking="", response_time=0, files=None, user_id=None,
+                     html=None, timings=None):
+        """Сохранить сообщение в базу данных.
+
+        html - уже отрендеренный текст ответа, timings - время этапов хода в мс.
+        """
+        html_version = self.renderer.version if html is not None and self.renderer is not None else None
+        shard = self._shard(session_id)
+        with shard.lock:
+            conn = sqlite3.connect(shard.db_path)
             cursor = conn.cursor()
 
-            files_json = json.dumps(files) if files else None
+            # Продолжение архивной сессии - возвращаем её в горячую БД
+            restored = self._session_archived(cursor, shard, session_id)
+            if restored:
+                self._restore_session(cursor, shard, session_id)
+
+            # В сообщении храним только ссылки на вложения
+            files_json = json.dumps(_store_attachments(cursor, files, self._pack)) if files else None
 
             cursor.execute('''
                            INSERT INTO chat_messages
-                               (session_id, role, content, thinking, response_time, files, user_id)
-                           VALUES (?, ?, ?, ?, ?, ?, ?)
-                           ''', (session_id, role, content, thinking, response_time, files_json, user_id))
+                               (session_id, role, content, thinking, response_time, files, user_id, html,
+                                html_version, timings)
+                           VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                           ''', (session_id, role, self._pack(content), self._pack(thinking), response_time,
+                                 self._pack(files_json), user_id, self._pack(html) if html_version else None,
+                                 html_version, json.dumps(timings) if timings else None))
 
             # Обновляем время последнего обновления сессии
-            cursor.execute('''
-                           UPDATE chat_sessions
-                           SET updated_at = CURRENT_TIMESTAMP
-                           WHERE session_id = ?
-                           ''', (session_id,))
+            if self.router is None:
+                cursor.execute('''
+                               UPDATE chat_sessions
+                               SET updated_at = CURRENT_TIMESTAMP
+                               WHERE session_id = ?
+                               ''', (session_id,))
 
             conn.commit()
             conn.close()
 
+        if self.router is not None:
+            # Каталог обновляется отдельной короткой транзакцией, не держа шард
+            if restored:
+                self.router.set_archived(session_id, False)
+            self.router.touch_session(session_id)
+
+        self._invalidate_session(session_id, user_id)
+
     def get_messages(self, session_id, limit=50):
         """Получить сообщения для сессии"""
-        with self.lock:
-            conn = sqlite3.connect(self.db_path)
+        generation = None
+        if self.cache is not None:
+            cached = self.cache.get(('messages', session_id))
+            if cached is not None and cached[0] == limit:
+                return list(cached[1])
+            generation = self.cache.generation(('messages', session_id))
+
+        shard = self._shard(session_id)
+        with shard.lock:
+            conn = sqlite3.connect(shard.db_path)
             cursor = conn.cursor()
 
-            cursor.execute('''
-                           SELECT role, content, thinking, response_time, timestamp, files, user_id
-                           FROM chat_messages
+            table = self._messages_table(cursor, shard, session_id)
+            cursor.execute(f'''
+                           SELECT id, role, content, thinking, response_time, timestamp, files, user_id,
+                                  html, html_version, timings
+                           FROM {table}
                            WHERE session_id = ?
-                           ORDER BY timestamp DESC
+                           ORDER BY timestamp DESC, id DESC
                            LIMIT ?
                            ''', (session_id, limit))
 
+            version = self.renderer.version if self.renderer is not None else None
             messages = []
+            stale = []  # (id, сообщение) ответов без HTML текущей версии
             for row in cursor.fetchall():
-                role, content, thinking, response_time, timestamp, files_json, user_id = row
+                message_id, role, content, thinking, response_time, timestamp, files_json, user_id, html, \
+                    html_version, timings = row
+                content = unpack_text(content)
+                thinking = unpack_text(thinking)
+                files_json = unpack_text(files_json)
                 files = json.loads(files_json) if files_json else []
 
-                messages.append({
+                message = {
                     'role': role,
                     'content': content,
                     'thinking': thinking or '',
                     'response_time': response_time or 0,
                     'timestamp': timestamp,
                     'files': files,
-                    'user_id': user_id
-                })
+                    'user_id': user_id,
+                    'html': unpack_text(html) if version and html_version == version else None,
+                    'timings': json.loads(timings) if timings else None
+                }
+                if role == 'assistant' and message['html'] is None and version:
+                    stale.append((message_id, message))
+                messages.append(message)
+
+            conn.close()
+
+        if stale:
+            self._render_stale(shard, table, stale)
+
+        messages.reverse()  # Возвращаем в хронологическом порядке
+        if self.cache is not None:
+            self.cache.put(('messages', session_id), (limit, messages), generation)
+            return list(messages)
+        return messages
+
+    def _render_stale(self, shard, table, stale):
+        """Рендерит ответы без HTML текущей версии и сохраняет результат в таблицу table"""
+        version = self.renderer.version
+        rendered = []
+        for message_id, message in stale:
+            try:
+                message['html'] = self.renderer.render(message['content'])
+            except Exception:
+                log.exception("Ошибка конвертации markdown")
+                continue
+            rendered.append((self._pack(message['html']), version, message_id))
+
+        if not rendered:
+            return
+
+        with shard.lock:
+            conn = sqlite3.connect(shard.db_path)
+            cursor = conn.cursor()
+
+            if table.startswith('archive.'):
+                _attach_archive(cursor, shard.archive_path)
+            cursor.executemany(f'UPDATE {table} SET html = ?, html_version = ? WHERE id = ?', rendered)
+
+            conn.commit()
+            conn.close()
+
+    def get_session_revision(self, session_id):
+        """Ревизия истории сессии для условных запросов: (updated_at, число сообщений, последний id).
+
+        Меняется при любом добавлении или удалении сообщений: id не
+        переиспользуются (AUTOINCREMENT), а updated_at хранится с точностью до секунды.
+        """
+        generation = None
+        if self.cache is not None:
+            cached = self.cache.get(('revision', session_id))
+            if cached is not None:
+                return cached
+            generation = self.cache.generation(('revision', session_id))
+
+        # updated_at хранится в каталоге сессий
+        catalog_path, catalog_lock = (self.router.catalog_path, self.router.catalog_lock) \
+            if self.router is not None else (self.db_path, self.lock)
+        with catalog_lock:
+            conn = sqlite3.connect(catalog_path)
+            cursor = conn.cursor()
+
+            cursor.execute('SELECT updated_at FROM chat_sessions WHERE session_id = ?', (session_id,))
+            row = cursor.fetchone()
+            conn.close()
+        updated_at = row[0] if row else None
+
+        shard = self._shard(session_id)
+        with shard.lock:
+            conn = sqlite3.connect(shard.db_path)
+            cursor = conn.cursor()
+
+            table = self._messages_table(cursor, shard, session_id)
+            cursor.execute(f'SELECT COUNT(*), MAX(id) FROM {table} WHERE session_id = ?', (session_id,))
+            message_count, last_id = cursor.fetchone()
+            conn.close()
+
+        revision = (updated_at, message_count, last_id)
+        if self.cache is not None:
+            self.cache.put(('revision', session_id), revision, generation)
+        return revision
+
+    def has_answer(self, session_id):
+        """Есть ли в сессии ответ ассистента (первый ход сессии еще не завершен, если нет)"""
+        shard = self._shard(session_id)
+        with shard.lock:
+            conn = sqlite3.connect(shard.db_path)
+            cursor = conn.cursor()
 
+            table = self._messages_table(cursor, shard, session_id)
+            cursor.execute(f'''
+                           SELECT EXISTS(SELECT 1 FROM {table} WHERE session_id = ? AND role = 'assistant')
+                           ''', (session_id,))
+            answered = bool(cursor.fetchone()[0])
+            conn.close()
+        return answered
+
+    def get_context_messages(self, session_id):
+        """Вся история сессии в формате контекста модели (role, content) без ограничения по количеству"""
+        shard = self._shard(session_id)
+        with shard.lock:
+            conn = sqlite3.connect(shard.db_path)
+            cursor = conn.cursor()
+
+            table = self._messages_table(cursor, shard, session_id)
+            cursor.execute(f'''
+                           SELECT role, content
+                           FROM {table}
+                           WHERE session_id = ?
+                             AND role IN ('user', 'assistant')
+                           ORDER BY timestamp, id
+                           ''', (session_id,))
+            messages = [{'role': role, 'content': unpack_text(content)} for role, content in cursor.fetchall()]
             conn.close()
-            return list(reversed(messages))  # Возвращаем в хронологическом порядке
+
+        return messages
+
+    def save_context_snapshot(self, session_id, messages, token_count):
+        """Сохраняет снимок контекста модели для сессии (заменяя предыдущий)"""
+        context = self._pack(json.dumps(messages, ensure_ascii=False))
+        shard = self._shard(session_id)
+        with shard.lock:
+            conn = sqlite3.connect(shard.db_path)
+            cursor = conn.cursor()
+
+            cursor.execute('''
+                           INSERT OR REPLACE INTO context_snapshots
+                               (session_id, context, token_count, message_count, updated_at)
+                           VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)
+                           ''', (session_id, context, token_count, len(messages)))
+
+            conn.commit()
+            conn.close()
+
+    def get_context_snapshot(self, session_id):
+        """Снимок контекста {'messages', 'token_count'} или None, если его нет"""
+        shard = self._shard(session_id)
+        with shard.lock:
+            conn = sqlite3.connect(shard.db_path)
+            cursor = conn.cursor()
+
+            cursor.execute('SELECT context, token_count FROM context_snapshots WHERE session_id = ?',
+                           (session_id,))
+            row = cursor.fetchone()
+            conn.close()
+
+        if row is None:
+            return None
+        return {'messages': json.loads(unpack_text(row[0])), 'token_count': row[1]}
+
+    def get_attachment(self, blob_hash, session_id=None):
+        """Ленивое получение содержимого вложения по хешу.
+
+        Если передан session_id, вложение отдается только когда на него
+        ссылается сообщение этой сессии.
+        """
+        if session_id is None and self.router is not None:
+            # Без сессии неизвестно, в каком шарде искать
+            return None
+
+        shard = self._shard(session_id)
+        with shard.lock:
+            conn = sqlite3.connect(shard.db_path)
+            cursor = conn.cursor()
+
+            if session_id is not None:
+                table = self._messages_table(cursor, shard, session_id)
+                cursor.execute(f'''
+                               SELECT files
+                               FROM {table}
+                               WHERE session_id = ?
+                                 AND files IS NOT NULL
+                               ''', (session_id,))
+                if not any(blob_hash in _attachment_hashes(row[0]) for row in cursor.fetchall()):
+                    conn.close()
+                    return None
+
+            cursor.execute('SELECT content FROM attachment_blobs WHERE hash = ?', (blob_hash,))
+            row = cursor.fetchone()
+            conn.close()
+
+            return unpack_text(row[0]) if row else None
+
+    def migrate_inline_attachments(self, batch_size=200):
+        """Фоновая миграция: переносит встроенные в files вложения в attachment_blobs"""
+        stats = {'rows_updated': 0, 'files_moved': 0}
+        for shard in self._shards():
+            self._migrate_inline_attachments_shard(shard, stats, batch_size)
+        return stats
+
+    def _migrate_inline_attachments_shard(self, shard, stats, batch_size):
+        last_id = None
+
+        while True:
+            with shard.lock:
+                conn = sqlite3.connect(shard.db_path)
+                cursor = conn.cursor()
+
+                if last_id is None:
+                    last_id = int(_get_meta(cursor, 'attachments_watermark', 0))
+
+                cursor.execute('''
+                               SELECT id, files
+                               FROM chat_messages
+                               WHERE id > ?
+                                 AND files IS NOT NULL
+                               ORDER BY id
+                               LIMIT ?
+                               ''', (last_id, batch_size))
+                rows = cursor.fetchall()
+
+                for row_id, files_value in rows:
+                    last_id = row_id
+                    files = json.loads(unpack_text(files_value) or '[]')
+                    if not any(isinstance(f, dict) and 'content' in f for f in files):
+                        continue
+
+                    refs = _store_attachments(cursor, files, self._pack, references=True)
+                    cursor.execute('UPDATE chat_messages SET files = ? WHERE id = ?',
+                                   (self._pack(json.dumps(refs)), row_id))
+                    stats['rows_updated'] += 1
+                    stats['files_moved'] += len(refs)
+
+                _set_meta(cursor, 'attachments_watermark', last_id)
+                conn.commit()
+                conn.close()
+
+            if len(rows) < batch_size:
+                break
 
     def clear_session(self, session_id):
         """Очистить историю сессии"""
-        with self.lock:
-            conn = sqlite3.connect(self.db_path)
+        shard = self._shard(session_id)
+        with shard.lock:
+            conn = sqlite3.connect(shard.db_path)
             cursor = conn.cursor()
 
-            cursor.execute('DELETE FROM chat_messages WHERE session_id = ?', (session_id,))
+            table = self._messages_table(cursor, shard, session_id)
+            _release_attachments(cursor, 'session_id = ?', (session_id,), table=table)
+            cursor.execute(f'DELETE FROM {table} WHERE session_id = ?', (session_id,))
+            cursor.execute('DELETE FROM context_snapshots WHERE session_id = ?', (session_id,))
 
             conn.commit()
             conn.close()
 
+        self._invalidate_session(session_id)
+
     # В класс ChatDatabase добавить:
     def delete_session_messages(self, session_id):
         """Удаление всех сообщений сессии"""
-        with self.lock:
-            conn = sqlite3.connect(self.db_path)
+        shard = self._shard(session_id)
+        with shard.lock:
+            conn = sqlite3.connect(shard.db_path)
             cursor = conn.cursor()
 
-            cursor.execute('DELETE FROM chat_messages WHERE session_id = ?', (session_id,))
+            table = self._messages_table(cursor, shard, session_id)
+            _release_attachments(cursor, 'session_id = ?', (session_id,), table=table)
+            cursor.execute(f'DELETE FROM {table} WHERE session_id = ?', (session_id,))
+            cursor.execute('DELETE FROM context_snapshots WHERE session_id = ?', (session_id,))
             conn.commit()
             conn.close()
 
+        self._invalidate_session(session_id)
+
+    def compress_existing_messages(self, batch_size=200, from_start=False):
+        """Фоновая миграция: сжимает старые несжатые сообщения.
+
+        Работает пачками и отпускает блокировку между ними, чтобы не мешать
+        обычным запросам. Возвращает статистику сэкономленных байт.
+        """
+        stats = {'rows_scanned': 0, 'rows_updated': 0, 'bytes_before': 0, 'bytes_after': 0}
+        for shard in self._shards():
+            self._compress_shard(shard, stats, batch_size, from_start)
+
+        stats['bytes_saved'] = stats['bytes_before'] - stats['bytes_after']
+        return stats
+
+    def _compress_shard(self, shard, stats, batch_size, from_start):
+        last_id = None
+
+        while True:
+            with shard.lock:
+                conn = sqlite3.connect(shard.db_path)
+                cursor = conn.cursor()
+
+                if last_id is None:
+                    # Новые сообщения сжимаются при записи, поэтому продолжаем с прошлой отметки
+                    last_id = 0 if from_start else int(_get_meta(cursor, 'compress_watermark', 0))
+
+                cursor.execute('''
+                               SELECT id, content, thinking, files
+                               FROM chat_messages
+                               WHERE id > ?
+                               ORDER BY id
+                               LIMIT ?
+                               ''', (last_id, batch_size))
+                rows = cursor.fetchall()
+
+                for row_id, content, thinking, files_json in rows:
+                    last_id = row_id
+                    stats['rows_scanned'] += 1
+
+                    old_values = (content, thinking, files_json)
+                    new_values = tuple(pack_text(v, self.compress_threshold, self.compress_level)
+                                       for v in old_values)
+                    if new_values == old_values:
+                        continue
+
+                    stats['bytes_before'] += sum(stored_size(v) for v in old_values)
+                    stats['bytes_after'] += sum(stored_size(v) for v in new_values)
+                    stats['rows_updated'] += 1
+
+                    cursor.execute('''
+                                   UPDATE chat_messages
+                                   SET content  = ?,
+                                       thinking = ?,
+                                       files    = ?
+                                   WHERE id = ?
+                                   ''', (*new_values, row_id))
+
+                _set_meta(cursor, 'compress_watermark', last_id)
+                conn.commit()
+                conn.close()
+
+            if len(rows) < batch_size:
+                break
+
+    def get_compression_stats(self):
+        """Статистика сжатия новых сообщений с момента запуска"""
+        bytes_in = self.compression_stats['bytes_in']
+        bytes_stored = self.compression_stats['bytes_stored']
+        return {
+            'bytes_in': bytes_in,
+            'bytes_stored': bytes_stored,
+            'bytes_saved': bytes_in - bytes_stored,
+            'ratio': round(bytes_stored / bytes_in, 3) if bytes_in else 1.0
+        }
+
+    def _restore_session(self, cursor, shard, session_id):
+        """Переносит сообщения сессии из архива обратно в горячую БД"""
+        _attach_archive(cursor, shard.archive_path)
+        cursor.execute(f'''
+                       INSERT INTO main.chat_messages ({ARCHIVE_COLUMNS})
+                       SELECT {ARCHIVE_COLUMNS}
+                       FROM archive.chat_messages
+                       WHERE session_id = ?
+                       ''', (session_id,))
+        cursor.execute('DELETE FROM archive.chat_messages WHERE session_id = ?', (session_id,))
+        if self.router is None:
+            cursor.execute('UPDATE chat_sessions SET archived_at = NULL WHERE session_id = ?', (session_id,))
+        log.info("Сессия возвращена из архива", extra={'session_id': session_id})
+
+    def archive_idle_sessions(self, max_idle_days=90, batch_size=50):
+        """Переносит сессии, не обновлявшиеся дольше max_idle_days, в архивную БД.
+
+        Метаданные сессии остаются в chat_sessions (с отметкой archived_at),
+        а сообщения переезжают в отдельный файл. Вложения остаются в горячей БД.
+        """
+        if not self.archive_path:
+            return {'sessions_archived': 0, 'messages_archived': 0}
+
+        stats = {'sessions_archived': 0, 'messages_archived': 0}
+
+        while True:
+            with self.lock:
+                conn = sqlite3.connect(self.db_path)
+                cursor = conn.cursor()
+
+                cursor.execute('''
+                               SELECT session_id
+                               FROM chat_sessions
+                               WHERE archived_at IS NULL
+                                 AND updated_at < datetime('now', ?)
+                               LIMIT ?
+                               ''', (f'-{int(max_idle_days)} days', batch_size))
+                session_ids = [row[0] for row in cursor.fetchall()]
+                conn.close()
+
+            # Группируем сессии по файлам, в которых лежат их сообщения
+            by_shard = {}
+            for session_id in session_ids:
+                shard = self._shard(session_id)
+                by_shard.setdefault(shard.index, (shard, []))[1].append(session_id)
+
+            for shard, shard_sessions in by_shard.values():
+                stats['messages_archived'] += self._archive_sessions(shard, shard_sessions)
+                stats['sessions_archived'] += len(shard_sessions)
+
+            if len(session_ids) < batch_size:
+                break
+
+        return stats
+
+    def _archive_sessions(self, shard, session_ids):
+        """Переносит сообщения сессий одного файла в его архив"""
+        messages_archived = 0
+
+        with shard.lock:
+            conn = sqlite3.connect(shard.db_path)
+            cursor = conn.cursor()
+            _attach_archive(cursor, shard.archive_path)
+
+            try:
+                for session_id in session_ids:
+                    cursor.execute(f'''
+                                   INSERT INTO archive.chat_messages ({ARCHIVE_COLUMNS})
+                                   SELECT {ARCHIVE_COLUMNS}
+                                   FROM main.chat_messages
+                                   WHERE session_id = ?
+                                   ''', (session_id,))
+                    messages_archived += cursor.rowcount
+                    cursor.execute('DELETE FROM main.chat_messages WHERE session_id = ?', (session_id,))
+                    # Снимок не архивируется: после возврата контекст соберется из сообщений
+                    cursor.execute('DELETE FROM main.context_snapshots WHERE session_id = ?', (session_id,))
+                    if self.router is None:
+                        cursor.execute('''
+                                       UPDATE chat_sessions
+                                       SET archived_at = CURRENT_TIMESTAMP
+                                       WHERE session_id = ?
+                                       ''', (session_id,))
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            finally:
+                conn.close()
+
+        if self.router is not None:
+            for session_id in session_ids:
+                self.router.set_archived(session_id, True)
+
+        return messages_archived
+
+    def enable_incremental_vacuum(self):
+        """Переводит существующую БД в режим auto_vacuum=INCREMENTAL.
+
+        Для уже созданной БД режим применяется только после полного VACUUM,
+        поэтому вызывается один раз из фонового потока.
+        """
+        converted = False
+        targets = [(self.db_path, self.lock)]
+        if self.router is not None:
+            targets += [(shard.db_path, shard.lock) for shard in self.router.shards]
+
+        for path, lock in targets:
+            with lock:
+                conn = sqlite3.connect(path)
+                cursor = conn.cursor()
+
+                cursor.execute('PRAGMA auto_vacuum')
+                if cursor.fetchone()[0] != 2:
+                    cursor.execute('PRAGMA auto_vacuum = INCREMENTAL')
+                    cursor.execute('VACUUM')
+                    converted = True
+
+                conn.close()
+
+        return converted
+
+    def incremental_vacuum(self, max_pages=1000):
+        """Освобождает до max_pages свободных страниц в горячей и архивной БД"""
+        freed = {}
+        paths = [('main', self.db_path, self.lock)]
+        for shard in self._shards():
+            if self.router is not None:
+                paths.append((f'shard_{shard.index}', shard.db_path, shard.lock))
+            if shard.archive_path and os.path.exists(shard.archive_path):
+                name = 'archive' if self.router is None else f'archive_{shard.index}'
+                paths.append((name, shard.archive_path, shard.lock))
+
+        for name, path, lock in paths:
+            with lock:
+                conn = sqlite3.connect(path)
+                cursor = conn.cursor()
+
+                cursor.execute('PRAGMA freelist_count')
+                before = cursor.fetchone()[0]
+                cursor.execute(f'PRAGMA incremental_vacuum({int(max_pages)})')
+                cursor.fetchall()
+                cursor.execute('PRAGMA freelist_count')
+                after = cursor.fetchone()[0]
+
+                conn.close()
+                freed[name] = before - after
+
+        return freed
+
     def get_session_stats(self, session_id):
         """Получить статистику сессии"""
-        with self.lock:
-            conn = sqlite3.connect(self.db_path)
+        shard = self._shard(session_id)
+        with shard.lock:
+            conn = sqlite3.connect(shard.db_path)
             cursor = conn.cursor()
 
-            cursor.execute('''
+            table = self._messages_table(cursor, shard, session_id)
+            cursor.execute(f'''
                            SELECT COUNT(*)                                            as total_messages,
                                   SUM(CASE WHEN role = 'user' THEN 1 ELSE 0 END)      as user_messages,
                                   SUM(CASE WHEN role = 'assistant' THEN 1 ELSE 0 END) as assistant_messages,
                                   AVG(response_time)                                  as avg_response_time
-                           FROM chat_messages
+                           FROM {table}
                            WHERE session_id = ?
                            ''', (session_id,))
 
@@ -145,81 +790,87 @@ class ChatDatabase:
             }
 
 
+@instrument_methods(DB_LATENCY, DB_ERRORS)
+@trace_methods('db')
 class UserDatabase:
-    def __init__(self, db_path="chat_history.db"):
+    def __init__(self, db_path="chat_history.db", archive_path=None, router=None, cache=None):
         self.db_path = db_path
+        self.archive_path = archive_path
         self.lock = Lock()
+        self.router = router
+        self.cache = cache
         self.init_user_table()
 
     def init_user_table(self):
         """Инициализация таблицы пользователей"""
         with self.lock:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-
-            cursor.execute('''
-                           CREATE TABLE IF NOT EXISTS users
-                           (
-                               id            INTEGER PRIMARY KEY AUTOINCREMENT,
-                               username      TEXT UNIQUE NOT NULL,
-                               password_hash TEXT        NOT NULL,
-                               created_at    DATETIME DEFAULT CURRENT_TIMESTAMP,
-                               last_login    DATETIME
-                           )
-                           ''')
-
-            # Создаем таблицу для сессий чата
-            cursor.execute('''
-                           CREATE TABLE IF NOT EXISTS chat_sessions
-                           (
-                               id         INTEGER PRIMARY KEY AUTOINCREMENT,
-                               user_id    INTEGER     NOT NULL,
-                               session_id TEXT UNIQUE NOT NULL,
-                               title      TEXT     DEFAULT 'Новый чат',
-                               created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                               updated_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                               FOREIGN KEY (user_id) REFERENCES users (id)
-                           )
-                           ''')
-            cursor.execute('CREATE INDEX IF NOT EXISTS idx_session ON chat_messages(session_id)')
-            cursor.execute('CREATE INDEX IF NOT EXISTS idx_user ON chat_messages(user_id)')
-
-            # Проверяем, существует ли колонка user_id в chat_messages
-            cursor.execute("PRAGMA table_info(chat_messages)")
-            columns = [column[1] for column in cursor.fetchall()]
-
-            if 'user_id' not in columns:
-                cursor.execute('''
-                               ALTER TABLE chat_messages
-                                   ADD COLUMN user_id INTEGER DEFAULT NULL
-                               ''')
-                print("✅ Добавлена колонка user_id в таблицу chat_messages")
-
-            conn.commit()
-            conn.close()
+            ensure_schema(self.db_path)
 
     def delete_session(self, session_id):
         """Удаление сессии и всех её сообщений"""
+        owner = self.get_session_owner(session_id) if self.cache is not None else None
+
+        if self.router is not None:
+            self._delete_sharded_messages(session_id)
+
         with self.lock:
             conn = sqlite3.connect(self.db_path)
             cursor = conn.cursor()
 
             try:
-                # Сначала удаляем все сообщения сессии
-                cursor.execute('DELETE FROM chat_messages WHERE session_id = ?', (session_id,))
+                table = 'chat_messages'
+                if self.router is None and self.archive_path and _is_archived(cursor, session_id):
+                    _attach_archive(cursor, self.archive_path)
+                    table = 'archive.chat_messages'
+
+                # Сначала удаляем все сообщения сессии и освобождаем их вложения
+                _release_attachments(cursor, 'session_id = ?', (session_id,), table=table)
+                cursor.execute(f'DELETE FROM {table} WHERE session_id = ?', (session_id,))
+                cursor.execute('DELETE FROM context_snapshots WHERE session_id = ?', (session_id,))
 
                 # Затем удаляем саму сессию
                 cursor.execute('DELETE FROM chat_sessions WHERE session_id = ?', (session_id,))
 
                 conn.commit()
-                print(f"✅ Сессия {session_id} и все её сообщения удалены")
+                log.info("Сессия и все её сообщения удалены", extra={'session_id': session_id})
+
+            except Exception as e:
+                conn.rollback()
+                raise e
+            finally:
+                conn.close()
+
+        if self.cache is not None:
+            self.cache.invalidate(('messages', session_id), ('revision', session_id), ('owner', session_id),
+                                  ('sessions', owner))
+
+    def _delete_sharded_messages(self, session_id):
+        """Удаляет сообщения сессии из её шарда (до удаления записи из каталога)"""
+        shard = self.router.locate(session_id)
+        archived = bool(shard.archive_path) and self.router.is_archived(session_id)
+
+        with shard.lock:
+            conn = sqlite3.connect(shard.db_path)
+            cursor = conn.cursor()
+
+            try:
+                table = 'chat_messages'
+                if archived:
+                    _attach_archive(cursor, shard.archive_path)
+                    table = 'archive.chat_messages'
 
+                _release_attachments(cursor, 'session_id = ?', (session_id,), table=table)
+                cursor.execute(f'DELETE FROM {table} WHERE session_id = ?', (session_id,))
+                cursor.execute('DELETE FROM context_snapshots WHERE session_id = ?', (session_id,))
+                conn.commit()
             except Exception as e:
                 conn.rollback()
                 raise e
             finally:
                 conn.close()
 
+        self.router.forget_session(session_id)
+
     def verify_user(self, username, password):
         """Проверка пользователя"""
         with self.lock:
@@ -237,7 +888,8 @@ class UserDatabase:
                     try:
                         # Проверяем если это bcrypt хеш
                         if password_hash.startswith('$2b$') or password_hash.startswith('$2a$'):
-                            # Используем bcrypt для проверки
+                            # Используем bcrypt для проверки (импорт только при первом входе)
+                            import bcrypt
                             if bcrypt.checkpw(password.encode('utf-8'), password_hash.encode('utf-8')):
                                 # Обновляем время последнего входа
                                 cursor.execute('UPDATE users SET last_login = ? WHERE id = ?',
@@ -254,17 +906,18 @@ class UserDatabase:
                                 conn.commit()
                                 conn.close()
                                 return user_id
-                    except Exception as e:
-                        print(f"❌ Ошибка проверки пароля для пользователя {username}: {str(e)}")
+                    except Exception:
+                        log.exception("Ошибка проверки пароля", extra={'username': username})
                 else:
-                    print(f"❌ Пользователь {username} имеет пустой хеш пароля")
+                    log.warning("Пустой хеш пароля пользователя", extra={'username': username})
 
             conn.close()
             return None
 
     def create_session(self, user_id, title="Новый чат"):
         """Создание новой сессии чата"""
-        session_id = f"session_{user_id}_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+        # Суффикс нужен, чтобы две вкладки могли создать сессии в одну секунду
+        session_id = f"session_{user_id}_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:6]}"
 
         with self.lock:
             conn = sqlite3.connect(self.db_path)
@@ -278,10 +931,42 @@ class UserDatabase:
             conn.commit()
             conn.close()
 
+        if self.cache is not None:
+            self.cache.invalidate(('sessions', user_id))
+
         return session_id
 
+    def get_session_owner(self, session_id):
+        """user_id владельца сессии или None, если сессии нет"""
+        generation = None
+        if self.cache is not None:
+            owner = self.cache.get(('owner', session_id))
+            if owner is not None:
+                return owner
+            generation = self.cache.generation(('owner', session_id))
+
+        with self.lock:
+            conn = sqlite3.connect(self.db_path)
+            cursor = conn.cursor()
+
+            cursor.execute('SELECT user_id FROM chat_sessions WHERE session_id = ?', (session_id,))
+            row = cursor.fetchone()
+            conn.close()
+
+        owner = row[0] if row else None
+        if owner is not None and self.cache is not None:
+            self.cache.put(('owner', session_id), owner, generation)
+        return owner
+
     def get_user_sessions(self, user_id):
         """Получение всех сессий пользователя"""
+        generation = None
+        if self.cache is not None:
+            cached = self.cache.get(('sessions', user_id))
+            if cached is not None:
+                return list(cached)
+            generation = self.cache.generation(('sessions', user_id))
+
         with self.lock:
             conn = sqlite3.connect(self.db_path)
             cursor = conn.cursor()
@@ -303,7 +988,11 @@ class UserDatabase:
                 })
 
             conn.close()
-            return sessions
+
+        if self.cache is not None:
+            self.cache.put(('sessions', user_id), sessions, generation)
+            return list(sessions)
+        return sessions
 
     def update_session_title(self, session_id, title):
         """Обновление названия сессии"""
@@ -320,3 +1009,326 @@ class UserDatabase:
 
             conn.commit()
             conn.close()
+
+        if self.cache is not None:
+            self.cache.invalidate(('sessions', self.get_session_owner(session_id)))
+
+
+@instrument_methods(DB_LATENCY, DB_ERRORS)
+@trace_methods('db')
+class OperationDatabase:
+    """Очередь асинхронных операций в SQLite.
+
+    Задача захватывается воркером на время аренды (lease) и продлевается
+    heartbeat-ом. Если процесс воркера умер, аренда истекает и задачу
+    забирает любой другой воркер (в том числе из другого процесса).
+    """
+
+    def __init__(self, db_path="chat_history.db"):
+        self.db_path = db_path
+        self.lock = Lock()
+        with self.lock:
+            ensure_schema(self.db_path)
+
+    def create_operation(self, operation_id, user_id, session_id, created_at, payload=None):
+        payload_value = pack_text(json.dumps(payload, ensure_ascii=False)) if payload is not None else None
+
+        with self.lock:
+            conn = sqlite3.connect(self.db_path)
+            cursor = conn.cursor()
+
+            cursor.execute('''
+                           INSERT INTO operations (operation_id, user_id, session_id, status, created_at, payload)
+                           VALUES (?, ?, ?, 'pending', ?, ?)
+                           ''', (operation_id, user_id, session_id, created_at, payload_value))
+
+            conn.commit()
+            conn.close()
+
+    def claim_operation(self, worker_id, lease_seconds, max_attempts):
+        """Захватывает самую старую ожидающую задачу или задачу с истекшей арендой.
+
+        Возвращает (задача, список задач, проваленных из-за исчерпания попыток).
+        """
+        now = time.time()
+
+        with self.lock:
+            conn = sqlite3.connect(self.db_path)
+            cursor = conn.cursor()
+
+            try:
+                # Захват должен быть атомарным между процессами
+                cursor.execute('BEGIN IMMEDIATE')
+
+                # Задачи, чьи воркеры умерли слишком много раз, не перезапускаем
+                cursor.execute('''
+                               SELECT operation_id
+                               FROM operations
+                               WHERE status = 'running'
+                                 AND lease_expires < ?
+                                 AND attempts >= ?
+                               ''', (now, max_attempts))
+                exhausted = [row[0] for row in cursor.fetchall()]
+                for operation_id in exhausted:
+                    cursor.execute('''
+                                   UPDATE operations
+                                   SET status      = 'error',
+                                       error       = 'Операция прервана: обработчик остановился',
+                                       payload     = NULL,
+                                       lease_owner = NULL,
+                                       finished_at = ?
+                                   WHERE operation_id = ?
+                                   ''', (now, operation_id))
+
+                cursor.execute('''
+                               SELECT operation_id, user_id, session_id, status, payload, created_at, attempts
+                               FROM operations
+                               WHERE (status = 'pending' OR (status = 'running' AND lease_expires < ?))
+                                 -- Ходы одной сессии выполняются строго по очереди
+                                 AND session_id NOT IN (SELECT session_id
+                                                        FROM operations
+                                                        WHERE status = 'running'
+                                                          AND lease_expires >= ?)
+                               ORDER BY created_at
+                               LIMIT 1
+                               ''', (now, now))
+                row = cursor.fetchone()
+
+                job = None
+                if row is not None:
+                    operation_id, user_id, session_id, status, payload, created_at, attempts = row
+                    cursor.execute('''
+                                   UPDATE operations
+                                   SET status        = 'running',
+                                       lease_owner   = ?,
+                                       lease_expires = ?,
+                                       attempts      = attempts + 1,
+                                       started_at    = ?
+                                   WHERE operation_id = ?
+                                   ''', (worker_id, now + lease_seconds, now, operation_id))
+                    job = {
+                        'operation_id': operation_id,
+                        'user_id': user_id,
+                        'session_id': session_id,
+                        'payload': json.loads(unpack_text(payload)) if payload is not None else None,
+                        'created_at': created_at,
+                        'attempt': attempts + 1,
+                        'resumed': status == 'running'
+                    }
+
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            finally:
+                conn.close()
+
+        return job, exhausted
+
+    def queue_length(self, user_id=None):
+        """Количество задач, ожидающих воркера (всего или одного пользователя)"""
+        with self.lock:
+            conn = sqlite3.connect(self.db_path)
+            cursor = conn.cursor()
+
+            if user_id is None:
+                cursor.execute("SELECT COUNT(*) FROM operations WHERE status = 'pending'")
+            else:
+                cursor.execute("SELECT COUNT(*) FROM operations WHERE status = 'pending' AND user_id = ?",
+                               (user_id,))
+            count = cursor.fetchone()[0]
+            conn.close()
+
+        return count
+
+    def queue_position(self, operation_id):
+        """Место ожидающей задачи в очереди (с 1) или 0, если она уже не ждет"""
+        with self.lock:
+            conn = sqlite3.connect(self.db_path)
+            cursor = conn.cursor()
+
+            cursor.execute('''
+                           SELECT COUNT(*)
+                           FROM operations
+                           WHERE status = 'pending'
+                             AND created_at <= (SELECT created_at
+                                                FROM operations
+                                                WHERE operation_id = ?
+                                                  AND status = 'pending')
+                           ''', (operation_id,))
+            position = cursor.fetchone()[0]
+            conn.close()
+
+        return position
+
+    def cancel_operation(self, operation_id, finished_at):
+        """Отменяет задачу.
+
+        Ожидающая задача сразу получает статус cancelled ('cancelled'),
+        для выполняемой выставляется флаг, который увидит её воркер
+        ('requested'). Для завершенной или отсутствующей задачи - None.
+        """
+        with self.lock:
+            conn = sqlite3.connect(self.db_path)
+            cursor = conn.cursor()
+
+            cursor.execute('''
+                           UPDATE operations
+                           SET status      = 'cancelled',
+                               progress    = 'Отменено',
+                               finished_at = ?,
+                               payload     = NULL
+                           WHERE operation_id = ?
+                             AND status = 'pending'
+                           ''', (finished_at, operation_id))
+            outcome = 'cancelled' if cursor.rowcount else None
+
+            if outcome is None:
+                cursor.execute('''
+                               UPDATE operations
+                               SET cancel_requested = 1
+                               WHERE operation_id = ?
+                                 AND status = 'running'
+                               ''', (operation_id,))
+                outcome = 'requested' if cursor.rowcount else None
+
+            conn.commit()
+            conn.close()
+
+        return outcome
+
+    def cancel_requests(self, operation_ids):
+        """Задачи из operation_ids, для которых запрошена отмена"""
+        if not operation_ids:
+            return set()
+
+        with self.lock:
+            conn = sqlite3.connect(self.db_path)
+            cursor = conn.cursor()
+
+            placeholders = ','.join('?' * len(operation_ids))
+            cursor.execute(f'''
+                            SELECT operation_id
+                            FROM operations
+                            WHERE operation_id IN ({placeholders})
+                              AND cancel_requested = 1
+                            ''', list(operation_ids))
+            requested = {row[0] for row in cursor.fetchall()}
+            conn.close()
+
+        return requested
+
+    def renew_leases(self, operation_ids, worker_id, lease_seconds):
+        """Продлевает аренду задач воркера. Возвращает задачи, аренда которых сохранилась"""
+        if not operation_ids:
+            return set()
+
+        with self.lock:
+            conn = sqlite3.connect(self.db_path)
+            cursor = conn.cursor()
+
+            renewed = set()
+            for operation_id in operation_ids:
+                cursor.execute('''
+                               UPDATE operations
+                               SET lease_expires = ?
+                               WHERE operation_id = ?
+                                 AND lease_owner = ?
+                                 AND status = 'running'
+                               ''', (time.time() + lease_seconds, operation_id, worker_id))
+                if cursor.rowcount:
+                    renewed.add(operation_id)
+
+            conn.commit()
+            conn.close()
+
+        return renewed
+
+    def set_progress(self, operation_id, progress):
+        with self.lock:
+            conn = sqlite3.connect(self.db_path)
+            cursor = conn.cursor()
+
+            cursor.execute('UPDATE operations SET progress = ? WHERE operation_id = ?', (progress, operation_id))
+
+            conn.commit()
+            conn.close()
+
+    def finish_operation(self, operation_id, status, progress, result, error, finished_at, worker_id=None):
+        """Сохраняет итог операции (completed, error или cancelled).
+
+        С worker_id итог записывается, только если аренда еще принадлежит
+        этому воркеру - иначе задачу уже перезапустил другой.
+        """
+        result_value = pack_text(json.dumps(result, ensure_ascii=False)) if result is not None else None
+
+        with self.lock:
+            conn = sqlite3.connect(self.db_path)
+            cursor = conn.cursor()
+
+            cursor.execute('''
+                           UPDATE operations
+                           SET status      = ?,
+                               progress    = ?,
+                               result      = ?,
+                               error       = ?,
+                               finished_at = ?,
+                               payload     = NULL,
+                               lease_owner = NULL
+                           WHERE operation_id = ?
+                             AND (? IS NULL OR lease_owner = ?)
+                           ''', (status, progress, result_value, error, finished_at, operation_id,
+                                 worker_id, worker_id))
+            finished = cursor.rowcount > 0
+
+            conn.commit()
+            conn.close()
+
+        return finished
+
+    def get_operation(self, operation_id):
+        with self.lock:
+            conn = sqlite3.connect(self.db_path)
+            cursor = conn.cursor()
+
+            cursor.execute('''
+                           SELECT user_id, session_id, status, progress, result, error, created_at, finished_at
+                           FROM operations
+                           WHERE operation_id = ?
+                           ''', (operation_id,))
+            row = cursor.fetchone()
+            conn.close()
+
+        if row is None:
+            return None
+
+        user_id, session_id, status, progress, result, error, created_at, finished_at = row
+        return {
+            'operation_id': operation_id,
+            'user_id': user_id,
+            'session_id': session_id,
+            'status': status,
+            'progress': progress or '',
+            'result': json.loads(unpack_text(result)) if result is not None else None,
+            'error': error,
+            'created_at': created_at,
+            'finished_at': finished_at
+        }
+
+    def purge_operations(self, max_age_days=7):
+        """Удаляет завершенные операции старше max_age_days"""
+        with self.lock:
+            conn = sqlite3.connect(self.db_path)
+            cursor = conn.cursor()
+
+            cursor.execute('''
+                           DELETE FROM operations
+                           WHERE finished_at IS NOT NULL
+                             AND finished_at < ?
+                           ''', (time.time() - max_age_days * 86400,))
+            purged = cursor.rowcount
+
+            conn.commit()
+            conn.close()
+
+        return purged
@@ -1,26 +1,111 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-import ollama
+import logging
 import os
 import re
 import sys
 import time
 from pathlib import Path
 
+log = logging.getLogger(__name__)
+
+
+class ReasoningSplitter:
+    """Делит потоковый ответ модели на рассуждения (<think>...</think>) и ответ.
+
+    Тег может прийти разрезанным между фрагментами, поэтому возможное
+    начало тега придерживается до следующего фрагмента.
+    """
+
+    OPEN_TAG = '<think>'
+    CLOSE_TAG = '</think>'
+
+    def __init__(self):
+        self.in_reasoning = False
+        self._pending = ''
+
+    def feed(self, text):
+        """Возвращает список (вид, текст), где вид - 'reasoning' или 'token'"""
+        text = self._pending + text
+        self._pending = ''
+        parts = []
+
+        while text:
+            tag = self.CLOSE_TAG if self.in_reasoning else self.OPEN_TAG
+            kind = 'reasoning' if self.in_reasoning else 'token'
+            index = text.find(tag)
+
+            if index >= 0:
+                if index:
+                    parts.append((kind, text[:index]))
+                text = text[index + len(tag):]
+                self.in_reasoning = not self.in_reasoning
+                continue
+
+            # Хвост, совпадающий с началом тега, ждет продолжения
+            keep = 0
+            for length in range(min(len(tag) - 1, len(text)), 0, -1):
+                if tag.startswith(text[-length:]):
+                    keep = length
+                    break
+            if keep:
+                self._pending = text[-keep:]
+                text = text[:-keep]
+            if text:
+                parts.append((kind, text))
+            break
+
+        return parts
+
+    def flush(self):
+        """Придержанный хвост в конце ответа"""
+        text, self._pending = self._pending, ''
+        if not text:
+            return []
+        return [('reasoning' if self.in_reasoning else 'token', text)]
+
 
 class DeepSeekChatPersistent:
+    # Параметры генерации ответа
+    CHAT_OPTIONS = {
+        "temperature": 0.7,
+        "top_p": 0.9,
+        "num_ctx": 131072,
+        "keep_alive": "72h",  # Держим модель дольше
+    }
+
     def __init__(self, model_name="deepseek-r1:8b", max_context_tokens=128000):
         self.model_name = model_name
-        self.client = ollama.Client()
+        self._client = None
+        self._async_client = None
         self.conversation_history = []
         self.max_context_tokens = max_context_tokens
         self.model_loaded = False
+        # Версия контекста в общем хранилище, с которой он загружен (см. ContextStore)
+        self.context_version = None
+        # Статистика последнего хода от Ollama (см. _turn_stats)
+        self.last_turn = None
+
+    @property
+    def client(self):
+        """Клиент Ollama создается при первом обращении к модели"""
+        if self._client is None:
+            import ollama
+            self._client = ollama.Client()
+        return self._client
+
+    @property
+    def async_client(self):
+        """Асинхронный клиент Ollama для ASGI-режима (создается при первом обращении)"""
+        if self._async_client is None:
+            import ollama
+            self._async_client = ollama.AsyncClient()
+        return self._async_client
 
     def preload_model(self):
         """Предварительная загрузка модели в память"""
-        print(f"🔄 Загружаю модель {self.model_name} в память...")
-        print("⏱️  Это может занять несколько минут для больших моделей...")
+        log.info("Загружаю модель %s в память", self.model_name)
 
         try:
             # Отправляем простой запрос для загрузки модели
@@ -37,14 +122,15 @@ class DeepSeekChatPersistent:
             )
 
             load_time = time.time() - start_time
-            print(f"✅ Модель загружена за {load_time:.2f} секунд")
-            print(f"🤖 Ответ модели: {response['message']['content']}")
+            log.info("Модель загружена за %.2f с", load_time,
+                     extra={'model': self.model_name, 'load_seconds': round(load_time, 2)})
+            log.debug("Ответ модели: %s", response['message']['content'])
 
             self.model_loaded = True
             return True
 
-        except Exception as e:
-            print(f"❌ Ошибка загрузки модели: {str(e)}")
+        except Exception:
+            log.exception("Ошибка загрузки модели %s", self.model_name)
             return False
 
     def estimate_tokens(self, text):
@@ -64,16 +150,27 @@ class DeepSeekChatPersistent:
         max_history_tokens = int(self.max_context_tokens * 0.8)
 
         if current_tokens > max_history_tokens:
-            print(f"⚠️  Контекст переполнен ({current_tokens} токенов). Удаляю старые сообщения...")
-
             while len(self.conversation_history) > 2 and self.get_context_size() > max_history_tokens:
                 self.conversation_history.pop(0)
                 self.conversation_history.pop(0)
 
-            print(f"✅ Контекст сжат до {self.get_context_size()} токенов")
+            log.warning("Контекст переполнен: удалены старые сообщения",
+                        extra={'tokens_before': current_tokens, 'tokens_after': self.get_context_size()})
 
         return current_tokens
 
+    def export_context(self):
+        """Снимок текущего контекста: копия истории и её размер в токенах"""
+        return {
+            'messages': list(self.conversation_history),
+            'token_count': self.get_context_size()
+        }
+
+    def restore_context(self, messages):
+        """Заменяет контекст сохраненным снимком (без повторной отправки в модель)"""
+        self.conversation_history = list(messages)
+        self.manage_context()
+
     def load_file_content(self, file_path):
         """Загружает содержимое файла"""
         try:
@@ -120,69 +217,179 @@ class DeepSeekChatPersistent:
         processed_text = re.sub(pattern, replace_file_ref, text)
         return processed_text
 
-    def send_message(self, message):
-        """Отправляет сообщение в DeepSeek"""
+    def send_message(self, message, on_chunk=None, should_stop=None):
+        """Отправляет сообщение в DeepSeek.
+
+        С on_chunk ответ запрашивается потоком, и каждый фрагмент текста
+        передается в on_chunk по мере генерации. should_stop проверяется
+        после каждого фрагмента: если он вернул True, генерация прерывается,
+        ход удаляется из истории и возвращается None.
+        """
         if not self.model_loaded:
-            print("❌ Модель не загружена! Используйте /preload")
+            log.warning("Модель не загружена")
             return "Модель не загружена в память"
 
         try:
-            # Упрощенная обработка файлов
-            if "#file:" in message:
-                processed_message = self.process_file_references(message)
-            else:
-                processed_message = message
-
-            self.conversation_history.append({
-                "role": "user",
-                "content": processed_message
-            })
-
-            self.manage_context()
+            self._begin_turn(message)
 
             # Засекаем время ответа
             start_time = time.time()
 
-            print(f"🔄 Отправляю запрос в модель...")
+            log.info("Отправляю запрос в модель",
+                     extra={'event': 'model.request', 'mode': 'blocking' if on_chunk is None else 'stream',
+                            'messages': len(self.conversation_history)})
 
             # Убираем все таймауты для ollama - пусть работает сколько нужно
-            response = self.client.chat(
-                model=self.model_name,
-                messages=self.conversation_history,
-                options={
-                    "temperature": 0.7,
-                    "top_p": 0.9,
-                    "num_ctx": 131072,
-                    "keep_alive": "72h",  # Держим модель дольше
-                }
-            )
+            if on_chunk is None:
+                response = self.client.chat(
+                    model=self.model_name,
+                    messages=self.conversation_history,
+                    options=self.CHAT_OPTIONS
+                )
+                assistant_response = response['message']['content']
+                self.last_turn = self._turn_stats(response, 'blocking', start_time)
+            else:
+                assistant_response = self._stream_response(self.CHAT_OPTIONS, on_chunk, should_stop, start_time)
+                if assistant_response is None:
+                    # Закрытие потока останавливает генерацию в Ollama
+                    self.conversation_history.pop()
+                    log.info("Генерация отменена")
+                    return None
+
+            return self._end_turn(assistant_response, start_time)
 
-            response_time = time.time() - start_time
+        except Exception as e:
+            return self._turn_error(e)
+
+    async def send_message_async(self, message):
+        """Асинхронный вариант send_message для ASGI-режима: ожидание ответа не занимает поток"""
+        if not self.model_loaded:
+            log.warning("Модель не загружена")
+            return "Модель не загружена в память"
 
-            assistant_response = response['message']['content']
+        try:
+            self._begin_turn(message)
+            start_time = time.time()
 
-            # Сохраняем ответ в истории
-            self.conversation_history.append({
-                "role": "assistant",
-                "content": assistant_response
-            })
+            log.info("Отправляю запрос в модель", extra={'event': 'model.request', 'mode': 'async',
+                                                         'messages': len(self.conversation_history)})
 
-            print(f"⏱️  Время ответа: {response_time:.2f} секунд ({response_time / 60:.2f} минут)")
-            print(f"📊 Длина ответа: {len(assistant_response)} символов")
+            response = await self.async_client.chat(
+                model=self.model_name,
+                messages=self.conversation_history,
+                options=self.CHAT_OPTIONS
+            )
+            self.last_turn = self._turn_stats(response, 'async', start_time)
 
-            return assistant_response
+            return self._end_turn(response['message']['content'], start_time)
 
         except Exception as e:
-            error_msg = f"Ошибка при отправке сообщения: {str(e)}"
-            print(f"❌ {error_msg}")
-            import traceback
-            traceback.print_exc()
-            return error_msg
+            return self._turn_error(e)
+
+    def _begin_turn(self, message):
+        """Добавляет сообщение пользователя в контекст"""
+        self.last_turn = None
+        # Упрощенная обработка файлов
+        if "#file:" in message:
+            processed_message = self.process_file_references(message)
+        else:
+            processed_message = message
+
+        self.conversation_history.append({
+            "role": "user",
+            "content": processed_message
+        })
+
+        self.manage_context()
+
+    def _end_turn(self, assistant_response, start_time):
+        """Сохраняет ответ модели в контексте"""
+        response_time = time.time() - start_time
+
+        # Сохраняем ответ в истории
+        self.conversation_history.append({
+            "role": "assistant",
+            "content": assistant_response
+        })
+
+        log.info("Ответ модели за %.2f с, %d символов", response_time, len(assistant_response),
+                 extra={'event': 'model.response', 'response_seconds': round(response_time, 2)})
+
+        return assistant_response
+
+    def _turn_error(self, error):
+        error_msg = f"Ошибка при отправке сообщения: {str(error)}"
+        log.error(error_msg, exc_info=error)
+        return error_msg
+
+    def _stream_response(self, options, on_chunk, should_stop, start_time):
+        """Потоковый запрос к модели. Полный текст ответа или None, если генерация прервана"""
+        content = []
+        thinking = []
+        first_token_time = None
+
+        for chunk in self.client.chat(model=self.model_name, messages=self.conversation_history,
+                                      options=options, stream=True):
+            if chunk.get('done'):
+                # Последний фрагмент несет статистику генерации
+                self.last_turn = self._turn_stats(chunk, 'stream', start_time, first_token_time)
+
+            message = chunk['message']
+            if first_token_time is None and (message.get('thinking') or message.get('content')):
+                first_token_time = time.time()
+            # Новые версии Ollama отдают рассуждения отдельным полем
+            reasoning = message.get('thinking')
+            if reasoning:
+                if not thinking:
+                    on_chunk('<think>')
+                thinking.append(reasoning)
+                on_chunk(reasoning)
+
+            text = message.get('content')
+            if text:
+                if thinking and not content:
+                    on_chunk('</think>')
+                content.append(text)
+                on_chunk(text)
+
+            if should_stop is not None and should_stop():
+                return None
+
+        if thinking:
+            return f"<think>{''.join(thinking)}</think>{''.join(content)}"
+        return ''.join(content)
+
+    @staticmethod
+    def _turn_stats(response, mode, start_time, first_token_time=None):
+        """Статистика хода: токены и длительности Ollama (наносекунды) в секундах.
+
+        Без потока время до первого токена не наблюдаемо - берется оценка
+        Ollama: загрузка модели и обработка запроса.
+        """
+        def seconds(field):
+            value = response.get(field)
+            return value / 1e9 if value is not None else None
+
+        if first_token_time is not None:
+            first_token_seconds = first_token_time - start_time
+        elif response.get('prompt_eval_duration') is not None:
+            first_token_seconds = (seconds('load_duration') or 0) + seconds('prompt_eval_duration')
+        else:
+            first_token_seconds = None
+
+        return {
+            'mode': mode,
+            'first_token_seconds': first_token_seconds,
+            'total_seconds': time.time() - start_time,
+            'prompt_eval_tokens': response.get('prompt_eval_count'),
+            'eval_tokens': response.get('eval_count'),
+            'eval_seconds': seconds('eval_duration')
+        }
 
     def unload_model(self):
         """Выгружает модель из памяти """
         try:
-            print("🔄 Выгружаю модель из памяти...")
+            log.info("Выгружаю модель из памяти")
 
             # Устанавливаем keep_alive в 0 для немедленной выгрузки
             self.client.chat(
@@ -192,16 +399,15 @@ class DeepSeekChatPersistent:
             )
 
             self.model_loaded = False
-            print("✅ Модель выгружена из памяти")
+            log.info("Модель выгружена из памяти")
 
-        except Exception as e:
-            print(f"❌ Ошибка выгрузки модели: {str(e)}")
+        except Exception:
+            log.exception("Ошибка выгрузки модели")
 
     def clear_history(self):
         """Очищает историю разговора"""
         self.conversation_history = []
-        print("✅ История разговора очищена")
-        print(f"📊 Доступно токенов: {self.max_context_tokens}")
+        log.info("История разговора очищена")
 
     def show_status(self):
         """Показывает статус контекста и модели"""
@@ -323,6 +529,9 @@ def main():
     """Главная функция"""
     model_name = "deepseek-r1:8b"  # Можно изменить на любую модель
 
+    # В консоли сообщения движка выводятся как есть, без очереди и JSON
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
     chat = DeepSeekChatPersistent(model_name)
     chat.run()
 
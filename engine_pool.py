@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import time
+from collections import OrderedDict
+from threading import Lock
+
+from cache import estimate_size
+
+
+class _Entry:
+    def __init__(self, engine):
+        self.engine = engine
+        self.last_used = time.time()
+        self.in_use = 0  # сколько генераций сейчас работает с движком
+        self.size = estimate_size(engine.conversation_history)
+
+
+class EnginePool:
+    """Живые движки разговоров (DeepSeekChatPersistent) по session_id.
+
+    Движок создается при первом обращении к сессии и сразу получает
+    контекст из ContextStore. Снимок контекста пишется после каждого хода,
+    поэтому простаивающие движки и движки сверх лимитов по количеству и
+    памяти просто выгружаются - при следующем обращении контекст вернется
+    из снимка. Движки, с которыми идет генерация (acquire без release),
+    не вытесняются.
+
+    Флаг загрузки модели хранится в общем хранилище состояния (state):
+    модель одна на сервер Ollama, и её загрузка через один процесс видна
+    всем. Движок, контекст которого изменил другой процесс, при следующем
+    обращении перечитывает снимок (если с ним сейчас не идет генерация).
+    """
+
+    MODEL_LOADED_KEY = 'model_loaded'
+
+    def __init__(self, factory, contexts, state=None, max_engines=100, max_bytes=512 * 1024 * 1024,
+                 idle_timeout=1800):
+        self.factory = factory
+        self.contexts = contexts
+        self.state = state
+        self.max_engines = max_engines
+        self.max_bytes = max_bytes
+        self.idle_timeout = idle_timeout
+        self.lock = Lock()
+        self._entries = OrderedDict()  # session_id -> _Entry, от давно использованных к недавним
+        self._bytes = 0  # размер историй, пересчитывается после каждой генерации
+        # Без общего хранилища флаг живет в памяти процесса
+        self._model_loaded = False
+        self.evictions = 0
+        self.reloads = 0
+        # Сессии, снимок которых сейчас читается: число чтений и число discard() за это время.
+        # Снимок, прочитанный до очистки сессии, не вставляется; записи живут, пока идут чтения
+        self._restoring = {}
+        self._discards = {}
+
+    @property
+    def model_loaded(self):
+        """Модель одна на сервер Ollama, поэтому флаг общий для всех движков (и процессов)"""
+        if self.state is None:
+            return self._model_loaded
+        return bool(self.state.get(self.MODEL_LOADED_KEY, False))
+
+    def _entry(self, session_id, use=0):
+        """Запись движка сессии; use - на сколько увеличить in_use (под той же блокировкой).
+
+        Создание движка и чтение снимка и версии контекста (БД, общее
+        хранилище) идут вне self.lock: восстановление одной сессии не
+        задерживает обращения к остальным. Под блокировкой движок только
+        вставляется - с повторной проверкой, не вставил ли его другой поток.
+        Устаревший движок заменяется новым, а не перечитывается на месте:
+        пока снимок читается, с прежним движком могут начать генерацию.
+        """
+        model_loaded = self.model_loaded
+        while True:
+            with self.lock:
+                entry = self._entries.get(session_id)
+
+            restored = None
+            if entry is None or (not entry.in_use and self.contexts.is_stale(session_id, entry.engine)):
+                restored = self._restore(session_id)
+
+            with self.lock:
+                fresh = None
+                if restored is not None:
+                    fresh, generation = restored
+                    if self._finish_restore(session_id, generation):
+                        # Пока читался снимок, сессию очистили: он мог устареть
+                        continue
+                current = self._entries.get(session_id)
+                if fresh is not None and (current is None or (current is entry and not current.in_use)):
+                    replacement = _Entry(fresh)
+                    if current is not None:
+                        # Сессию продолжили в другом процессе
+                        self._bytes -= current.size
+                        self.reloads += 1
+                    self._bytes += replacement.size
+                    self._entries[session_id] = current = replacement
+                elif current is None:
+                    # Свежий движок вытеснили, пока проверялась версия
+                    current = entry
+                    self._bytes += current.size
+                    self._entries[session_id] = current
+                current.engine.model_loaded = model_loaded
+                current.in_use += use
+                self._entries.move_to_end(session_id)
+                current.last_used = time.time()
+                return current
+
+    def _restore(self, session_id):
+        """Новый движок со снимком сессии (вне self.lock): (движок, поколение discard() сессии)"""
+        with self.lock:
+            self._restoring[session_id] = self._restoring.get(session_id, 0) + 1
+            generation = self._discards.get(session_id, 0)
+        try:
+            engine = self.factory()
+            self.contexts.restore(session_id, engine)
+        except Exception:
+            with self.lock:
+                self._finish_restore(session_id, generation)
+            raise
+        return engine, generation
+
+    def _finish_restore(self, session_id, generation):
+        """Завершает чтение снимка (под self.lock). Истина, если сессию за это время очистили"""
+        discarded = self._discards.get(session_id, 0) != generation
+        self._restoring[session_id] -= 1
+        if not self._restoring[session_id]:
+            del self._restoring[session_id]
+            self._discards.pop(session_id, None)
+        return discarded
+
+    def get(self, session_id):
+        """Движок сессии (создается и восстанавливается из снимка при необходимости)"""
+        engine = self._entry(session_id).engine
+        self.evict()
+        return engine
+
+    def acquire(self, session_id):
+        """Движок для генерации: не будет вытеснен до release()"""
+        entry = self._entry(session_id, use=1)
+        self.evict()
+        return entry.engine
+
+    def release(self, session_id):
+        with self.lock:
+            entry = self._entries.get(session_id)
+            if entry is not None:
+                entry.in_use = max(0, entry.in_use - 1)
+                entry.last_used = time.time()
+                size = estimate_size(entry.engine.conversation_history)
+                self._bytes += size - entry.size
+                entry.size = size
+        self.evict()
+
+    def discard(self, session_id):
+        """Выгружает движок без сохранения (сессия очищена или удалена)"""
+        with self.lock:
+            if session_id in self._restoring:
+                self._discards[session_id] = self._discards.get(session_id, 0) + 1
+            entry = self._entries.pop(session_id, None)
+            if entry is not None:
+                self._bytes -= entry.size
+
+    def set_model_loaded(self, loaded):
+        if self.state is not None:
+            self.state.set(self.MODEL_LOADED_KEY, loaded)
+        with self.lock:
+            self._model_loaded = loaded
+            for entry in self._entries.values():
+                entry.engine.model_loaded = loaded
+
+    def evict(self):
+        """Выгружает простаивающие движки и движки сверх лимитов. Возвращает их количество"""
+        now = time.time()
+        evicted = 0
+
+        with self.lock:
+            for session_id, entry in list(self._entries.items()):
+                if entry.in_use:
+                    continue
+                over_limit = len(self._entries) > self.max_engines or self._bytes > self.max_bytes
+                if not over_limit and now - entry.last_used < self.idle_timeout:
+                    # Дальше только более свежие движки
+                    break
+                del self._entries[session_id]
+                self._bytes -= entry.size
+                evicted += 1
+
+            self.evictions += evicted
+
+        return evicted
+
+    def stats(self):
+        with self.lock:
+            return {
+                'engines': len(self._entries),
+                'busy': sum(1 for entry in self._entries.values() if entry.in_use),
+                'bytes': self._bytes,
+                'max_engines': self.max_engines,
+                'evictions': self.evictions,
+                'reloads': self.reloads
+            }
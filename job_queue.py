@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+
+log = logging.getLogger(__name__)
+
+
+class JobWorkerPool:
+    """Пул потоков, выполняющих задачи из очереди операций.
+
+    Воркеры захватывают задачи из БД с арендой на lease_seconds. Общий
+    heartbeat-поток продлевает аренду выполняемых задач каждые
+    lease_seconds / 3 и заодно передает обработчикам отмену, запрошенную
+    через другие процессы. Если процесс остановился, аренда истекает, и задачу
+    забирает любой воркер (этого или другого процесса) - не больше
+    max_attempts раз, после чего она завершается ошибкой.
+
+    handler(operation, payload, registry) выполняет задачу и выставляет
+    operation.status / result / error; итог сохраняет пул.
+
+    Количество потоков фиксировано, а длина очереди ограничена max_queue
+    (всего) и max_queue_per_user: admit() отказывает новым задачам сверх
+    лимита, не давая очереди расти без границ.
+    """
+
+    def __init__(self, registry, handler, workers=2, lease_seconds=60, poll_interval=1.0, max_attempts=2,
+                 max_queue=100, max_queue_per_user=5):
+        self.registry = registry
+        self.handler = handler
+        self.workers = workers
+        self.lease_seconds = lease_seconds
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self.max_queue = max_queue
+        self.max_queue_per_user = max_queue_per_user
+        self.rejected = 0
+        self.started_at = time.time()
+        # Статистика по воркерам: каждый поток пишет только свою запись
+        self._worker_stats = [{'jobs': 0, 'errors': 0, 'busy_seconds': 0.0, 'last_job_seconds': 0.0,
+                               'queue_wait_seconds': 0.0, 'max_queue_wait_seconds': 0.0}
+                              for _ in range(workers)]
+        # Уникален для процесса: по нему БД отличает аренду этого пула
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+        self._wakeup = threading.Condition()
+        self._running = {}  # operation_id -> AsyncOperation
+        self._running_lock = threading.Lock()
+        self._threads = []
+
+    def start(self):
+        for index in range(self.workers):
+            thread = threading.Thread(target=self._worker, args=(index,), name=f'job-worker-{index}')
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+        thread = threading.Thread(target=self._heartbeat, name='job-heartbeat')
+        thread.daemon = True
+        thread.start()
+        self._threads.append(thread)
+
+    def admit(self, user_id):
+        """None, если задачу можно поставить в очередь, иначе причина отказа.
+
+        Лимиты проверяются по БД и общие для всех процессов, но без
+        блокировки - при одновременной постановке возможно небольшое превышение.
+        """
+        store = self.registry.store
+        if self.max_queue_per_user and store.queue_length(user_id) >= self.max_queue_per_user:
+            reason = f"У вас уже {self.max_queue_per_user} сообщений в очереди - дождитесь ответов"
+        elif self.max_queue and store.queue_length() >= self.max_queue:
+            reason = "Сервер перегружен, попробуйте позже"
+        else:
+            return None
+
+        self.rejected += 1
+        return reason
+
+    def notify(self):
+        """Будит свободный воркер (задача поставлена этим процессом)"""
+        with self._wakeup:
+            self._wakeup.notify()
+
+    def _worker(self, index):
+        while True:
+            try:
+                operation, payload = self.registry.claim(self.worker_id, self.lease_seconds, self.max_attempts)
+            except Exception:
+                log.exception("Ошибка захвата задачи")
+                operation = None
+
+            if operation is None:
+                with self._wakeup:
+                    self._wakeup.wait(self.poll_interval)
+                continue
+
+            self._run(operation, payload, self._worker_stats[index])
+
+    def _run(self, operation, payload, stats):
+        started = time.time()
+        queue_wait = started - operation.start_time
+        stats['queue_wait_seconds'] += queue_wait
+        stats['max_queue_wait_seconds'] = max(stats['max_queue_wait_seconds'], queue_wait)
+
+        if operation.attempt > 1:
+            log.warning("Возобновляю задачу после сбоя",
+                        extra={'operation_id': operation.operation_id, 'attempt': operation.attempt})
+
+        with self._running_lock:
+            self._running[operation.operation_id] = operation
+
+        try:
+            self.handler(operation, payload, self.registry)
+        except Exception as e:
+            operation.status = "error"
+            operation.error = str(e)
+            log.exception("Ошибка выполнения задачи", extra={'operation_id': operation.operation_id})
+        finally:
+            elapsed = time.time() - started
+            stats['jobs'] += 1
+            stats['errors'] += operation.status == "error"
+            stats['busy_seconds'] += elapsed
+            stats['last_job_seconds'] = elapsed
+
+            with self._running_lock:
+                self._running.pop(operation.operation_id, None)
+            try:
+                self.registry.finish(operation, self.worker_id)
+            except Exception:
+                # Итог не записан: задача будет перезапущена после истечения аренды
+                log.exception("Не удалось сохранить итог задачи", extra={'operation_id': operation.operation_id})
+
+    def _heartbeat(self):
+        while True:
+            time.sleep(self.lease_seconds / 3)
+
+            with self._running_lock:
+                operation_ids = list(self._running)
+
+            try:
+                renewed = self.registry.store.renew_leases(operation_ids, self.worker_id, self.lease_seconds)
+            except Exception:
+                log.exception("Ошибка продления аренды задач")
+                continue
+
+            for operation_id in set(operation_ids) - renewed:
+                log.warning("Аренда задачи потеряна - её выполняет другой воркер", extra={'operation_id': operation_id})
+
+            try:
+                # Отмену, запрошенную через другой процесс, видно только в БД
+                self.registry.request_cancel(self.registry.store.cancel_requests(renewed))
+            except Exception:
+                log.exception("Ошибка проверки отмены задач")
+
+    def stats(self):
+        with self._running_lock:
+            running = len(self._running)
+
+        uptime = time.time() - self.started_at
+        workers = []
+        for index, stats in enumerate(self._worker_stats):
+            jobs = stats['jobs']
+            workers.append({
+                'worker': index,
+                'jobs': jobs,
+                'errors': stats['errors'],
+                'busy_seconds': round(stats['busy_seconds'], 2),
+                'utilization': round(stats['busy_seconds'] / uptime, 3) if uptime else 0.0,
+                'last_job_seconds': round(stats['last_job_seconds'], 2),
+                'avg_queue_wait_seconds': round(stats['queue_wait_seconds'] / jobs, 2) if jobs else 0.0,
+                'max_queue_wait_seconds': round(stats['max_queue_wait_seconds'], 2)
+            })
+
+        return {
+            'worker_id': self.worker_id,
+            'workers': self.workers,
+            'running': running,
+            'queue_length': self.registry.store.queue_length(),
+            'max_queue': self.max_queue,
+            'rejected': self.rejected,
+            'per_worker': workers
+        }
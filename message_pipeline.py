@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import logging
+import re
+import time
+from contextlib import contextmanager
+
+from metrics import observe_turn
+from tracing import span, TRACER
+
+THINK_PATTERN = re.compile(r'<think>(.*?)</think>', re.DOTALL)
+MAX_ATTACHMENT_CHARS = 200000
+
+log = logging.getLogger(__name__)
+
+
+class StageTimer:
+    """Время этапов одного хода в миллисекундах.
+
+    Этапы в порядке выполнения; повторный этап с тем же именем суммируется.
+    Таймер асинхронного хода передается в задачу через payload (timings).
+    Внутри трассы каждый этап - спан (см. tracing).
+    """
+
+    def __init__(self, timings=None):
+        self.timings = dict(timings or {})
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            with span(name):
+                yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def add(self, name, seconds):
+        self.timings[name] = round(self.timings.get(name, 0) + seconds * 1000, 2)
+
+    def summary(self):
+        return ', '.join(f"{name} {ms:.0f} мс" for name, ms in self.timings.items())
+
+
+class MessagePipeline:
+    """Этапы обработки сообщения, общие для всех путей отправки.
+
+    Синхронный /send_message (WSGI и ASGI) и задача очереди
+    (/send_message_async, WebSocket) различаются только вызовом модели:
+        prepare - вложения в текст запроса, сохранение сообщения пользователя;
+        finish  - название сессии, разбор <think>, markdown, сохранение ответа
+                  и снимка контекста.
+    Время каждого этапа попадает в ответ и в сохраненное сообщение ассистента.
+    """
+
+    def __init__(self, db, user_db, contexts, renderer):
+        self.db = db
+        self.user_db = user_db
+        self.contexts = contexts
+        self.renderer = renderer
+
+    @staticmethod
+    def build_prompt(message, files_content):
+        """Текст запроса к модели: содержимое прикрепленных файлов перед сообщением"""
+        if not files_content:
+            return message
+
+        file_texts = []
+        for file_data in files_content:
+            filename = file_data.get('name', 'unknown')
+            content = file_data.get('content', '')
+
+            if len(content) > MAX_ATTACHMENT_CHARS:
+                content = content[:MAX_ATTACHMENT_CHARS] + "\n\n[... файл обрезан из-за большого размера ...]"
+
+            file_text = f"[Файл: {filename}]\n"
+            file_text += f"[Размер: {len(content)} символов]\n"
+            file_text += "--- СОДЕРЖИМОЕ ФАЙЛА ---\n"
+            file_text += content
+            file_text += "\n--- КОНЕЦ ФАЙЛА ---\n\n"
+            file_texts.append(file_text)
+
+        return ''.join(file_texts) + message
+
+    @staticmethod
+    def split_thinking(response):
+        """(рассуждения, ответ) из текста модели с блоком <think>"""
+        thinking_text = ""
+        final_response = response
+
+        thinking_match = THINK_PATTERN.search(response)
+        if thinking_match:
+            thinking_text = thinking_match.group(1).strip()
+            final_response = THINK_PATTERN.sub('', response).strip()
+
+        if not final_response.strip():
+            final_response = "Извините, произошла ошибка при обработке ответа."
+        return thinking_text, final_response
+
+    def prepare(self, session_id, user_id, message, files_content, timer):
+        """Текст запроса к модели; сообщение пользователя сохраняется до вызова модели"""
+        with timer.stage('attachments'):
+            prompt = self.build_prompt(message, files_content)
+
+        with timer.stage('save_user'):
+            self.db.save_message(session_id, 'user', message, files=files_content, user_id=user_id)
+        return prompt
+
+    def render(self, text):
+        """HTML ответа модели или None при ошибке конвертации"""
+        try:
+            return self.renderer.render(text)
+        except Exception:
+            log.exception("Ошибка конвертации markdown")
+            return None
+
+    def finish(self, session_id, user_id, original_message, response, response_time, engine, timer):
+        """Сохраняет ответ модели, возвращает данные ответа клиенту"""
+        with timer.stage('title'):
+            # Первый ход сессии дает ей название. Ответ этого хода еще не сохранен,
+            # а сообщения пользователя из очереди могут уже лежать в истории
+            if not self.db.has_answer(session_id):
+                title = original_message[:50] + ('...' if len(original_message) > 50 else '')
+                self.user_db.update_session_title(session_id, title)
+
+        with timer.stage('parse'):
+            thinking_text, final_response = self.split_thinking(response)
+
+        with timer.stage('render'):
+            html_response = self.render(final_response)
+
+        # В сообщении - этапы до его сохранения, в ответе клиенту - все
+        with timer.stage('save_assistant'):
+            self.db.save_message(session_id, 'assistant', final_response, thinking_text, response_time,
+                                 files=None, user_id=user_id, html=html_response, timings=timer.timings)
+
+        with timer.stage('context'):
+            self.contexts.save(session_id, engine)
+        observe_turn(engine.last_turn, timer.timings)
+        if engine.last_turn:
+            TRACER.current().set(**{f"model.{key}": value for key, value in engine.last_turn.items()})
+
+        log.info("Ответ готов: %d символов, этапы: %s", len(final_response), timer.summary(),
+                 extra={'event': 'turn.finished', 'session_id': session_id, 'timings': timer.timings})
+
+        return {
+            'success': True,
+            'thinking': thinking_text,
+            'response': final_response,
+            'response_time': round(response_time, 2),
+            'session_id': session_id,
+            'html_response': html_response if html_response is not None else final_response,
+            'timings': timer.timings
+        }
@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Метрики процесса в текстовом формате Prometheus (/metrics).
+
+Счетчики и гистограммы собираются в памяти процесса: наблюдение - это
+поиск корзины и инкремент под блокировкой метрики, без внешних сервисов.
+Значения, которые уже ведут сами компоненты (кеши, пул движков,
+операции), не дублируются: их снимают коллекторы в момент запроса
+/metrics. При нескольких воркерах (gunicorn -w N) у каждого процесса
+свои метрики: /metrics отдает метрики обслужившего запрос процесса.
+"""
+
+import functools
+import logging
+import math
+import time
+import types
+from bisect import bisect_left
+from threading import Lock
+
+log = logging.getLogger(__name__)
+
+# Корзины по умолчанию: от миллисекунд (БД) до десятков минут (генерация)
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+DB_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5)
+TOKEN_BUCKETS = (16, 64, 256, 1024, 4096, 16384, 32768, 65536, 131072)
+RATE_BUCKETS = (1, 2.5, 5, 10, 20, 30, 50, 75, 100, 150, 250)
+
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    pairs.extend(f'{name}="{_escape(value)}"' for name, value in extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self.lock = Lock()
+        self._values = {}  # кортеж значений меток -> значение
+
+    def _key(self, labels):
+        if len(labels) != len(self.label_names):
+            raise ValueError(f"{self.name}: ожидаются метки {self.label_names}")
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def samples(self):
+        """[(суффикс имени, значения меток, доп. метки, значение)]"""
+        with self.lock:
+            return [('', key, (), value) for key, value in self._values.items()]
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self._values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(_Metric):
+    """Гистограмма с фиксированными корзинами: счетчики корзин, сумма и количество"""
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            state = self._values.get(key)
+            if state is None:
+                # Счетчики корзин (последняя - +Inf), сумма, количество
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    def samples(self):
+        with self.lock:
+            snapshot = [(key, list(state[0]), state[1], state[2]) for key, state in self._values.items()]
+
+        samples = []
+        for key, counts, total, count in snapshot:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (math.inf,), counts):
+                cumulative += bucket_count
+                samples.append(('_bucket', key, (('le', _format_value(float(bound))),), cumulative))
+            samples.append(('_sum', key, (), total))
+            samples.append(('_count', key, (), count))
+        return samples
+
+
+class MetricsRegistry:
+    """Метрики процесса и коллекторы значений, снимаемых при запросе.
+
+    Коллектор - функция без аргументов, возвращающая список
+    (имя, тип, описание, [({метки}, значение)]).
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self._metrics = {}
+        self._collectors = []
+
+    def _register(self, metric):
+        with self.lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"Метрика {metric.name} уже зарегистрирована")
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, documentation, labels=()):
+        return self._register(Counter(name, documentation, labels))
+
+    def gauge(self, name, documentation, labels=()):
+        return self._register(Gauge(name, documentation, labels))
+
+    def histogram(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        return self._register(Histogram(name, documentation, labels, buckets))
+
+    def add_collector(self, collector):
+        with self.lock:
+            self._collectors.append(collector)
+
+    def render(self):
+        """Все метрики в текстовом формате Prometheus 0.0.4"""
+        with self.lock:
+            metrics = list(self._metrics.values())
+            collectors = list(self._collectors)
+
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for suffix, key, extra, value in metric.samples():
+                labels = _format_labels(metric.label_names, key, extra)
+                lines.append(f"{metric.name}{suffix}{labels} {_format_value(value)}")
+
+        for collector in collectors:
+            try:
+                families = collector()
+            except Exception:
+                # Сбой одного коллектора не ломает сбор остальных метрик
+                log.exception("Ошибка сбора метрик %s", getattr(collector, '__name__', collector))
+                continue
+            for name, kind, documentation, samples in families:
+                lines.append(f"# HELP {name} {documentation}")
+                lines.append(f"# TYPE {name} {kind}")
+                for labels, value in samples:
+                    lines.append(f"{name}{_format_labels(labels.keys(), labels.values())} {_format_value(value)}")
+
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = MetricsRegistry()
+
+DB_LATENCY = REGISTRY.histogram('chat_db_operation_seconds', 'Длительность операций database.py',
+                                labels=('method',), buckets=DB_BUCKETS)
+DB_ERRORS = REGISTRY.counter('chat_db_operation_errors_total', 'Операции database.py, завершившиеся исключением',
+                             labels=('method',))
+
+STAGE_LATENCY = REGISTRY.histogram('chat_stage_seconds', 'Длительность этапов обработки сообщения',
+                                   labels=('stage',))
+QUEUE_WAIT = REGISTRY.histogram('chat_queue_wait_seconds', 'Ожидание задачи в очереди до начала обработки')
+TIME_TO_FIRST_TOKEN = REGISTRY.histogram('chat_time_to_first_token_seconds',
+                                         'Время до первого токена ответа модели', labels=('mode',))
+GENERATION_TIME = REGISTRY.histogram('chat_generation_seconds', 'Полное время генерации ответа моделью',
+                                     labels=('mode',))
+TOKENS_PER_SECOND = REGISTRY.histogram('chat_generation_tokens_per_second', 'Скорость генерации ответа',
+                                       labels=('mode',), buckets=RATE_BUCKETS)
+PROMPT_TOKENS = REGISTRY.histogram('chat_prompt_eval_tokens', 'Токены запроса, обработанные моделью за ход',
+                                   buckets=TOKEN_BUCKETS)
+PROMPT_TOKENS_TOTAL = REGISTRY.counter('chat_prompt_eval_tokens_total', 'Токены запросов, обработанные моделью')
+GENERATED_TOKENS_TOTAL = REGISTRY.counter('chat_generated_tokens_total', 'Токены ответов, сгенерированные моделью')
+TURNS_TOTAL = REGISTRY.counter('chat_turns_total', 'Завершенные ходы разговора', labels=('mode',))
+
+
+def instrument_methods(histogram, errors=None):
+    """Декоратор класса: время каждого публичного метода в histogram с меткой method='Класс.метод'"""
+    def decorate(cls):
+        for name, attribute in list(vars(cls).items()):
+            # Только обычные методы: staticmethod и property остаются как есть
+            if name.startswith('_') or not isinstance(attribute, types.FunctionType):
+                continue
+            setattr(cls, name, _timed(attribute, histogram, errors, f"{cls.__name__}.{name}"))
+        return cls
+    return decorate
+
+
+def _timed(function, histogram, errors, label):
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        except Exception:
+            if errors is not None:
+                errors.inc(method=label)
+            raise
+        finally:
+            histogram.observe(time.perf_counter() - start, method=label)
+    return wrapper
+
+
+def observe_turn(stats, timings):
+    """Метрики завершенного хода: статистика модели (engine.last_turn) и этапы StageTimer (мс).
+
+    mode - способ вызова модели: blocking, stream (очередь) или async (ASGI).
+    Без статистики (ошибка вызова модели) учитываются только этапы.
+    """
+    for stage, ms in timings.items():
+        STAGE_LATENCY.observe(ms / 1000, stage=stage)
+    if 'queue' in timings:
+        QUEUE_WAIT.observe(timings['queue'] / 1000)
+
+    if not stats:
+        return
+    mode = stats['mode']
+    TURNS_TOTAL.inc(mode=mode)
+    if stats.get('first_token_seconds') is not None:
+        TIME_TO_FIRST_TOKEN.observe(stats['first_token_seconds'], mode=mode)
+    if stats.get('total_seconds') is not None:
+        GENERATION_TIME.observe(stats['total_seconds'], mode=mode)
+
+    prompt_tokens = stats.get('prompt_eval_tokens')
+    if prompt_tokens is not None:
+        PROMPT_TOKENS.observe(prompt_tokens)
+        PROMPT_TOKENS_TOTAL.inc(prompt_tokens)
+
+    eval_tokens = stats.get('eval_tokens')
+    if eval_tokens:
+        GENERATED_TOKENS_TOTAL.inc(eval_tokens)
+        if stats.get('eval_seconds'):
+            TOKENS_PER_SECOND.observe(eval_tokens / stats['eval_seconds'], mode=mode)
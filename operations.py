@@ -0,0 +1,341 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import time
+import uuid
+from collections import OrderedDict
+from threading import Condition, Lock
+
+FINISHED_STATUSES = ('completed', 'error', 'cancelled')
+
+
+class AsyncOperation:
+    def __init__(self, operation_id, user_id=None, session_id=None):
+        self.operation_id = operation_id
+        self.user_id = user_id
+        self.session_id = session_id
+        self.status = "pending"  # pending, running, completed, error, cancelled
+        self.progress = ""
+        self.result = None
+        self.error = None
+        self.start_time = time.time()
+        self.finished_at = None
+        self.fetched_at = None  # когда клиент впервые получил итог
+        self.attempt = 0  # номер попытки выполнения (больше 1 - задача возобновлена после сбоя)
+        self.cancel_requested = False  # обработчик прерывает генерацию при первой возможности
+        self.events = []  # фрагменты ответа по мере генерации: (вид, текст), только в процессе воркера
+
+
+def operation_response(operation_id, status, progress, elapsed_time, result=None, error=None):
+    """Ответ /operation_status"""
+    response = {
+        'operation_id': operation_id,
+        'status': status,
+        'progress': progress,
+        'elapsed_time': round(elapsed_time, 2)
+    }
+
+    if status == "completed":
+        response['result'] = result
+    elif status == "error":
+        response['error'] = error
+
+    return response
+
+
+class _Waiters:
+    """Ожидающие одной операции.
+
+    Смена статуса или прогресса будит всех ожидающих и слушателей
+    операции, новый фрагмент ответа - только ожидающих фрагментов
+    (wait с offset). Оба условия делят одну блокировку.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.status_changed = Condition(self.lock)
+        self.events_added = Condition(self.lock)
+        self.status_version = 0  # счетчики изменений: уведомление не теряется между чтением и ожиданием
+        self.events_version = 0
+        self.waiting = 0  # потоков в wait()
+        self.listeners = []
+
+    def version(self, events):
+        return self.status_version + (self.events_version if events else 0)
+
+
+class OperationRegistry:
+    """Реестр асинхронных операций с ограничением по размеру и времени жизни.
+
+    Операция - это задача в очереди OperationDatabase: создается в одном
+    процессе, выполняется воркером любого процесса. В памяти хранятся
+    операции, выполняемые этим процессом, и недавно завершенные; итог
+    сохраняется в БД. Завершенные операции удаляются из памяти через
+    fetched_ttl после того, как клиент получил результат, через ttl после
+    завершения или раньше, если реестр превысил max_entries.
+    Незавершенные операции не вытесняются.
+    """
+
+    def __init__(self, store, max_entries=1000, ttl=3600, fetched_ttl=60, poll_interval=2.0):
+        self.store = store
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.fetched_ttl = fetched_ttl
+        # Как часто wait() перечитывает БД: изменения из других процессов не будят ожидающих
+        self.poll_interval = poll_interval
+        self.lock = Lock()
+        self._operations = OrderedDict()  # operation_id -> AsyncOperation в порядке создания
+        # operation_id -> _Waiters; запись есть, только пока у операции есть ожидающие или слушатели
+        self._waiters = {}
+        self._waiters_lock = Lock()
+        self.evictions = 0
+
+    def _notify(self, operation_id, events=False):
+        """Будит ожидающих одной операции: events=True - только ожидающих фрагментов ответа"""
+        with self._waiters_lock:
+            waiters = self._waiters.get(operation_id)
+        if waiters is None:
+            return
+
+        with waiters.lock:
+            if events:
+                waiters.events_version += 1
+            else:
+                waiters.status_version += 1
+                waiters.status_changed.notify_all()
+            waiters.events_added.notify_all()
+            listeners = list(waiters.listeners) if not events else ()
+        for listener in listeners:
+            listener()
+
+    def _subscribe(self, operation_id, listener=None):
+        with self._waiters_lock:
+            waiters = self._waiters.get(operation_id)
+            if waiters is None:
+                waiters = self._waiters[operation_id] = _Waiters()
+            if listener is None:
+                waiters.waiting += 1
+            else:
+                waiters.listeners.append(listener)
+            return waiters
+
+    def _unsubscribe(self, operation_id, listener=None):
+        with self._waiters_lock:
+            waiters = self._waiters.get(operation_id)
+            if waiters is None:
+                return
+            if listener is None:
+                waiters.waiting -= 1
+            elif listener in waiters.listeners:
+                waiters.listeners.remove(listener)
+            if not waiters.waiting and not waiters.listeners:
+                del self._waiters[operation_id]
+
+    def add_listener(self, operation_id, listener):
+        """Подписка на смену статуса операции без блокировки потока (ASGI-режим).
+
+        listener вызывается без аргументов из потока, внесшего изменение;
+        фрагменты ответа слушателей не будят.
+        """
+        self._subscribe(operation_id, listener)
+
+    def remove_listener(self, operation_id, listener):
+        self._unsubscribe(operation_id, listener)
+
+    def create(self, user_id, session_id, payload=None):
+        """Ставит задачу в очередь"""
+        operation = AsyncOperation(str(uuid.uuid4()), user_id, session_id)
+        self.store.create_operation(operation.operation_id, user_id, session_id, operation.start_time, payload)
+
+        with self.lock:
+            self._operations[operation.operation_id] = operation
+        self.evict()
+
+        return operation
+
+    def claim(self, worker_id, lease_seconds, max_attempts):
+        """Захватывает задачу из очереди. Возвращает (операция, данные задачи) или (None, None)"""
+        job, exhausted = self.store.claim_operation(worker_id, lease_seconds, max_attempts)
+
+        with self.lock:
+            # Операции этого процесса, которые другой воркер признал прерванными
+            for operation_id in exhausted:
+                self._operations.pop(operation_id, None)
+
+            if job is None:
+                return None, None
+
+            operation = self._operations.get(job['operation_id'])
+            if operation is None:
+                # Задача поставлена другим процессом или до перезапуска
+                operation = AsyncOperation(job['operation_id'], job['user_id'], job['session_id'])
+                operation.start_time = job['created_at']
+                self._operations[operation.operation_id] = operation
+
+        operation.status = "running"
+        operation.attempt = job['attempt']
+        self._notify(operation.operation_id)
+        return operation, job['payload']
+
+    def progress(self, operation, text):
+        """Обновляет прогресс (в памяти и в БД для других процессов)"""
+        operation.progress = text
+        self.store.set_progress(operation.operation_id, text)
+        self._notify(operation.operation_id)
+
+    def emit(self, operation, kind, text):
+        """Фрагмент ответа модели ('token' или 'reasoning') для подписчиков этого процесса.
+
+        В БД не пишется: итог сохранит finish(), а частота фрагментов слишком высока.
+        Будит только тех, кто ждет фрагменты этой операции.
+        """
+        operation.events.append((kind, text))
+        self._notify(operation.operation_id, events=True)
+
+    def events(self, operation_id, offset=0):
+        """Фрагменты ответа, начиная с offset (пусто, если задачу выполняет другой процесс)"""
+        with self.lock:
+            operation = self._operations.get(operation_id)
+            return operation.events[offset:] if operation is not None else []
+
+    def cancel(self, operation_id, user_id=None):
+        """Отменяет операцию пользователя.
+
+        Ожидающая задача отменяется сразу, выполняемая - когда её воркер
+        увидит запрос (в этом процессе немедленно, в другом - при
+        ближайшем продлении аренды). Возвращает 'cancelled', 'requested'
+        или None, если отменять нечего.
+        """
+        if self.status(operation_id, user_id) is None:
+            return None
+
+        outcome = self.store.cancel_operation(operation_id, time.time())
+        if outcome == 'requested':
+            with self.lock:
+                operation = self._operations.get(operation_id)
+                if operation is not None:
+                    operation.cancel_requested = True
+
+        self._notify(operation_id)
+        return outcome
+
+    def request_cancel(self, operation_ids):
+        """Отмечает выполняемые здесь операции, отмену которых запросил другой процесс"""
+        with self.lock:
+            for operation_id in operation_ids:
+                operation = self._operations.get(operation_id)
+                if operation is not None:
+                    operation.cancel_requested = True
+
+    def finish(self, operation, worker_id=None):
+        """Сохраняет итог операции в БД, после чего её можно вытеснить из памяти"""
+        if operation.status not in FINISHED_STATUSES:
+            operation.status = "error"
+            operation.error = operation.error or "Операция завершилась без результата"
+
+        finished_at = time.time()
+        saved = self.store.finish_operation(operation.operation_id, operation.status, operation.progress,
+                                            operation.result, operation.error, finished_at, worker_id)
+        operation.finished_at = finished_at
+        # Полный ответ теперь в result, фрагменты больше не нужны
+        operation.events = []
+
+        if not saved:
+            # Аренду перехватил другой воркер - его итог главнее
+            with self.lock:
+                self._operations.pop(operation.operation_id, None)
+
+        self._notify(operation.operation_id)
+        return saved
+
+    def wait(self, operation_id, status=None, progress=None, timeout=25, user_id=None, offset=None):
+        """Ждет, пока статус или прогресс операции отличатся от переданных (long-poll, SSE).
+
+        С offset ждет также новых фрагментов ответа (events() после offset).
+        Возвращает ответ /operation_status - изменившийся или текущий по истечении
+        timeout, либо None, если операции нет.
+        """
+        deadline = time.time() + timeout
+        events = offset is not None
+        waiters = self._subscribe(operation_id)
+        condition = waiters.events_added if events else waiters.status_changed
+        try:
+            while True:
+                with waiters.lock:
+                    version = waiters.version(events)
+                response = self.status(operation_id, user_id)
+                if response is None or (response['status'], response['progress']) != (status, progress):
+                    return response
+                if events and self._event_count(operation_id) > offset:
+                    return response
+
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return response
+
+                with condition:
+                    if waiters.version(events) == version:
+                        condition.wait(min(remaining, self.poll_interval))
+        finally:
+            self._unsubscribe(operation_id)
+
+    def _event_count(self, operation_id):
+        with self.lock:
+            operation = self._operations.get(operation_id)
+            return len(operation.events) if operation is not None else 0
+
+    def status(self, operation_id, user_id=None):
+        """Ответ /operation_status или None, если операции нет (или она чужая)"""
+        with self.lock:
+            operation = self._operations.get(operation_id)
+            if operation is not None:
+                if user_id is not None and operation.user_id != user_id:
+                    return None
+                # Ожидающую задачу мог захватить воркер другого процесса - смотрим в БД
+                if operation.status != "pending":
+                    if operation.finished_at is not None and operation.fetched_at is None:
+                        operation.fetched_at = time.time()
+                    return operation_response(operation_id, operation.status, operation.progress,
+                                              time.time() - operation.start_time, operation.result,
+                                              operation.error)
+
+        # Вытесненная из памяти, выполняемая другим процессом или созданная до перезапуска операция
+        row = self.store.get_operation(operation_id)
+        if row is None or (user_id is not None and row['user_id'] != user_id):
+            return None
+
+        if operation is not None and row['status'] != "pending":
+            with self.lock:
+                if operation.status == "pending":
+                    self._operations.pop(operation_id, None)
+
+        elapsed = (row['finished_at'] or time.time()) - row['created_at']
+        return operation_response(operation_id, row['status'], row['progress'], elapsed, row['result'], row['error'])
+
+    def evict(self):
+        """Удаляет из памяти завершенные операции по TTL и сверх max_entries"""
+        now = time.time()
+
+        with self.lock:
+            # Поставленные здесь, но так и не захваченные здесь задачи тоже есть в БД
+            stale = [op for op in self._operations.values()
+                     if op.status == "pending" and now - op.start_time > self.ttl]
+            finished = [op for op in self._operations.values() if op.finished_at is not None]
+            overflow = len(self._operations) - self.max_entries
+
+            for operation in stale + finished:
+                expired = (operation.finished_at is None or now - operation.finished_at > self.ttl or
+                           (operation.fetched_at is not None and now - operation.fetched_at > self.fetched_ttl))
+                if expired or overflow > 0:
+                    del self._operations[operation.operation_id]
+                    overflow -= 1
+                    self.evictions += 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                'entries': len(self._operations),
+                'active': sum(1 for op in self._operations.values() if op.finished_at is None),
+                'max_entries': self.max_entries,
+                'evictions': self.evictions
+            }
@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Профилирование работающего сервера без перезапуска.
+
+SamplingProfiler - выборочный профилировщик всех потоков процесса:
+отдельный поток раз в interval снимает стеки через sys._current_frames()
+и не вмешивается в выполнение кода (в отличие от sys.setprofile).
+RequestProfiler - cProfile одного помеченного запроса.
+Оба отдают стеки в свернутом формате flamegraph.pl / speedscope:
+"поток;модуль:функция;... количество".
+"""
+
+import cProfile
+import io
+import os
+import pstats
+import re
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+
+
+def _thread_group(name):
+    """Имя потока без номеров: потоки запросов и воркеров сливаются в одну вершину графа"""
+    return re.sub(r'\d+', 'N', name).replace(';', ',').replace(' ', '_')
+
+
+def _frame_label(code):
+    name = getattr(code, 'co_qualname', code.co_name)
+    return f"{os.path.basename(code.co_filename)}:{name}".replace(';', ',').replace(' ', '_')
+
+
+def format_collapsed(stacks):
+    """Свернутые стеки {стек: вес} в текст, самые тяжелые первыми"""
+    return ''.join(f"{stack} {weight}\n" for stack, weight in stacks.most_common() if weight > 0)
+
+
+class SamplingProfiler:
+    """Выборка стеков всех потоков на заданное время.
+
+    Одновременно идет только один сеанс; длительность и частота
+    ограничены (max_seconds, min_interval), поэтому забытый сеанс не
+    нагружает процесс бесконечно. Результат последнего сеанса хранится
+    до следующего запуска.
+    """
+
+    def __init__(self, max_seconds=120, min_interval=0.005):
+        self.max_seconds = max_seconds
+        self.min_interval = min_interval
+        self.lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self.session = None  # параметры и итоги текущего или последнего сеанса
+        self._stacks = Counter()
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, seconds, interval=0.01):
+        """Запускает сеанс. False, если сеанс уже идет"""
+        seconds = max(0.1, min(float(seconds), self.max_seconds))
+        interval = max(float(interval), self.min_interval)
+        with self.lock:
+            if self.running:
+                return False
+            self._stop.clear()
+            self._stacks = Counter()
+            self.session = {'started_at': time.time(), 'seconds': seconds, 'interval': interval,
+                            'samples': 0, 'duration': None}
+            self._thread = threading.Thread(target=self._run, args=(seconds, interval), name='sampling-profiler')
+            self._thread.daemon = True
+            self._thread.start()
+        return True
+
+    def stop(self):
+        """Останавливает сеанс досрочно и ждет его завершения"""
+        self._stop.set()
+        thread = self._thread
+        if thread is not None:
+            thread.join()
+
+    def status(self):
+        with self.lock:
+            return dict(self.session or {}, running=self.running)
+
+    def collapsed(self):
+        """Стеки текущего или последнего сеанса"""
+        with self.lock:
+            stacks = Counter(self._stacks)
+        return format_collapsed(stacks)
+
+    def _run(self, seconds, interval):
+        me = threading.get_ident()
+        started = time.monotonic()
+        deadline = started + seconds
+        names = {}
+        names_refreshed = 0
+
+        while not self._stop.wait(interval) and time.monotonic() < deadline:
+            now = time.monotonic()
+            if now - names_refreshed > 1:
+                names = {thread.ident: _thread_group(thread.name) for thread in threading.enumerate()}
+                names_refreshed = now
+
+            sample = []
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(_frame_label(frame.f_code))
+                    frame = frame.f_back
+                stack.append(names.get(ident, 'unknown'))
+                sample.append(';'.join(reversed(stack)))
+
+            with self.lock:
+                self._stacks.update(sample)
+                self.session['samples'] += 1
+
+        with self.lock:
+            self.session['duration'] = round(time.monotonic() - started, 3)
+
+
+def collapse_cprofile(stats, max_depth=64):
+    """Свернутые стеки из cProfile (вес - собственное время в микросекундах).
+
+    cProfile хранит только пары вызывающий-вызываемый, поэтому время
+    вызываемой функции делится между путями пропорционально времени
+    каждой пары - это приближение, точные стеки дает SamplingProfiler.
+    """
+    entries = stats.stats  # функция -> (cc, nc, tt, ct, {вызывающий: (nc, cc, tt, ct)})
+    callees = defaultdict(list)
+    for function, (_, _, _, _, callers) in entries.items():
+        for caller, edge in callers.items():
+            callees[caller].append((function, edge[3]))
+
+    def label(function):
+        filename, _, name = function
+        return f"{os.path.basename(filename)}:{name}".replace(';', ',').replace(' ', '_')
+
+    stacks = Counter()
+
+    def walk(function, path, share):
+        _, _, own_time, _, _ = entries[function]
+        path = path + (label(function),)
+        weight = int(own_time * share * 1e6)
+        if weight:
+            stacks[';'.join(path)] += weight
+        if len(path) >= max_depth:
+            return
+        for callee, edge_time in callees.get(function, ()):
+            callee_time = entries[callee][3]
+            callee_share = share * edge_time / callee_time if callee_time else 0
+            # Рекурсия и пути с ничтожным временем не разворачиваются
+            if label(callee) in path or callee_time * callee_share < 1e-6:
+                continue
+            walk(callee, path, callee_share)
+
+    for function, entry in entries.items():
+        if not entry[4]:
+            walk(function, (), 1.0)
+    return stacks
+
+
+class RequestProfiler:
+    """cProfile одного запроса: администратор помечает путь, следующий такой запрос профилируется.
+
+    Профилируется только поток запроса: задача очереди после
+    /send_message_async выполняется в воркере и сюда не попадает
+    (её стеки видны в SamplingProfiler).
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.armed = None  # префикс пути, ожидающий запроса
+        self.result = None
+
+    def arm(self, path):
+        with self.lock:
+            self.armed = path
+            self.result = None
+
+    def claim(self, path):
+        """Профилировщик, если запрос помечен, иначе None. Помечается один запрос"""
+        if self.armed is None:
+            return None
+        with self.lock:
+            if self.armed is None or not path.startswith(self.armed):
+                return None
+            self.armed = None
+
+        profile = cProfile.Profile()
+        profile.enable()
+        return profile
+
+    def finish(self, profile, method, path, status_code=None):
+        profile.disable()
+        stats = pstats.Stats(profile)
+
+        report = io.StringIO()
+        pstats.Stats(profile, stream=report).sort_stats('cumulative').print_stats(60)
+
+        with self.lock:
+            self.result = {
+                'method': method,
+                'path': path,
+                'status_code': status_code,
+                'finished_at': time.time(),
+                'total_seconds': round(stats.total_tt, 6),
+                'collapsed': format_collapsed(collapse_cprofile(stats)),
+                'pstats': report.getvalue()
+            }
+
+    def status(self):
+        with self.lock:
+            return {'armed': self.armed,
+                    'result': {key: value for key, value in self.result.items()
+                               if key not in ('collapsed', 'pstats')} if self.result else None}
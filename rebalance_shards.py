@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Перебалансировка шардов сообщений.
+
+Переносит сообщения (горячие и архивные) и их вложения пользователей,
+чей шард по хешу изменился при новом количестве шардов, и обновляет
+каталог user_shards. Пользователи без записи в каталоге считаются
+хранящимися в самом каталоге - так же переносится БД без шардирования.
+
+Запускать при остановленном сервере:
+
+    python rebalance_shards.py --shards 8
+"""
+
+import argparse
+import glob
+import os
+import re
+import sqlite3
+import time
+
+from config import Config
+from database import _attach_archive, _attachment_hashes
+from schema import ensure_archive_schema
+from sharding import ShardRouter, hash_shard, shard_paths
+
+MESSAGE_COLUMNS = ('session_id, role, content, thinking, response_time, timestamp, files, user_id, '
+                   'html, html_version, timings')
+
+
+def existing_shard_count(shard_dir):
+    """Количество шардов, уже созданных в каталоге shard_dir"""
+    indexes = [int(m.group(1)) for path in glob.glob(os.path.join(shard_dir, 'chat_shard_*.db'))
+               if (m := re.search(r'chat_shard_(\d+)\.db$', path))]
+    return max(indexes) + 1 if indexes else 0
+
+
+def _move_rows(cursor, src_table, dst_table, session_id):
+    """Переносит сообщения сессии между таблицами вместе со ссылками на вложения"""
+    cursor.execute(f'SELECT files FROM {src_table} WHERE session_id = ? AND files IS NOT NULL', (session_id,))
+    for (files_value,) in cursor.fetchall():
+        for blob_hash in _attachment_hashes(files_value):
+            cursor.execute('''
+                           INSERT OR IGNORE INTO main.attachment_blobs (hash, content, size, ref_count)
+                           SELECT hash, content, size, 0
+                           FROM src.attachment_blobs
+                           WHERE hash = ?
+                           ''', (blob_hash,))
+            cursor.execute('UPDATE main.attachment_blobs SET ref_count = ref_count + 1 WHERE hash = ?',
+                           (blob_hash,))
+            cursor.execute('UPDATE src.attachment_blobs SET ref_count = ref_count - 1 WHERE hash = ?',
+                           (blob_hash,))
+
+    cursor.execute(f'''
+                   INSERT INTO {dst_table} ({MESSAGE_COLUMNS})
+                   SELECT {MESSAGE_COLUMNS}
+                   FROM {src_table}
+                   WHERE session_id = ?
+                   ''', (session_id,))
+    moved = cursor.rowcount
+    cursor.execute(f'DELETE FROM {src_table} WHERE session_id = ?', (session_id,))
+    return moved
+
+
+def move_sessions(session_ids, src_path, src_archive, dst_path, dst_archive):
+    """Переносит сессии из одного файла в другой одной транзакцией"""
+    conn = sqlite3.connect(dst_path)
+    cursor = conn.cursor()
+    cursor.execute('ATTACH DATABASE ? AS src', (src_path,))
+
+    tables = [('src.chat_messages', 'main.chat_messages')]
+    if src_archive and dst_archive and os.path.exists(src_archive):
+        _attach_archive(cursor, dst_archive)
+        ensure_archive_schema(src_archive)
+        cursor.execute('ATTACH DATABASE ? AS src_archive', (src_archive,))
+        tables.append(('src_archive.chat_messages', 'archive.chat_messages'))
+
+    moved = 0
+    try:
+        for session_id in session_ids:
+            for src_table, dst_table in tables:
+                moved += _move_rows(cursor, src_table, dst_table, session_id)
+        cursor.execute('DELETE FROM src.attachment_blobs WHERE ref_count <= 0')
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+    return moved
+
+
+def rebalance(catalog_path, shard_dir, shard_count, archive_path=None):
+    """Приводит размещение пользователей к hash(user_id) % shard_count"""
+    old_count = existing_shard_count(shard_dir)
+    router = ShardRouter(catalog_path, shard_count, shard_dir, archive_path)
+    all_paths = shard_paths(shard_dir, max(old_count, shard_count), archive_path)
+
+    conn = sqlite3.connect(catalog_path)
+    cursor = conn.cursor()
+    cursor.execute('SELECT DISTINCT user_id FROM chat_sessions')
+    user_ids = [row[0] for row in cursor.fetchall()]
+    cursor.execute('SELECT user_id, shard FROM user_shards')
+    current = dict(cursor.fetchall())
+    conn.close()
+
+    stats = {'users_moved': 0, 'messages_moved': 0}
+
+    for user_id in user_ids:
+        target = hash_shard(user_id, shard_count)
+        source = current.get(user_id)
+        if source == target:
+            continue
+
+        if source is None:
+            # Данные еще лежат в каталоге (режим без шардов)
+            src_path, src_archive = catalog_path, archive_path
+        else:
+            src_path, src_archive = all_paths[source]
+        dst = router.shards[target]
+
+        conn = sqlite3.connect(catalog_path)
+        cursor = conn.cursor()
+        cursor.execute('SELECT session_id FROM chat_sessions WHERE user_id = ?', (user_id,))
+        session_ids = [row[0] for row in cursor.fetchall()]
+        conn.close()
+
+        if os.path.exists(src_path):
+            stats['messages_moved'] += move_sessions(session_ids, src_path, src_archive,
+                                                     dst.db_path, dst.archive_path)
+
+        conn = sqlite3.connect(catalog_path)
+        conn.execute('INSERT OR REPLACE INTO user_shards (user_id, shard) VALUES (?, ?)', (user_id, target))
+        conn.commit()
+        conn.close()
+
+        stats['users_moved'] += 1
+
+    router.forget_users()
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Перебалансировка шардов сообщений')
+    parser.add_argument('--catalog', default='chat_history.db', help='БД-каталог с users и chat_sessions')
+    parser.add_argument('--shard-dir', default=Config.SHARD_DIR)
+    parser.add_argument('--shards', type=int, required=True, help='новое количество шардов')
+    parser.add_argument('--archive-path', default=Config.ARCHIVE_PATH)
+    args = parser.parse_args()
+
+    start_time = time.time()
+    stats = rebalance(args.catalog, args.shard_dir, args.shards, args.archive_path)
+    print(f"✅ Перенесено пользователей: {stats['users_moved']}, сообщений: {stats['messages_moved']} "
+          f"за {time.time() - start_time:.1f} с")
+    print(f"⚠️ Укажите SHARD_COUNT = {args.shards} в config.py")
+
+
+if __name__ == '__main__':
+    main()
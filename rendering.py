@@ -0,0 +1,40 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from importlib.metadata import version as package_version, PackageNotFoundError
+
+
+class MarkdownRenderer:
+    """Рендер ответов модели в HTML (markdown + подсветка кода Pygments).
+
+    HTML сохраняется вместе с сообщением. Версия рендерера включает
+    собственную версию (поднимать при смене расширений или настроек) и
+    версии пакетов markdown и Pygments: сохраненный HTML другой версии
+    рендерится заново при чтении истории.
+    """
+
+    VERSION = 1
+    EXTENSIONS = ['codehilite', 'fenced_code', 'tables']
+
+    def __init__(self):
+        self._version = None
+        self.renders = 0
+
+    @property
+    def version(self):
+        """Строка версии; пакеты не импортируются, версии берутся из метаданных"""
+        if self._version is None:
+            parts = [str(self.VERSION)]
+            for package in ('markdown', 'pygments'):
+                try:
+                    parts.append(f"{package}-{package_version(package)}")
+                except PackageNotFoundError:
+                    parts.append(f"{package}-none")
+            self._version = '/'.join(parts)
+        return self._version
+
+    def render(self, text):
+        """Конвертирует markdown в HTML (markdown и Pygments импортируются при первом вызове)"""
+        import markdown
+        self.renders += 1
+        return markdown.markdown(text, extensions=self.EXTENSIONS)
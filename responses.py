@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import gzip
+import hashlib
+import json
+from datetime import datetime, timezone
+
+from flask import Response
+from werkzeug.http import is_resource_modified
+
+try:
+    import orjson
+except ImportError:
+    # Без orjson - стандартный json (медленнее на больших историях)
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    # Без brotli ответы сжимаются только gzip
+    brotli = None
+
+
+def dumps_json(data):
+    """JSON в байтах UTF-8: orjson, если установлен"""
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data, ensure_ascii=False).encode('utf-8')
+
+
+def json_response(data, status=200):
+    return Response(dumps_json(data), status=status, mimetype='application/json')
+
+
+def make_etag(*parts):
+    """Короткий ETag из частей валидатора"""
+    return hashlib.blake2b(':'.join(str(part) for part in parts).encode('utf-8'), digest_size=12).hexdigest()
+
+
+def parse_timestamp(value):
+    """CURRENT_TIMESTAMP SQLite (UTC, 'YYYY-MM-DD HH:MM:SS') в datetime или None"""
+    if not value:
+        return None
+    try:
+        return datetime.strptime(value[:19], '%Y-%m-%d %H:%M:%S').replace(tzinfo=timezone.utc)
+    except ValueError:
+        return None
+
+
+def conditional_json(request, etag, last_modified, build):
+    """JSON-ответ с ETag и Last-Modified.
+
+    Если у клиента актуальная копия, отвечает 304 без вызова build() -
+    ни чтения из БД, ни сериализации. Клиент каждый раз перепроверяет
+    копию (no-cache), поэтому изменения видны сразу.
+    """
+    if is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+        response = json_response(build())
+    else:
+        response = Response(status=304)
+
+    response.set_etag(etag, weak=True)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+
+def compress_response(response, request, min_size=1024, gzip_level=6, brotli_quality=5):
+    """Сжимает JSON-ответ размером от min_size байт: brotli или gzip по Accept-Encoding"""
+    if response.status_code != 200 or response.mimetype != 'application/json' or \
+            response.direct_passthrough or response.is_streamed or 'Content-Encoding' in response.headers:
+        return response
+
+    response.vary.add('Accept-Encoding')
+    body = response.get_data()
+    if len(body) < min_size:
+        return response
+
+    accepted = request.accept_encodings
+    if brotli is not None and accepted['br']:
+        response.set_data(brotli.compress(body, quality=brotli_quality))
+        response.headers['Content-Encoding'] = 'br'
+    elif accepted['gzip']:
+        response.set_data(gzip.compress(body, compresslevel=gzip_level, mtime=0))
+        response.headers['Content-Encoding'] = 'gzip'
+    return response
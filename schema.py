@@ -0,0 +1,392 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import logging
+import os
+import sqlite3
+from threading import Lock
+
+log = logging.getLogger(__name__)
+
+# Пути БД и архивов, для которых схема уже проверена в этом процессе
+_checked_paths = set()
+_checked_archives = set()
+_checked_lock = Lock()
+
+
+def _table_columns(cursor, table):
+    """Список колонок таблицы"""
+    cursor.execute(f"PRAGMA table_info({table})")
+    return [column[1] for column in cursor.fetchall()]
+
+
+def _migration_base(cursor):
+    """Базовая схема: сообщения, вложения, пользователи, сессии"""
+    cursor.execute('''
+                   CREATE TABLE IF NOT EXISTS chat_messages
+                   (
+                       id            INTEGER PRIMARY KEY AUTOINCREMENT,
+                       session_id    TEXT NOT NULL,
+                       role          TEXT NOT NULL,
+                       content       TEXT NOT NULL,
+                       thinking      TEXT,
+                       response_time REAL,
+                       timestamp     DATETIME DEFAULT CURRENT_TIMESTAMP,
+                       files         TEXT,
+                       user_id       INTEGER DEFAULT NULL
+                   )
+                   ''')
+
+    # Старые БД создавались без колонки user_id
+    if 'user_id' not in _table_columns(cursor, 'chat_messages'):
+        cursor.execute('ALTER TABLE chat_messages ADD COLUMN user_id INTEGER DEFAULT NULL')
+
+    # Содержимое вложений хранится один раз по SHA-256
+    cursor.execute('''
+                   CREATE TABLE IF NOT EXISTS attachment_blobs
+                   (
+                       hash       TEXT PRIMARY KEY,
+                       content    BLOB    NOT NULL,
+                       size       INTEGER NOT NULL,
+                       ref_count  INTEGER NOT NULL DEFAULT 0,
+                       created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+                   )
+                   ''')
+
+    cursor.execute('''
+                   CREATE TABLE IF NOT EXISTS users
+                   (
+                       id            INTEGER PRIMARY KEY AUTOINCREMENT,
+                       username      TEXT UNIQUE NOT NULL,
+                       password_hash TEXT        NOT NULL,
+                       created_at    DATETIME DEFAULT CURRENT_TIMESTAMP,
+                       last_login    DATETIME
+                   )
+                   ''')
+
+    cursor.execute('''
+                   CREATE TABLE IF NOT EXISTS chat_sessions
+                   (
+                       id          INTEGER PRIMARY KEY AUTOINCREMENT,
+                       user_id     INTEGER     NOT NULL,
+                       session_id  TEXT UNIQUE NOT NULL,
+                       title       TEXT     DEFAULT 'Новый чат',
+                       created_at  DATETIME DEFAULT CURRENT_TIMESTAMP,
+                       updated_at  DATETIME DEFAULT CURRENT_TIMESTAMP,
+                       archived_at DATETIME DEFAULT NULL,
+                       FOREIGN KEY (user_id) REFERENCES users (id)
+                   )
+                   ''')
+
+    # Отметка о переносе сессии в архивную БД
+    if 'archived_at' not in _table_columns(cursor, 'chat_sessions'):
+        cursor.execute('ALTER TABLE chat_sessions ADD COLUMN archived_at DATETIME DEFAULT NULL')
+
+
+def _migration_indexes(cursor):
+    """Индексы под запросы database.py вместо дублирующих idx_session/idx_session_timestamp"""
+    # idx_session - префикс idx_session_timestamp, idx_user не используется ни одним запросом
+    cursor.execute('DROP INDEX IF EXISTS idx_session')
+    cursor.execute('DROP INDEX IF EXISTS idx_session_timestamp')
+    cursor.execute('DROP INDEX IF EXISTS idx_user')
+
+    # get_messages (WHERE session_id ORDER BY timestamp), удаление сессии,
+    # а get_session_stats (role, response_time) читает только индекс
+    cursor.execute('''
+                   CREATE INDEX IF NOT EXISTS idx_messages_session
+                       ON chat_messages(session_id, timestamp, role, response_time)
+                   ''')
+
+    # get_user_sessions: WHERE user_id ORDER BY updated_at DESC - покрывающий индекс
+    cursor.execute('''
+                   CREATE INDEX IF NOT EXISTS idx_sessions_user_updated
+                       ON chat_sessions(user_id, updated_at DESC, session_id, title, created_at)
+                   ''')
+
+    # archive_idle_sessions: только неархивные сессии по updated_at
+    cursor.execute('''
+                   CREATE INDEX IF NOT EXISTS idx_sessions_idle
+                       ON chat_sessions(updated_at) WHERE archived_at IS NULL
+                   ''')
+
+    # Сборка мусора: DELETE FROM attachment_blobs WHERE ref_count <= 0
+    cursor.execute('''
+                   CREATE INDEX IF NOT EXISTS idx_blobs_unreferenced
+                       ON attachment_blobs(ref_count) WHERE ref_count <= 0
+                   ''')
+
+    cursor.execute('ANALYZE')
+
+
+def _migration_meta(cursor):
+    """Служебные значения (прогресс фоновых миграций и т.п.)"""
+    cursor.execute('''
+                   CREATE TABLE IF NOT EXISTS db_meta
+                   (
+                       key   TEXT PRIMARY KEY,
+                       value TEXT
+                   )
+                   ''')
+
+
+def _migration_user_shards(cursor):
+    """Каталог шардов: за каким файлом сообщений закреплен пользователь"""
+    cursor.execute('''
+                   CREATE TABLE IF NOT EXISTS user_shards
+                   (
+                       user_id INTEGER PRIMARY KEY,
+                       shard   INTEGER NOT NULL
+                   )
+                   ''')
+
+
+def _migration_context_snapshots(cursor):
+    """Снимки контекста модели: точная (обрезанная) история для быстрого переключения сессий"""
+    cursor.execute('''
+                   CREATE TABLE IF NOT EXISTS context_snapshots
+                   (
+                       session_id    TEXT PRIMARY KEY,
+                       context       BLOB    NOT NULL,
+                       token_count   INTEGER NOT NULL,
+                       message_count INTEGER NOT NULL,
+                       updated_at    DATETIME DEFAULT CURRENT_TIMESTAMP
+                   )
+                   ''')
+
+
+def _migration_operations(cursor):
+    """Асинхронные операции: статус и результат переживают перезапуск сервера"""
+    cursor.execute('''
+                   CREATE TABLE IF NOT EXISTS operations
+                   (
+                       operation_id TEXT PRIMARY KEY,
+                       user_id      INTEGER,
+                       session_id   TEXT,
+                       status       TEXT NOT NULL,
+                       progress     TEXT,
+                       result       BLOB,
+                       error        TEXT,
+                       created_at   REAL NOT NULL,
+                       finished_at  REAL
+                   )
+                   ''')
+    cursor.execute('''
+                   CREATE INDEX IF NOT EXISTS idx_operations_status
+                       ON operations(status, created_at)
+                   ''')
+
+
+def _migration_job_queue(cursor):
+    """Очередь задач поверх operations: данные задачи, аренда и число попыток"""
+    columns = _table_columns(cursor, 'operations')
+    for column, definition in [('payload', 'BLOB'),
+                               ('lease_owner', 'TEXT'),
+                               ('lease_expires', 'REAL'),
+                               ('attempts', 'INTEGER NOT NULL DEFAULT 0'),
+                               ('started_at', 'REAL')]:
+        if column not in columns:
+            cursor.execute(f'ALTER TABLE operations ADD COLUMN {column} {definition}')
+
+
+def _migration_cancel_requests(cursor):
+    """Запрос отмены выполняемой задачи: его видит воркер любого процесса"""
+    if 'cancel_requested' not in _table_columns(cursor, 'operations'):
+        cursor.execute('ALTER TABLE operations ADD COLUMN cancel_requested INTEGER NOT NULL DEFAULT 0')
+
+
+def _migration_shared_state(cursor):
+    """Общее состояние процессов: версии контекстов, загрузка модели и инвалидации кеша"""
+    cursor.execute('''
+                   CREATE TABLE IF NOT EXISTS shared_state
+                   (
+                       key        TEXT PRIMARY KEY,
+                       value      TEXT,
+                       updated_at REAL NOT NULL
+                   )
+                   ''')
+    cursor.execute('''
+                   CREATE TABLE IF NOT EXISTS cache_invalidations
+                   (
+                       seq        INTEGER PRIMARY KEY AUTOINCREMENT,
+                       origin     TEXT NOT NULL,
+                       payload    TEXT NOT NULL,
+                       created_at REAL NOT NULL
+                   )
+                   ''')
+
+
+def _migration_rendered_html(cursor):
+    """HTML ответа, отрендеренный при сохранении, и версия рендерера, которой он получен"""
+    columns = _table_columns(cursor, 'chat_messages')
+    if 'html' not in columns:
+        cursor.execute('ALTER TABLE chat_messages ADD COLUMN html TEXT DEFAULT NULL')
+    if 'html_version' not in columns:
+        cursor.execute('ALTER TABLE chat_messages ADD COLUMN html_version TEXT DEFAULT NULL')
+
+
+def _migration_message_timings(cursor):
+    """Время этапов обработки хода (JSON) у сообщений ассистента"""
+    if 'timings' not in _table_columns(cursor, 'chat_messages'):
+        cursor.execute('ALTER TABLE chat_messages ADD COLUMN timings TEXT DEFAULT NULL')
+
+
+def _migration_messages_order(cursor):
+    """id в индексе сообщений: порядок (timestamp, id) без временной сортировки"""
+    # Сообщения одной секунды упорядочиваются по id. Без id в индексе
+    # get_context_messages (ORDER BY timestamp, id) сортировал всю сессию
+    cursor.execute('DROP INDEX IF EXISTS idx_messages_session')
+    cursor.execute('''
+                   CREATE INDEX idx_messages_session
+                       ON chat_messages(session_id, timestamp, id, role, response_time)
+                   ''')
+    cursor.execute('ANALYZE chat_messages')
+
+
+# (версия, описание, функция). Новые миграции только добавляются в конец.
+MIGRATIONS = [
+    (1, 'Базовая схема', _migration_base),
+    (2, 'Покрывающие индексы для запросов чата', _migration_indexes),
+    (3, 'Таблица служебных значений db_meta', _migration_meta),
+    (4, 'Каталог шардов user_shards', _migration_user_shards),
+    (5, 'Снимки контекста сессий', _migration_context_snapshots),
+    (6, 'Таблица асинхронных операций', _migration_operations),
+    (7, 'Очередь задач: аренда и попытки', _migration_job_queue),
+    (8, 'Отмена выполняемых задач', _migration_cancel_requests),
+    (9, 'Общее состояние процессов', _migration_shared_state),
+    (10, 'Отрендеренный HTML сообщений', _migration_rendered_html),
+    (11, 'Время этапов обработки сообщений', _migration_message_timings),
+    (12, 'id в индексе сообщений сессии', _migration_messages_order),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+def get_schema_version(cursor):
+    """Текущая версия схемы из PRAGMA user_version"""
+    cursor.execute('PRAGMA user_version')
+    return cursor.fetchone()[0]
+
+
+def migrate(db_path):
+    """Применяет недостающие миграции. Возвращает список примененных версий.
+
+    Каждая миграция выполняется в своей транзакции вместе с записью
+    user_version, BEGIN IMMEDIATE не дает двум процессам мигрировать одновременно.
+    """
+    conn = sqlite3.connect(db_path, isolation_level=None)
+    cursor = conn.cursor()
+    applied = []
+
+    try:
+        current_version = get_schema_version(cursor)
+        if current_version >= SCHEMA_VERSION:
+            # Схема актуальна - никакого DDL и блокировок на запись
+            return applied
+
+        if current_version == 0:
+            # Для новой БД сразу включаем инкрементальную очистку
+            cursor.execute('PRAGMA auto_vacuum = INCREMENTAL')
+
+        for version, description, migration in MIGRATIONS:
+            cursor.execute('BEGIN IMMEDIATE')
+            try:
+                if get_schema_version(cursor) >= version:
+                    cursor.execute('COMMIT')
+                    continue
+
+                migration(cursor)
+                cursor.execute(f'PRAGMA user_version = {int(version)}')
+                cursor.execute('COMMIT')
+            except Exception:
+                cursor.execute('ROLLBACK')
+                raise
+
+            applied.append(version)
+            log.info("Миграция схемы %d: %s", version, description, extra={'version': version})
+    finally:
+        conn.close()
+
+    return applied
+
+
+def ensure_schema(db_path):
+    """Проверяет схему один раз на процесс.
+
+    Повторные вызовы (ChatDatabase и UserDatabase на одном файле,
+    пересоздание объектов) не открывают соединение вообще.
+    """
+    key = os.path.abspath(db_path)
+    if key in _checked_paths:
+        return []
+
+    with _checked_lock:
+        if key in _checked_paths:
+            return []
+        applied = migrate(db_path)
+        _checked_paths.add(key)
+        return applied
+
+
+# Колонки chat_messages, появившиеся после создания архивов: (имя, тип)
+ARCHIVE_ADDED_COLUMNS = (('html', 'TEXT'), ('html_version', 'TEXT'), ('timings', 'TEXT'))
+
+
+def _create_archive(cursor, is_new):
+    """Таблица сообщений архива; в существующий архив добавляются новые колонки"""
+    if is_new:
+        # auto_vacuum нужно включить до создания первой таблицы
+        cursor.execute('PRAGMA auto_vacuum = INCREMENTAL')
+
+    cursor.execute('BEGIN IMMEDIATE')
+    try:
+        cursor.execute('''
+                       CREATE TABLE IF NOT EXISTS chat_messages
+                       (
+                           id            INTEGER PRIMARY KEY,
+                           session_id    TEXT NOT NULL,
+                           role          TEXT NOT NULL,
+                           content       TEXT NOT NULL,
+                           thinking      TEXT,
+                           response_time REAL,
+                           timestamp     DATETIME,
+                           files         TEXT,
+                           user_id       INTEGER,
+                           html          TEXT,
+                           html_version  TEXT,
+                           timings       TEXT
+                       )
+                       ''')
+        columns = _table_columns(cursor, 'chat_messages')
+        for name, column_type in ARCHIVE_ADDED_COLUMNS:
+            if name not in columns:
+                cursor.execute(f'ALTER TABLE chat_messages ADD COLUMN {name} {column_type} DEFAULT NULL')
+        cursor.execute('''
+                       CREATE INDEX IF NOT EXISTS idx_archive_session_timestamp
+                           ON chat_messages(session_id, timestamp)
+                       ''')
+        cursor.execute('COMMIT')
+    except Exception:
+        cursor.execute('ROLLBACK')
+        raise
+
+
+def ensure_archive_schema(archive_path):
+    """Создает или обновляет схему архивной БД один раз на процесс.
+
+    Чтения архива только подключают файл (ATTACH) без DDL. BEGIN IMMEDIATE
+    не дает двум процессам одновременно добавлять колонки.
+    """
+    key = os.path.abspath(archive_path)
+    if key in _checked_archives:
+        return
+
+    with _checked_lock:
+        if key in _checked_archives:
+            return
+        is_new = not os.path.exists(archive_path)
+        conn = sqlite3.connect(archive_path, isolation_level=None)
+        try:
+            _create_archive(conn.cursor(), is_new)
+        finally:
+            conn.close()
+        _checked_archives.add(key)
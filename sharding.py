@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import hashlib
+import os
+import sqlite3
+from collections import namedtuple
+from threading import Lock
+
+from schema import ensure_schema
+
+# Файл с сообщениями, его блокировка и архив этого файла
+Shard = namedtuple('Shard', ['index', 'db_path', 'lock', 'archive_path'])
+
+
+def hash_shard(user_id, shard_count):
+    """Шард пользователя по хешу user_id (стабилен между процессами)"""
+    digest = hashlib.md5(str(user_id).encode('utf-8')).hexdigest()
+    return int(digest, 16) % shard_count
+
+
+def shard_paths(shard_dir, shard_count, archive_path=None):
+    """Пути файлов шардов и их архивов"""
+    paths = []
+    for index in range(shard_count):
+        db_path = os.path.join(shard_dir, f'chat_shard_{index}.db')
+        shard_archive = None
+        if archive_path:
+            root, ext = os.path.splitext(os.path.basename(archive_path))
+            shard_archive = os.path.join(shard_dir, f'{root}_shard_{index}{ext or ".db"}')
+        paths.append((db_path, shard_archive))
+    return paths
+
+
+class ShardRouter:
+    """Маршрутизация сообщений по файлам-шардам.
+
+    users и chat_sessions остаются в небольшой БД-каталоге, сообщения и
+    вложения пользователя лежат в шарде, номер которого записан в
+    user_shards (по умолчанию - хеш user_id). Каждый шард имеет свою
+    блокировку, поэтому записи разных пользователей не ждут друг друга.
+    """
+
+    def __init__(self, catalog_path, shard_count, shard_dir='shards', archive_path=None):
+        self.catalog_path = catalog_path
+        self.shard_count = shard_count
+        self.catalog_lock = Lock()
+
+        os.makedirs(shard_dir, exist_ok=True)
+        self.shards = []
+        for index, (db_path, shard_archive) in enumerate(shard_paths(shard_dir, shard_count, archive_path)):
+            ensure_schema(db_path)
+            self.shards.append(Shard(index, db_path, Lock(), shard_archive))
+
+        ensure_schema(catalog_path)
+
+        # Кеши каталога: session_id -> user_id, user_id -> номер шарда
+        self._session_users = {}
+        self._user_shards = {}
+
+    def shard_for_user(self, user_id):
+        """Шард пользователя; новый пользователь закрепляется за шардом по хешу"""
+        shard_index = self._user_shards.get(user_id)
+        if shard_index is not None:
+            return self.shards[shard_index]
+
+        with self.catalog_lock:
+            conn = sqlite3.connect(self.catalog_path)
+            cursor = conn.cursor()
+
+            cursor.execute('SELECT shard FROM user_shards WHERE user_id = ?', (user_id,))
+            row = cursor.fetchone()
+            if row:
+                shard_index = row[0]
+            else:
+                shard_index = hash_shard(user_id, self.shard_count)
+                cursor.execute('INSERT INTO user_shards (user_id, shard) VALUES (?, ?)', (user_id, shard_index))
+                conn.commit()
+
+            conn.close()
+
+        if shard_index >= self.shard_count:
+            raise RuntimeError(f"Пользователь {user_id} закреплен за шардом {shard_index}, "
+                               f"а настроено {self.shard_count} - запустите rebalance_shards.py")
+
+        self._user_shards[user_id] = shard_index
+        return self.shards[shard_index]
+
+    def user_for_session(self, session_id):
+        """Владелец сессии по каталогу"""
+        user_id = self._session_users.get(session_id)
+        if user_id is not None:
+            return user_id
+
+        with self.catalog_lock:
+            conn = sqlite3.connect(self.catalog_path)
+            cursor = conn.cursor()
+            cursor.execute('SELECT user_id FROM chat_sessions WHERE session_id = ?', (session_id,))
+            row = cursor.fetchone()
+            conn.close()
+
+        if row is None:
+            raise KeyError(f"Сессия {session_id} не найдена в каталоге")
+
+        self._session_users[session_id] = row[0]
+        return row[0]
+
+    def locate(self, session_id):
+        """Шард, в котором хранятся сообщения сессии"""
+        return self.shard_for_user(self.user_for_session(session_id))
+
+    def forget_session(self, session_id):
+        self._session_users.pop(session_id, None)
+
+    def forget_users(self):
+        """Сброс кеша после перебалансировки"""
+        self._user_shards.clear()
+
+    def _execute_catalog(self, sql, params):
+        with self.catalog_lock:
+            conn = sqlite3.connect(self.catalog_path)
+            cursor = conn.cursor()
+            cursor.execute(sql, params)
+            conn.commit()
+            conn.close()
+
+    def touch_session(self, session_id):
+        """Обновляет updated_at сессии в каталоге (короткая отдельная транзакция)"""
+        self._execute_catalog('UPDATE chat_sessions SET updated_at = CURRENT_TIMESTAMP WHERE session_id = ?',
+                              (session_id,))
+
+    def is_archived(self, session_id):
+        with self.catalog_lock:
+            conn = sqlite3.connect(self.catalog_path)
+            cursor = conn.cursor()
+            cursor.execute('SELECT archived_at FROM chat_sessions WHERE session_id = ?', (session_id,))
+            row = cursor.fetchone()
+            conn.close()
+        return bool(row and row[0])
+
+    def set_archived(self, session_id, archived):
+        if archived:
+            self._execute_catalog('UPDATE chat_sessions SET archived_at = CURRENT_TIMESTAMP WHERE session_id = ?',
+                                  (session_id,))
+        else:
+            self._execute_catalog('UPDATE chat_sessions SET archived_at = NULL WHERE session_id = ?',
+                                  (session_id,))
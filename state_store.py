@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import sqlite3
+import time
+import uuid
+from threading import Lock
+
+from schema import ensure_schema
+
+
+class MemoryStateStore:
+    """Общее состояние в памяти процесса (по умолчанию).
+
+    Подходит для одного процесса: версии контекстов и флаг загрузки модели
+    видны только ему, а инвалидации кеша рассылать некому.
+    """
+
+    shared = False
+
+    def __init__(self):
+        self.lock = Lock()
+        self._values = {}  # key -> (value, updated_at)
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self._values.get(key)
+            return entry[0] if entry is not None else default
+
+    def set(self, key, value):
+        with self.lock:
+            self._values[key] = (value, time.time())
+
+    def delete(self, key):
+        with self.lock:
+            self._values.pop(key, None)
+
+    def purge(self, prefix, max_age):
+        """Удаляет ключи с префиксом prefix, не менявшиеся max_age секунд"""
+        threshold = time.time() - max_age
+        with self.lock:
+            stale = [key for key, (_, updated_at) in self._values.items()
+                     if key.startswith(prefix) and updated_at < threshold]
+            for key in stale:
+                del self._values[key]
+        return len(stale)
+
+    def publish(self, payload):
+        """Событие для других процессов - в памяти их нет"""
+        return None
+
+    def events_since(self, seq):
+        return seq, []
+
+    def purge_events(self, max_age):
+        return 0
+
+
+class SQLiteStateStore:
+    """Общее состояние в основной БД: видно всем процессам и воркерам.
+
+    Значения хранятся как JSON в shared_state. События (инвалидации
+    кеша) пишутся в cache_invalidations с возрастающим seq, каждый
+    процесс читает новые события периодически и пропускает свои.
+    """
+
+    shared = True
+
+    def __init__(self, db_path="chat_history.db"):
+        self.db_path = db_path
+        self.lock = Lock()
+        # Отличает события этого процесса от чужих
+        self.origin = f"{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        with self.lock:
+            ensure_schema(self.db_path)
+
+    def get(self, key, default=None):
+        with self.lock:
+            conn = sqlite3.connect(self.db_path)
+            cursor = conn.cursor()
+
+            cursor.execute('SELECT value FROM shared_state WHERE key = ?', (key,))
+            row = cursor.fetchone()
+            conn.close()
+
+        return json.loads(row[0]) if row is not None else default
+
+    def set(self, key, value):
+        with self.lock:
+            conn = sqlite3.connect(self.db_path)
+            cursor = conn.cursor()
+
+            cursor.execute('INSERT OR REPLACE INTO shared_state (key, value, updated_at) VALUES (?, ?, ?)',
+                           (key, json.dumps(value, ensure_ascii=False), time.time()))
+
+            conn.commit()
+            conn.close()
+
+    def delete(self, key):
+        with self.lock:
+            conn = sqlite3.connect(self.db_path)
+            cursor = conn.cursor()
+
+            cursor.execute('DELETE FROM shared_state WHERE key = ?', (key,))
+
+            conn.commit()
+            conn.close()
+
+    def purge(self, prefix, max_age):
+        """Удаляет ключи с префиксом prefix, не менявшиеся max_age секунд"""
+        with self.lock:
+            conn = sqlite3.connect(self.db_path)
+            cursor = conn.cursor()
+
+            cursor.execute('DELETE FROM shared_state WHERE key >= ? AND key < ? AND updated_at < ?',
+                           (prefix, prefix + '￿', time.time() - max_age))
+            purged = cursor.rowcount
+
+            conn.commit()
+            conn.close()
+
+        return purged
+
+    def publish(self, payload):
+        """Публикует событие для других процессов, возвращает его seq"""
+        with self.lock:
+            conn = sqlite3.connect(self.db_path)
+            cursor = conn.cursor()
+
+            cursor.execute('INSERT INTO cache_invalidations (origin, payload, created_at) VALUES (?, ?, ?)',
+                           (self.origin, json.dumps(payload, ensure_ascii=False), time.time()))
+            seq = cursor.lastrowid
+
+            conn.commit()
+            conn.close()
+
+        return seq
+
+    def events_since(self, seq):
+        """Чужие события после seq. Возвращает (последний seq, список событий).
+
+        seq=None - только узнать текущую позицию (при запуске процесса).
+        """
+        with self.lock:
+            conn = sqlite3.connect(self.db_path)
+            cursor = conn.cursor()
+
+            if seq is None:
+                cursor.execute('SELECT COALESCE(MAX(seq), 0) FROM cache_invalidations')
+                last = cursor.fetchone()[0]
+                conn.close()
+                return last, []
+
+            cursor.execute('''
+                           SELECT seq, origin, payload
+                           FROM cache_invalidations
+                           WHERE seq > ?
+                           ORDER BY seq
+                           ''', (seq,))
+            rows = cursor.fetchall()
+            conn.close()
+
+        if rows:
+            seq = rows[-1][0]
+        return seq, [json.loads(payload) for _, origin, payload in rows if origin != self.origin]
+
+    def purge_events(self, max_age):
+        with self.lock:
+            conn = sqlite3.connect(self.db_path)
+            cursor = conn.cursor()
+
+            cursor.execute('DELETE FROM cache_invalidations WHERE created_at < ?', (time.time() - max_age,))
+            purged = cursor.rowcount
+
+            conn.commit()
+            conn.close()
+
+        return purged
+
+
+def create_state_store(kind, db_path="chat_history.db"):
+    """Хранилище общего состояния по имени из конфигурации: memory или sqlite"""
+    if kind == 'memory':
+        return MemoryStateStore()
+    if kind == 'sqlite':
+        return SQLiteStateStore(db_path)
+    raise ValueError(f"Неизвестное хранилище состояния: {kind}")
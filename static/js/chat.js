@@ -3,6 +3,10 @@ class DeepSeekChat {
         this.attachedFiles = [];
         this.currentSessionId = null;
         this.sessions = [];
+        // WebSocket-канал (если сервер его поддерживает): requestId/operationId -> сообщение ожидания
+        this.socket = null;
+        this.socketRequests = new Map();
+        this.socketOperations = new Map();
         this.initializeElements();
         this.bindEvents();
         this.loadStatus();
@@ -10,6 +14,112 @@ class DeepSeekChat {
         this.loadHistory();
         this.initializeTheme();
         this.initializeSidebarState();
+        this.connectSocket();
+    }
+
+    connectSocket(retryDelay = 1000) {
+        if (!window.WebSocket) return;
+
+        const protocol = window.location.protocol === 'https:' ? 'wss:' : 'ws:';
+        const socket = new WebSocket(`${protocol}//${window.location.host}/ws`);
+        let opened = false;
+
+        socket.onopen = () => {
+            opened = true;
+            this.socket = socket;
+            // После переподключения снова подписываемся на незавершенные операции
+            this.socketOperations.forEach((_, operationId) => {
+                socket.send(JSON.stringify({type: 'subscribe', operation_id: operationId}));
+            });
+        };
+
+        socket.onmessage = (event) => this.handleSocketEvent(JSON.parse(event.data));
+
+        socket.onclose = () => {
+            this.socket = null;
+            // Если канал ни разу не открылся, сервер его не поддерживает - остаемся на REST
+            if (opened) {
+                setTimeout(() => this.connectSocket(Math.min(retryDelay * 2, 30000)), retryDelay);
+            }
+        };
+    }
+
+    sendViaSocket(message) {
+        const requestId = `${Date.now()}-${Math.random().toString(16).slice(2)}`;
+        const waitingMessageElement = this.addWaitingMessage();
+        this.socketRequests.set(requestId, waitingMessageElement);
+
+        this.socket.send(JSON.stringify({
+            type: 'send',
+            request_id: requestId,
+            message: message,
+            session_id: this.currentSessionId || ''
+        }));
+    }
+
+    handleSocketEvent(event) {
+        if (event.type === 'accepted') {
+            const waitingMessageElement = this.socketRequests.get(event.request_id);
+            if (!waitingMessageElement) return;
+            this.socketRequests.delete(event.request_id);
+
+            waitingMessageElement.dataset.operationId = event.operation_id;
+            this.currentSessionId = event.session_id;
+            this.socketOperations.set(event.operation_id, {
+                element: waitingMessageElement,
+                finish: this.startElapsedTimer(waitingMessageElement)
+            });
+            return;
+        }
+
+        if (event.type === 'error') {
+            const waitingMessageElement = this.socketRequests.get(event.request_id);
+            if (waitingMessageElement) {
+                this.socketRequests.delete(event.request_id);
+                waitingMessageElement.remove();
+            }
+            this.showMessage('Ошибка: ' + event.error, 'error');
+            return;
+        }
+
+        const operation = this.socketOperations.get(event.operation_id);
+        if (!operation) return;
+        const element = operation.element;
+
+        if (event.type === 'queue') {
+            const thinkingElement = element.querySelector('.ai-thinking');
+            if (thinkingElement) {
+                thinkingElement.title = event.position > 0 ? `Место в очереди: ${event.position}` : '';
+            }
+        } else if (event.type === 'reasoning') {
+            const reasoningElement = element.querySelector('.stream-reasoning');
+            reasoningElement.classList.remove('hidden');
+            reasoningElement.textContent += event.text;
+            this.scrollToBottom();
+        } else if (event.type === 'token') {
+            element.querySelector('.stream-content').textContent += event.text;
+            this.scrollToBottom();
+        } else if (event.type === 'status') {
+            if (this.handleOperationUpdate(event, element)) {
+                this.socketOperations.delete(event.operation_id);
+                operation.finish();
+            }
+        }
+    }
+
+    async cancelOperation(operationId) {
+        if (!operationId) return;
+
+        if (this.socket) {
+            this.socket.send(JSON.stringify({type: 'cancel', operation_id: operationId}));
+            return;
+        }
+
+        try {
+            await fetch(`/cancel_operation/${operationId}`, {method: 'POST'});
+        } catch (error) {
+            console.error('Cancel error:', error);
+        }
     }
 
     initializeSidebarState() {
@@ -214,7 +324,7 @@ class DeepSeekChat {
                 this.elements.messages.innerHTML = '';
 
                 data.messages.forEach(msg => {
-                    this.addMessage(msg.role, msg.content, msg.files || [], msg.thinking, msg.response_time);
+                    this.addMessage(msg.role, msg.content, msg.files || [], msg.thinking, msg.response_time, msg.html);
                 });
 
                 this.renderSessions();
@@ -258,6 +368,12 @@ class DeepSeekChat {
         this.elements.sendBtn.disabled = true;
 
         try {
+            // Без вложений сообщение уходит по WebSocket, ответ приходит потоком
+            if (this.socket && attachedFiles.length === 0) {
+                this.sendViaSocket(message);
+                return;
+            }
+
             const formData = new FormData();
             formData.append('message', message);
             formData.append('session_id', this.currentSessionId || '');
@@ -274,7 +390,9 @@ class DeepSeekChat {
             });
 
             if (!response.ok) {
-                throw new Error(`HTTP error! status: ${response.status}`);
+                // При переполненной очереди (429) сервер объясняет причину отказа
+                const errorData = await response.json().catch(() => ({}));
+                throw new Error(errorData.error || `HTTP error! status: ${response.status}`);
             }
 
             const data = await response.json();
@@ -283,8 +401,8 @@ class DeepSeekChat {
                 // Показываем индикатор ожидания AI
                 const waitingMessageId = this.addWaitingMessage();
 
-                // Начинаем polling статуса
-                this.pollOperationStatus(data.operation_id, waitingMessageId);
+                // Подписываемся на изменения статуса (SSE, при недоступности - long-poll)
+                this.watchOperation(data.operation_id, waitingMessageId);
 
             } else {
                 this.showMessage('Ошибка: ' + data.error, 'error');
@@ -311,10 +429,17 @@ class DeepSeekChat {
             <div class="ai-thinking">
                 🧠 Думаю... <span class="dots"></span>
                 <div class="progress-info">Время: <span class="elapsed-time">0с</span></div>
+                <button class="cancel-operation-btn" title="Остановить генерацию">⏹ Отменить</button>
             </div>
+            <div class="thinking stream-reasoning hidden"></div>
+            <div class="stream-content"></div>
         </div>
     `;
 
+        messageDiv.querySelector('.cancel-operation-btn').addEventListener('click', () => {
+            this.cancelOperation(messageDiv.dataset.operationId);
+        });
+
         this.elements.messages.appendChild(messageDiv);
         this.scrollToBottom();
 
@@ -322,64 +447,135 @@ class DeepSeekChat {
     }
 
 
-    async pollOperationStatus(operationId, waitingMessageElement) {
+    startElapsedTimer(waitingMessageElement) {
         const startTime = Date.now();
 
+        // Время ожидания считаем на клиенте: сервер присылает только изменения
+        const elapsedTimer = setInterval(() => {
+            const elapsed = Math.floor((Date.now() - startTime) / 1000);
+            const elapsedTimeElement = waitingMessageElement.querySelector('.elapsed-time');
+            if (elapsedTimeElement) {
+                const minutes = Math.floor(elapsed / 60);
+                const seconds = elapsed % 60;
+                elapsedTimeElement.textContent = minutes > 0 ? `${minutes}м ${seconds}с` : `${seconds}с`;
+            }
+        }, 1000);
+
+        return () => clearInterval(elapsedTimer);
+    }
+
+    watchOperation(operationId, waitingMessageElement) {
+        waitingMessageElement.dataset.operationId = operationId;
+        const finish = this.startElapsedTimer(waitingMessageElement);
+
+        if (!window.EventSource) {
+            this.pollOperationStatus(operationId, waitingMessageElement, finish);
+            return;
+        }
+
+        // Основной канал - Server-Sent Events, при обрыве переходим на long-poll
+        let done = false;
+        const events = new EventSource(`/operation_events/${operationId}`);
+
+        events.onmessage = (event) => {
+            const data = JSON.parse(event.data);
+            if (this.handleOperationUpdate(data, waitingMessageElement)) {
+                done = true;
+                events.close();
+                finish();
+            }
+        };
+
+        events.onerror = () => {
+            events.close();
+            if (!done) {
+                console.warn('SSE недоступен, переключаюсь на long-poll');
+                this.pollOperationStatus(operationId, waitingMessageElement, finish);
+            }
+        };
+    }
+
+    handleOperationUpdate(data, waitingMessageElement) {
+        // Возвращает true, когда операция завершена
+        if (data.progress) {
+            const thinkingElement = waitingMessageElement.querySelector('.ai-thinking');
+            if (thinkingElement) {
+                thinkingElement.title = data.progress;
+            }
+        }
+
+        if (data.status === 'completed') {
+            // Убираем сообщение ожидания
+            waitingMessageElement.remove();
+
+            // Добавляем ТОЛЬКО ответ ассистента (сообщение пользователя уже показано)
+            const result = data.result;
+            this.addMessage('assistant', result.response, [], result.thinking, result.response_time,
+                result.html_response);
+            this.currentSessionId = result.session_id;
+            this.loadSessions();
+            return true;
+        }
+
+        if (data.status === 'error') {
+            waitingMessageElement.remove();
+            this.showMessage('Ошибка AI: ' + data.error, 'error');
+            return true;
+        }
+
+        if (data.status === 'cancelled') {
+            waitingMessageElement.remove();
+            this.showMessage('Генерация отменена', 'info');
+            return true;
+        }
+
+        return false;
+    }
+
+    async pollOperationStatus(operationId, waitingMessageElement, onFinish = () => {}) {
+        // Long-poll: сервер держит запрос, пока статус или прогресс не изменятся
+        let status = '';
+        let progress = '';
+
         const poll = async () => {
             try {
-                const response = await fetch(`/operation_status/${operationId}`);
+                const params = new URLSearchParams({wait: 25, status, progress});
+                const response = await fetch(`/operation_status/${operationId}?${params}`);
                 const data = await response.json();
 
                 if (!response.ok) {
                     throw new Error(data.error || 'Ошибка получения статуса');
                 }
 
-                // Обновляем время ожидания
-                const elapsed = Math.floor((Date.now() - startTime) / 1000);
-                const elapsedTimeElement = waitingMessageElement.querySelector('.elapsed-time');
-                if (elapsedTimeElement) {
-                    const minutes = Math.floor(elapsed / 60);
-                    const seconds = elapsed % 60;
-                    elapsedTimeElement.textContent = minutes > 0 ? `${minutes}м ${seconds}с` : `${seconds}с`;
+                if (this.handleOperationUpdate(data, waitingMessageElement)) {
+                    onFinish();
+                    return;
                 }
 
-                if (data.status === 'completed') {
-                    // Убираем сообщение ожидания
-                    waitingMessageElement.remove();
-
-                    // Добавляем ТОЛЬКО ответ ассистента (сообщение пользователя уже показано)
-                    const result = data.result;
-                    this.addMessage('assistant', result.response, [], result.thinking, result.response_time);
-                    this.currentSessionId = result.session_id;
-                    this.loadSessions();
-
-                } else if (data.status === 'error') {
-                    waitingMessageElement.remove();
-                    this.showMessage('Ошибка AI: ' + data.error, 'error');
-
-                } else {
-                    // Продолжаем polling через 2 секунды
-                    setTimeout(poll, 2000);
-                }
+                status = data.status;
+                progress = data.progress;
+                setTimeout(poll, 0);
 
             } catch (error) {
                 console.error('Polling error:', error);
                 waitingMessageElement.remove();
                 this.showMessage('Ошибка получения ответа: ' + error.message, 'error');
+                onFinish();
             }
         };
 
-        // Начинаем polling
         poll();
     }
 
-    addMessage(role, content, files = [], thinking = '', responseTime = null) {
+    addMessage(role, content, files = [], thinking = '', responseTime = null, html = null) {
         const messageDiv = document.createElement('div');
         messageDiv.className = `message ${role}`;
 
         let filesHtml = '';
         if (files && files.length > 0) {
-            filesHtml = `<div class="message-files">📎 Файлы: ${files.join(', ')}</div>`;
+            // В истории файлы приходят ссылками {name, hash, size}, при отправке - именами
+            const names = files.map(f => typeof f === 'string' ? f : f.name);
+            filesHtml = `<div class="message-files">📎 Файлы: ${names.join(', ')}</div>`;
         }
 
         let thinkingHtml = '';
@@ -399,7 +595,7 @@ class DeepSeekChat {
             </div>
             ${filesHtml}
             ${thinkingHtml}
-            <div class="message-content">${this.formatMessage(content)}</div>
+            <div class="message-content">${html || this.formatMessage(content)}</div>
             ${timeHtml}
         `;
 
@@ -408,6 +604,7 @@ class DeepSeekChat {
     }
 
     formatMessage(content) {
+        // HTML ответов приходит с сервера (сохранен вместе с сообщением), здесь - сообщения пользователя
         return marked.parse(content);
     }
 
@@ -526,7 +723,7 @@ class DeepSeekChat {
             if (data.success && data.messages) {
                 this.elements.messages.innerHTML = '';
                 data.messages.forEach(msg => {
-                    this.addMessage(msg.role, msg.content, msg.files || [], msg.thinking, msg.response_time);
+                    this.addMessage(msg.role, msg.content, msg.files || [], msg.thinking, msg.response_time, msg.html);
                 });
                 this.scrollToBottom();
             }
@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Трассировка запросов и операций.
+
+Трасса начинается на запрос (Flask) или задачу очереди и состоит из
+вложенных спанов: этапы StageTimer (разбор вложений, модель, рендер...)
+и вызовы database.py. Текущий спан хранится в contextvars, поэтому
+потоки запросов не мешают друг другу, а asyncio.to_thread переносит
+его в поток автоматически. В задачу очереди контекст передается через
+payload (inject / trace(parent=...)) - в том числе в другой процесс.
+
+Сэмплирование решается один раз на трассу: вне выбранной трассы span()
+возвращает общий пустой объект, и накладные расходы - одно чтение
+contextvar. Завершенные спаны попадают в кольцевой буфер (для
+/admin/traces) и, если задан файл, в JSONL из фонового потока.
+"""
+
+import contextvars
+import functools
+import json
+import logging
+import os
+import queue
+import random
+import threading
+import time
+import types
+from collections import deque
+
+_current = contextvars.ContextVar('trace_span', default=None)
+log = logging.getLogger(__name__)
+
+
+class Span:
+    __slots__ = ('tracer', 'trace_id', 'span_id', 'parent_id', 'name', 'attributes', 'start', '_started',
+                 'duration_ms', 'status', 'error', 'thread', '_token')
+
+    def __init__(self, tracer, trace_id, parent_id, name, attributes):
+        self.tracer = tracer
+        self.trace_id = trace_id
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.name = name
+        self.attributes = attributes
+        self.start = time.time()
+        self._started = time.perf_counter()
+        self.duration_ms = None
+        self.status = 'ok'
+        self.error = None
+        self.thread = threading.current_thread().name
+        self._token = None
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def context(self):
+        """Контекст для продолжения трассы в другом потоке или процессе"""
+        return {'trace_id': self.trace_id, 'span_id': self.span_id}
+
+    def to_dict(self):
+        return {
+            'trace_id': self.trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'name': self.name,
+            'start': round(self.start, 6),
+            'duration_ms': self.duration_ms,
+            'status': self.status,
+            'error': self.error,
+            'thread': self.thread,
+            'attributes': self.attributes
+        }
+
+    def __enter__(self):
+        self._token = _current.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.finish(exc)
+        return False
+
+    def finish(self, error=None):
+        self.duration_ms = round((time.perf_counter() - self._started) * 1000, 3)
+        if error is not None:
+            self.status = 'error'
+            self.error = f"{type(error).__name__}: {error}"
+        if self._token is not None:
+            _current.reset(self._token)
+            self._token = None
+        self.tracer.export(self)
+
+
+class _NullSpan:
+    """Спан вне выбранной трассы: ничего не записывает"""
+
+    trace_id = None
+
+    def set(self, **attributes):
+        pass
+
+    def context(self):
+        return None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+    def finish(self, error=None):
+        pass
+
+
+NULL_SPAN = _NullSpan()
+
+
+class _NoTrace:
+    """Невыбранная трасса: скрывает внешний спан, чтобы вложенные вызовы его не продолжали"""
+
+    def __init__(self):
+        self._token = None
+
+    def __enter__(self):
+        self._token = _current.set(None)
+        return NULL_SPAN
+
+    def __exit__(self, exc_type, exc, tb):
+        _current.reset(self._token)
+        return False
+
+
+class Tracer:
+    """Создание трасс и спанов, сэмплирование и экспорт.
+
+    sample_rate - доля новых трасс, которые записываются (0..1);
+    продолжение трассы из inject() записывается всегда.
+    """
+
+    def __init__(self, sample_rate=0.0, buffer_size=5000, path=None):
+        self.lock = threading.Lock()
+        self.buffer = deque(maxlen=buffer_size)
+        self._queue = None
+        self.configure(sample_rate, buffer_size, path)
+
+    def configure(self, sample_rate, buffer_size, path=None):
+        """Настройки из конфигурации приложения; path - JSONL-файл спанов или None"""
+        with self.lock:
+            self.sample_rate = max(0.0, min(1.0, float(sample_rate)))
+            if buffer_size != self.buffer.maxlen:
+                self.buffer = deque(self.buffer, maxlen=buffer_size)
+            self.path = path
+            if path and self._queue is None:
+                self._queue = queue.SimpleQueue()
+                writer = threading.Thread(target=self._write_spans, name='trace-writer')
+                writer.daemon = True
+                writer.start()
+
+    def trace(self, name, parent=None, **attributes):
+        """Корневой спан новой трассы или продолжение трассы parent (см. inject)"""
+        if parent:
+            return Span(self, parent['trace_id'], parent['span_id'], name, attributes)
+        if self.sample_rate and random.random() < self.sample_rate:
+            return Span(self, os.urandom(16).hex(), None, name, attributes)
+        return _NoTrace()
+
+    def span(self, name, **attributes):
+        """Вложенный спан текущей трассы; вне трассы - пустой"""
+        parent = _current.get()
+        if parent is None:
+            return NULL_SPAN
+        return Span(self, parent.trace_id, parent.span_id, name, attributes)
+
+    def current(self):
+        return _current.get() or NULL_SPAN
+
+    def inject(self):
+        """Контекст текущей трассы для payload задачи или None"""
+        return self.current().context()
+
+    def export(self, span):
+        record = span.to_dict()
+        with self.lock:
+            self.buffer.append(record)
+            spans = self._queue if self.path else None
+        if spans is not None:
+            spans.put(record)
+
+    def _write_spans(self):
+        """Фоновая запись спанов в JSONL: запросы не ждут диск"""
+        while True:
+            records = [self._queue.get()]
+            while True:
+                try:
+                    records.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            path = self.path
+            if not path:
+                continue
+            try:
+                with open(path, 'a', encoding='utf-8') as f:
+                    for record in records:
+                        f.write(json.dumps(record, ensure_ascii=False, default=str) + '\n')
+            except OSError:
+                log.exception("Ошибка записи трасс в %s", path)
+
+    def recent(self, limit=20, trace_id=None):
+        """Последние трассы из буфера: корневой спан и все спаны трассы по времени начала"""
+        with self.lock:
+            records = list(self.buffer)
+
+        traces = {}
+        for record in records:
+            if trace_id is None or record['trace_id'] == trace_id:
+                traces.setdefault(record['trace_id'], []).append(record)
+
+        result = []
+        for tid, spans in traces.items():
+            spans.sort(key=lambda record: record['start'])
+            root = next((record for record in spans if record['parent_id'] is None), spans[0])
+            result.append({
+                'trace_id': tid,
+                'name': root['name'],
+                'start': root['start'],
+                'duration_ms': root['duration_ms'],
+                'status': 'error' if any(record['status'] == 'error' for record in spans) else 'ok',
+                'spans': spans
+            })
+
+        result.sort(key=lambda trace: trace['start'], reverse=True)
+        return result[:limit]
+
+
+TRACER = Tracer()
+
+
+def span(name, **attributes):
+    return TRACER.span(name, **attributes)
+
+
+def trace_methods(prefix):
+    """Декоратор класса: спан на каждый публичный метод ('prefix.Класс.метод') внутри трассы"""
+    def decorate(cls):
+        for name, attribute in list(vars(cls).items()):
+            if name.startswith('_') or not isinstance(attribute, types.FunctionType):
+                continue
+            setattr(cls, name, _traced(attribute, f"{prefix}.{cls.__name__}.{name}"))
+        return cls
+    return decorate
+
+
+def _traced(function, name):
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        if _current.get() is None:
+            return function(*args, **kwargs)
+        with TRACER.span(name):
+            return function(*args, **kwargs)
+    return wrapper
@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import codecs
+
+from werkzeug.http import parse_options_header
+from werkzeug.sansio.multipart import MultipartDecoder, Field, File, Data, Epilogue, NEED_DATA
+
+
+class UploadError(Exception):
+    """Запрос с вложениями отклонен. status - HTTP-код ответа"""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+def normalize_files(files):
+    """Вложения из JSON-запроса (поле files) в виде [{'name': str, 'content': str}].
+
+    Прочие ключи отбрасываются: ссылки на сохраненные файлы (hash) строит
+    только database.py. Не список объектов со строками - UploadError (400).
+    """
+    if not files:
+        return []
+    if not isinstance(files, list):
+        raise UploadError('files: ожидается список вложений')
+
+    normalized = []
+    for file_data in files:
+        if not isinstance(file_data, dict):
+            raise UploadError('Вложение должно быть объектом {name, content}')
+        name = file_data.get('name', 'unknown')
+        content = file_data.get('content', '')
+        if not isinstance(name, str) or not isinstance(content, str):
+            raise UploadError('name и content вложения должны быть строками')
+        normalized.append({'name': name, 'content': content})
+    return normalized
+
+
+class TextDecoder:
+    """Декодирование текста по мере поступления байтов, за один проход.
+
+    Кодировка определяется по BOM, иначе байты декодируются как UTF-8,
+    при первой ошибке - как cp1251, затем latin-1. Уже декодированная
+    часть при смене кодировки перекодируется из памяти: строгий декодер
+    однозначен, encode() возвращает исходные байты. Файл не читается
+    повторно и не сохраняется на диск.
+    """
+
+    ENCODINGS = ('utf-8', 'cp1251', 'latin-1')
+
+    def __init__(self, max_chars=None):
+        self.max_chars = max_chars
+        self.encoding = None
+        self._fallbacks = ()
+        self._decoder = None
+        self._head = b''  # первые байты до проверки BOM
+        self._parts = []
+        self._length = 0
+
+    def feed(self, data):
+        if self._decoder is None:
+            self._head += data
+            if len(self._head) < 4:
+                return
+            data, self._head = self._start(self._head), b''
+        self._decode(data)
+
+    def finish(self):
+        """Весь текст файла"""
+        if self._decoder is None:
+            self._decode(self._start(self._head))
+        self._decode(b'', final=True)
+        return ''.join(self._parts)
+
+    def _start(self, head):
+        """Выбирает кодировку по началу файла, возвращает данные без BOM UTF-8"""
+        if head.startswith(codecs.BOM_UTF8):
+            head = head[len(codecs.BOM_UTF8):]
+            encodings = self.ENCODINGS
+        elif head.startswith((codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)):
+            # Декодер UTF-16 сам определяет порядок байтов по BOM
+            encodings = ('utf-16',)
+        else:
+            encodings = self.ENCODINGS
+        self._switch(encodings)
+        return head
+
+    def _switch(self, encodings):
+        self.encoding, self._fallbacks = encodings[0], encodings[1:]
+        # Для последней кодировки ошибки не фатальны
+        errors = 'strict' if self._fallbacks else 'replace'
+        self._decoder = codecs.getincrementaldecoder(self.encoding)(errors=errors)
+
+    def _decode(self, data, final=False):
+        pending = self._decoder.getstate()[0]
+        try:
+            text = self._decoder.decode(data, final)
+        except UnicodeDecodeError:
+            # Исходные байты уже декодированной части и необработанный остаток
+            raw = ''.join(self._parts).encode(self.encoding) + pending + data
+            self._parts, self._length = [], 0
+            self._switch(self._fallbacks)
+            self._decode(raw, final)
+            return
+
+        if text:
+            self._parts.append(text)
+            self._length += len(text)
+            if self.max_chars is not None and self._length > self.max_chars:
+                raise UploadError(f'больше {self.max_chars // 4} токенов', 413)
+
+
+class _FieldPart:
+    """Обычное поле формы: значение целиком в памяти (размер ограничивает MultipartDecoder)"""
+
+    def __init__(self, name):
+        self.name = name
+        self._chunks = []
+
+    def feed(self, data):
+        self._chunks.append(data)
+
+    def close(self):
+        pass
+
+    def value(self):
+        return b''.join(self._chunks).decode('utf-8', errors='replace')
+
+
+class _SkippedPart:
+    """Пустое поле выбора файла: данные отбрасываются"""
+
+    def feed(self, data):
+        pass
+
+    def close(self):
+        pass
+
+
+class _FilePart:
+    """Файл, который декодируется в потоке запроса по мере чтения его блоков"""
+
+    def __init__(self, pipeline, field, filename):
+        self.pipeline = pipeline
+        self.field = field
+        self.filename = filename
+        self.size = 0
+        self.content = None
+        self._decoder = TextDecoder(max_chars=pipeline.max_file_tokens * 4)
+
+    def feed(self, data):
+        self.size += len(data)
+        if self.size > self.pipeline.max_file_bytes:
+            raise UploadError(f'Файл {self.filename} больше {self.pipeline.max_file_bytes // (1024 * 1024)} МБ',
+                              413)
+        self._decode(self._decoder.feed, data)
+
+    def close(self):
+        self.content = self._decode(self._decoder.finish)
+
+    def result(self):
+        return {'name': self.filename, 'content': self.content}
+
+    def _decode(self, step, *args):
+        try:
+            return step(*args)
+        except UploadError as e:
+            raise UploadError(f'Файл {self.filename} слишком большой для контекста модели: {e}', e.status)
+
+
+class UploadPipeline:
+    """Потоковый разбор multipart-запросов с текстовыми вложениями.
+
+    Тело запроса читается блоками по chunk_size прямо из входного потока
+    (без временных файлов werkzeug и без uploads/), и каждый блок файла
+    сразу декодируется в потоке запроса: инкрементальный декодер дешевле
+    чтения из сети, а общий пул потоков, ждущих данных медленных
+    клиентов, исчерпывался бы несколькими зависшими загрузками. Размер в
+    байтах и оценка токенов (как estimate_tokens: символы / 4)
+    проверяются по ходу чтения, поэтому память на вложение ограничена
+    лимитом токенов независимо от размера файла.
+    """
+
+    def __init__(self, max_file_bytes=5 * 1024 * 1024, max_file_tokens=64000, max_files=10,
+                 max_field_bytes=1024 * 1024, chunk_size=64 * 1024):
+        self.max_file_bytes = max_file_bytes
+        self.max_file_tokens = max_file_tokens
+        self.max_files = max_files
+        self.max_field_bytes = max_field_bytes
+        self.chunk_size = chunk_size
+
+    def parse(self, stream, content_type, allowed=None):
+        """Разбирает multipart-запрос.
+
+        Возвращает (поля {имя: значение}, файлы [(имя поля, {'name', 'content'})]).
+        allowed(filename) - проверка типа файла до чтения его содержимого.
+        """
+        mimetype, options = parse_options_header(content_type or '')
+        boundary = options.get('boundary')
+        if mimetype != 'multipart/form-data' or not boundary:
+            raise UploadError('Ожидается multipart/form-data')
+
+        # Несколько служебных полей (message, session_id) сверх файлов
+        decoder = MultipartDecoder(boundary.encode('latin-1'), max_form_memory_size=self.max_field_bytes,
+                                   max_parts=self.max_files + 10)
+        fields = []
+        files = []
+        part = None
+
+        finished = False
+        while not finished:
+            chunk = stream.read(self.chunk_size)
+            decoder.receive_data(chunk or None)
+
+            event = decoder.next_event()
+            while event is not NEED_DATA:
+                if isinstance(event, Field):
+                    part = _FieldPart(event.name)
+                    fields.append(part)
+                elif isinstance(event, File):
+                    part = self._file_part(event, allowed, files)
+                elif isinstance(event, Data):
+                    part.feed(event.data)
+                    if not event.more_data:
+                        part.close()
+                elif isinstance(event, Epilogue):
+                    finished = True
+                    break
+                event = decoder.next_event()
+
+            if not chunk and not finished:
+                raise UploadError('Запрос оборвался до конца вложений')
+
+        return {field.name: field.value() for field in fields}, [(file.field, file.result()) for file in files]
+
+    def _file_part(self, event, allowed, files):
+        if not event.filename:
+            return _SkippedPart()
+        if allowed is not None and not allowed(event.filename):
+            raise UploadError(f'Неподдерживаемый тип файла: {event.filename}')
+        if len(files) >= self.max_files:
+            raise UploadError(f'Не больше {self.max_files} файлов в одном сообщении')
+
+        part = _FilePart(self, event.name, event.filename)
+        files.append(part)
+        return part
@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Генератор синтетической нагрузки для chat_history.db.
+
+Заполняет БД пользователями, сессиями, сообщениями и вложениями
+с распределениями размеров, похожими на реальную работу чата:
+короткие вопросы, длинные ответы с рассуждениями, редкие большие
+вложения, которые часто повторяются (один и тот же CSV в разных сессиях).
+
+    python workload.py --db bench.db --users 10000 --messages 50000000
+"""
+
+import argparse
+import json
+import os
+import random
+import sqlite3
+import string
+import time
+from datetime import datetime, timedelta
+
+from compression import pack_text
+from database import _store_attachments
+from schema import migrate
+
+# Распределения (медианы в символах)
+SESSIONS_PER_USER_MEAN = 8
+MESSAGES_PER_SESSION_MU = 2.3  # lognormal: медиана ~10 сообщений
+MESSAGES_PER_SESSION_SIGMA = 1.0
+USER_MESSAGE_MEDIAN = 200
+ASSISTANT_MESSAGE_MEDIAN = 1500
+THINKING_MEDIAN = 2000
+THINKING_PROBABILITY = 0.9
+ATTACHMENT_PROBABILITY = 0.05
+ATTACHMENT_MEDIAN = 20000
+ATTACHMENT_MAX = 200000
+ATTACHMENT_POOL_SIZE = 500  # разных файлов, остальные - повторы
+
+WORDS = ['данные', 'отчет', 'продажи', 'SELECT', 'FROM', 'WHERE', 'клиент', 'анализ', 'таблица',
+         'итого', 'метрика', 'KPI', 'план', 'факт', 'значение', 'def', 'return', 'import',
+         'результат', 'запрос', 'индекс', 'сумма', 'месяц', 'рост', 'снижение', 'вывод']
+
+
+class WorkloadGenerator:
+    def __init__(self, seed=42, compress_threshold=4096):
+        self.random = random.Random(seed)
+        self.compress_threshold = compress_threshold
+        # Один большой текст, из которого нарезаются сообщения - быстро и похоже на живой текст
+        self.corpus = ' '.join(self.random.choice(WORDS) for _ in range(400000))
+        self.attachment_pool = [self._make_attachment(i) for i in range(ATTACHMENT_POOL_SIZE)]
+        # Популярные файлы повторяются чаще (распределение Ципфа)
+        self.attachment_weights = [1 / (rank + 1) for rank in range(ATTACHMENT_POOL_SIZE)]
+
+    def _length(self, median, maximum=None):
+        length = int(self.random.lognormvariate(0, 1) * median) + 1
+        return min(length, maximum) if maximum else length
+
+    def text(self, median, maximum=None):
+        """Случайный текст с длиной из lognormal-распределения"""
+        length = min(self._length(median, maximum), len(self.corpus))
+        start = self.random.randrange(0, len(self.corpus) - length + 1)
+        return self.corpus[start:start + length]
+
+    def _make_attachment(self, index):
+        name = f"export_{index}_{''.join(self.random.choices(string.ascii_lowercase, k=4))}.csv"
+        return {'name': name, 'content': self.text(ATTACHMENT_MEDIAN, ATTACHMENT_MAX)}
+
+    def attachments(self):
+        """Вложения к сообщению пользователя (чаще всего пусто)"""
+        if self.random.random() >= ATTACHMENT_PROBABILITY:
+            return None
+        count = self.random.choice([1, 1, 1, 2, 3])
+        return self.random.choices(self.attachment_pool, weights=self.attachment_weights, k=count)
+
+    def message(self, role):
+        """(content, thinking, response_time, files) для одного сообщения"""
+        if role == 'user':
+            return self.text(USER_MESSAGE_MEDIAN), '', 0, self.attachments()
+
+        thinking = self.text(THINKING_MEDIAN) if self.random.random() < THINKING_PROBABILITY else ''
+        response_time = round(self.random.lognormvariate(3.5, 1.0), 2)
+        return self.text(ASSISTANT_MESSAGE_MEDIAN), thinking, response_time, None
+
+    def sessions_for_user(self):
+        return max(1, int(self.random.expovariate(1 / SESSIONS_PER_USER_MEAN)))
+
+    def messages_for_session(self):
+        count = int(self.random.lognormvariate(MESSAGES_PER_SESSION_MU, MESSAGES_PER_SESSION_SIGMA))
+        return max(2, count - count % 2)  # пары вопрос-ответ
+
+    def _pack(self, value):
+        return pack_text(value, self.compress_threshold)
+
+    def populate(self, db_path, users, messages, batch_size=5000):
+        """Заполняет БД. Возвращает статистику сгенерированных данных"""
+        migrate(db_path)
+        conn = sqlite3.connect(db_path)
+        cursor = conn.cursor()
+        cursor.execute('PRAGMA synchronous = OFF')
+
+        stats = {'users': 0, 'sessions': 0, 'messages': 0, 'attachments': 0}
+        now = datetime.now()
+        pending = []
+        start_time = time.time()
+
+        def flush():
+            cursor.executemany('''
+                               INSERT INTO chat_messages
+                                   (session_id, role, content, thinking, response_time, timestamp, files, user_id)
+                               VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                               ''', pending)
+            pending.clear()
+            conn.commit()
+
+        user_ids = []
+        for u in range(users):
+            cursor.execute('INSERT OR IGNORE INTO users (username, password_hash) VALUES (?, ?)',
+                           (f'bench_user_{u}', 'x'))
+            cursor.execute('SELECT id FROM users WHERE username = ?', (f'bench_user_{u}',))
+            user_ids.append(cursor.fetchone()[0])
+        stats['users'] = users
+        conn.commit()
+
+        session_number = 0
+        while stats['messages'] < messages:
+            user_id = self.random.choice(user_ids)
+            for _ in range(self.sessions_for_user()):
+                session_id = f'session_{user_id}_bench_{session_number}'
+                session_number += 1
+
+                moment = now - timedelta(minutes=self.random.randint(0, 2 * 365 * 24 * 60))
+                created_at = moment
+                count = min(self.messages_for_session(), messages - stats['messages'])
+
+                for i in range(count):
+                    role = 'user' if i % 2 == 0 else 'assistant'
+                    content, thinking, response_time, files = self.message(role)
+                    moment += timedelta(seconds=response_time or self.random.randint(5, 600))
+
+                    files_json = None
+                    if files:
+                        files_json = json.dumps(_store_attachments(cursor, files, self._pack))
+                        stats['attachments'] += len(files)
+
+                    pending.append((session_id, role, self._pack(content), self._pack(thinking),
+                                    response_time, moment.strftime('%Y-%m-%d %H:%M:%S'), files_json, user_id))
+
+                cursor.execute('''
+                               INSERT INTO chat_sessions (user_id, session_id, title, created_at, updated_at)
+                               VALUES (?, ?, ?, ?, ?)
+                               ''', (user_id, session_id, self.text(30, 50),
+                                     created_at.strftime('%Y-%m-%d %H:%M:%S'), moment.strftime('%Y-%m-%d %H:%M:%S')))
+
+                stats['sessions'] += 1
+                stats['messages'] += count
+
+                if len(pending) >= batch_size:
+                    flush()
+                    elapsed = time.time() - start_time
+                    print(f"⏳ {stats['messages']:,} / {messages:,} сообщений "
+                          f"({stats['messages'] / elapsed:,.0f} в секунду)", end='\r')
+
+                if stats['messages'] >= messages:
+                    break
+
+        flush()
+        cursor.execute('ANALYZE')
+        conn.close()
+        print()
+        return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Генерация синтетической БД чата')
+    parser.add_argument('--db', default='bench_history.db', help='путь к создаваемой БД')
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--messages', type=int, default=1000000)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    start_time = time.time()
+    stats = WorkloadGenerator(seed=args.seed).populate(args.db, args.users, args.messages)
+    elapsed = time.time() - start_time
+
+    size_mb = os.path.getsize(args.db) / 1024 / 1024
+    print(f"✅ Создано за {elapsed:.1f} с: пользователей {stats['users']:,}, сессий {stats['sessions']:,}, "
+          f"сообщений {stats['messages']:,}, вложений {stats['attachments']:,}")
+    print(f"📊 Размер БД: {size_mb:.1f} МБ")
+
+
+if __name__ == '__main__':
+    main()
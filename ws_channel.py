@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import json
+import threading
+
+from operations import FINISHED_STATUSES
+from uploads import UploadError, normalize_files
+
+
+class ChatChannel:
+    """Протокол WebSocket-канала чата: одно соединение на вкладку.
+
+    Клиент отправляет JSON-команды:
+        {"type": "send", "message": ..., "session_id": ..., "request_id": ...}
+        {"type": "subscribe", "operation_id": ...}
+        {"type": "cancel", "operation_id": ...}
+        {"type": "ping"}
+
+    Сервер отвечает событиями:
+        accepted  - задача поставлена в очередь (operation_id, session_id, request_id)
+        queue     - место задачи в очереди (position)
+        reasoning - фрагмент рассуждений модели (text)
+        token     - фрагмент ответа (text)
+        status    - ответ /operation_status при смене статуса или прогресса
+        cancel    - итог команды cancel (outcome)
+        error     - ошибка команды (error, request_id, retry_after)
+        pong
+
+    Фрагменты ответа доступны, если задачу выполняет воркер этого процесса;
+    иначе клиент получает только смену статуса и итог, как через REST.
+
+    submit(user_id, session_id, message, files) ставит задачу в очередь и
+    возвращает (операция, None) или (None, причина отказа).
+    """
+
+    def __init__(self, ws, registry, submit, user_id, keepalive=15, retry_after=30):
+        self.ws = ws
+        self.registry = registry
+        self.submit = submit
+        self.user_id = user_id
+        self.keepalive = keepalive
+        self.retry_after = retry_after
+        self._send_lock = threading.Lock()  # события шлют поток соединения и потоки подписок
+        self._closed = threading.Event()
+        self._watching = set()
+
+    def send(self, event_type, **fields):
+        fields['type'] = event_type
+        with self._send_lock:
+            self.ws.send(json.dumps(fields, ensure_ascii=False))
+
+    def run(self):
+        """Читает команды клиента, пока соединение открыто"""
+        try:
+            while True:
+                raw = self.ws.receive()
+                if raw is None:
+                    continue
+                try:
+                    command = json.loads(raw)
+                except ValueError:
+                    self.send('error', error='Некорректная команда')
+                    continue
+                self.handle(command)
+        except Exception:
+            # Соединение закрыто клиентом или прокси
+            pass
+        finally:
+            self._closed.set()
+
+    def handle(self, command):
+        command_type = command.get('type')
+
+        if command_type == 'send':
+            message = (command.get('message') or '').strip()
+            if not message:
+                self.send('error', error='Пустое сообщение', request_id=command.get('request_id'))
+                return
+
+            try:
+                files = normalize_files(command.get('files'))
+            except UploadError as e:
+                self.send('error', error=str(e), request_id=command.get('request_id'))
+                return
+
+            operation, rejection = self.submit(self.user_id, command.get('session_id') or '', message, files)
+            if rejection:
+                self.send('error', error=rejection, request_id=command.get('request_id'),
+                          retry_after=self.retry_after)
+                return
+
+            self.send('accepted', operation_id=operation.operation_id, session_id=operation.session_id,
+                      request_id=command.get('request_id'))
+            self.watch(operation.operation_id)
+
+        elif command_type == 'subscribe':
+            operation_id = command.get('operation_id')
+            if self.registry.status(operation_id, self.user_id) is None:
+                self.send('error', error='Операция не найдена', operation_id=operation_id)
+                return
+            self.watch(operation_id)
+
+        elif command_type == 'cancel':
+            operation_id = command.get('operation_id')
+            outcome = self.registry.cancel(operation_id, self.user_id)
+            self.send('cancel', operation_id=operation_id, outcome=outcome)
+
+        elif command_type == 'ping':
+            self.send('pong')
+
+        else:
+            self.send('error', error=f'Неизвестная команда: {command_type}')
+
+    def watch(self, operation_id):
+        """Подписывает соединение на события операции (один поток на операцию)"""
+        if operation_id in self._watching:
+            return
+        self._watching.add(operation_id)
+
+        thread = threading.Thread(target=self._watch, args=(operation_id,), name=f'ws-watch-{operation_id[:8]}')
+        thread.daemon = True
+        thread.start()
+
+    def _watch(self, operation_id):
+        status = progress = None
+        position = None
+        offset = 0
+
+        try:
+            while not self._closed.is_set():
+                # Место в очереди меняется от действий других процессов - опрашиваем чаще
+                timeout = self.registry.poll_interval if status in (None, 'pending') else self.keepalive
+                response = self.registry.wait(operation_id, status, progress, timeout=timeout,
+                                              user_id=self.user_id, offset=offset)
+                if response is None:
+                    self.send('error', error='Операция не найдена', operation_id=operation_id)
+                    return
+
+                events = self.registry.events(operation_id, offset)
+                offset += len(events)
+                for kind, text in _coalesce(events):
+                    self.send(kind, operation_id=operation_id, text=text)
+
+                if response['status'] == 'pending':
+                    current = self.registry.store.queue_position(operation_id)
+                    if current != position:
+                        position = current
+                        self.send('queue', operation_id=operation_id, position=position)
+
+                if (response['status'], response['progress']) != (status, progress):
+                    status, progress = response['status'], response['progress']
+                    self.send('status', **response)
+
+                if status in FINISHED_STATUSES:
+                    return
+        except Exception:
+            # Соединение закрылось во время отправки
+            self._closed.set()
+        finally:
+            self._watching.discard(operation_id)
+
+
+def _coalesce(events):
+    """Склеивает подряд идущие фрагменты одного вида - меньше кадров на соединение"""
+    merged = []
+    for kind, text in events:
+        if merged and merged[-1][0] == kind:
+            merged[-1] = (kind, merged[-1][1] + text)
+        else:
+            merged.append((kind, text))
+    return merged